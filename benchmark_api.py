@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Load and latency benchmarks against a running Geometrize API.
+
+Usage: python benchmark_api.py [--url http://localhost:8000] <benchmark> [options]
+
+Benchmarks:
+  tiled     Compare a single run with tiled mode on a large (4K by default) image
+  fairness  Interactive latency (p50/p99) alone and next to a flood of batch jobs
+  load      Throughput and latency with several clients submitting jobs concurrently
+  upload    Multipart upload vs. raw request body for large (5-20 MB) images
+  pyramid   Native engine with and without coarse-to-fine pyramid mode
+  sequence  Seeded image sequence vs. independent runs per frame
+  checkpoints  Several shape counts from one run vs. one run per count
+  coalesce  Identical concurrent requests sharing a single run
+"""
+
+import io
+import os
+import json
+import random
+import math
+import sys
+import time
+import argparse
+import threading
+import statistics
+
+import requests
+from PIL import Image, ImageDraw
+
+
+def create_test_image(width, height, fmt="PNG"):
+    """Create a synthetic test image with some structure and return its encoded bytes."""
+    img = Image.new('RGB', (width, height), color='white')
+    draw = ImageDraw.Draw(img)
+    step = max(1, min(width, height) // 8)
+    for i, x in enumerate(range(0, width, step)):
+        color = ((i * 53) % 256, (i * 97) % 256, (i * 151) % 256)
+        draw.ellipse([x, (i * step) % height, x + step * 2, (i * step) % height + step], fill=color)
+        draw.polygon([(x, height), (x + step, height // 2), (x + step * 2, height)], fill=color[::-1])
+    buffer = io.BytesIO()
+    img.save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def timed_generate(url, image_bytes, data, filename="image.png", headers=None):
+    """POST one /api/generate request and return (seconds, response)."""
+    started = time.perf_counter()
+    response = requests.post(f"{url}/api/generate", files={'image': (filename, image_bytes)}, data=data, headers=headers)
+    return time.perf_counter() - started, response
+
+
+def summarize(name, samples):
+    print(f"{name}: min={min(samples):.2f} s  median={statistics.median(samples):.2f} s  max={max(samples):.2f} s")
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def benchmark_tiled(args):
+    """Single run vs. tiled mode on the same large image."""
+    image_bytes = create_test_image(args.width, args.height)
+    base = {'output_format': 'json', 'shape_types': ['triangle'], 'shape_count': args.shapes}
+
+    for label, extra in [("single run", {}), (f"tiled ({args.tile_size}px)", {'tile_size': args.tile_size})]:
+        samples = []
+        for _ in range(args.runs):
+            seconds, response = timed_generate(args.url, image_bytes, {**base, **extra})
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+            samples.append(seconds)
+        result = response.json()
+        summarize(f"{label}: {result['shapes_generated']} shapes, {result.get('tiles', 1)} tile(s)", samples)
+    return True
+
+
+def benchmark_fairness(args):
+    """Interactive latency alone, then while other clients keep the server busy with batch jobs."""
+    def interactive_latencies(round_index):
+        samples = []
+        for i in range(args.requests):
+            # A different image each time so no result comes from the cache
+            image_bytes = create_test_image(256 + i, 256 + round_index)
+            seconds, response = timed_generate(
+                args.url, image_bytes, {'output_format': 'json', 'shape_count': args.interactive_shapes},
+                headers={'X-Client-Id': 'interactive-user'}
+            )
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+            samples.append(seconds)
+        return samples
+
+    def report(label, samples):
+        print(f"{label}: p50={percentile(samples, 0.5):.2f} s  p99={percentile(samples, 0.99):.2f} s  max={max(samples):.2f} s")
+
+    report("interactive, idle server", interactive_latencies(0))
+
+    stop = threading.Event()
+    batch_done = []
+
+    def batch_client(index):
+        count = 0
+        while not stop.is_set():
+            image_bytes = create_test_image(400 + index, 400 + count)
+            _, response = timed_generate(
+                args.url, image_bytes,
+                {'output_format': 'json', 'shape_count': args.batch_shapes, 'priority': 'batch'},
+                headers={'X-Client-Id': f'batch-tenant-{index % 2}'}
+            )
+            if response.status_code == 200:
+                batch_done.append(1)
+            count += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=batch_client, args=(i,), daemon=True) for i in range(args.batch_clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    report(f"interactive, {args.batch_clients} batch clients", interactive_latencies(1))
+    stop.set()
+    elapsed = time.perf_counter() - started
+    print(f"batch throughput meanwhile: {len(batch_done)} jobs in {elapsed:.1f} s")
+    return True
+
+
+def benchmark_load(args):
+    """
+    Throughput and latency under concurrent load.
+
+    Run it against servers started with different GEOMETRIZE_PRIMITIVE_THREADS settings
+    (e.g. the default CPU-aware split vs. -1, primitive using all cores for every run).
+    """
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def client(index):
+        for i in range(args.requests):
+            # A different image each time so no result comes from the cache
+            image_bytes = create_test_image(args.size + index, args.size + i)
+            seconds, response = timed_generate(
+                args.url, image_bytes, {'output_format': 'json', 'shape_count': args.shapes},
+                headers={'X-Client-Id': f'load-{index}'}
+            )
+            with lock:
+                (latencies if response.status_code == 200 else failures).append(seconds)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.clients} clients x {args.requests} jobs of {args.shapes} shapes")
+    print(f"throughput: {len(latencies) / elapsed:.2f} jobs/s ({len(latencies)} in {elapsed:.1f} s, {len(failures)} failed)")
+    if latencies:
+        print(f"latency: p50={percentile(latencies, 0.5):.2f} s  p99={percentile(latencies, 0.99):.2f} s  max={max(latencies):.2f} s")
+    metrics = requests.get(f"{args.url}/metrics").text
+    budget = [line for line in metrics.splitlines() if line.startswith("geometrize_cpu_budget")]
+    if budget:
+        print(f"server CPU budget: {budget[0].split()[-1]}")
+    return not failures
+
+
+def metric_value(url, name):
+    """Current value of an unlabelled counter or gauge from /metrics (0 if not exported yet)."""
+    for line in requests.get(f"{url}/metrics").text.splitlines():
+        if line.startswith(f"{name} "):
+            return float(line.split()[-1])
+    return 0.0
+
+
+def benchmark_coalesce(args):
+    """
+    N identical requests at once: with in-flight coalescing they should cost a single run.
+
+    The first client gives up after --disconnect-after seconds (if set), to show that the
+    job keeps running for the others when only some of its waiters leave.
+    """
+    # Fresh images on every invocation, so the result is not already in the cache
+    width = args.size + random.randrange(1000)
+    image_bytes = create_test_image(width, args.size)
+    data = {'output_format': 'json', 'shape_count': args.shapes}
+    baseline, response = timed_generate(args.url, create_test_image(width, args.size - 1), data)
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+
+    responses = [None] * args.clients
+    latencies = [None] * args.clients
+    started_before = metric_value(args.url, "geometrize_jobs_started_total")
+
+    def client(index):
+        timeout = args.disconnect_after if index == 0 and args.disconnect_after else None
+        started = time.perf_counter()
+        try:
+            responses[index] = requests.post(
+                f"{args.url}/api/generate", files={'image': ('image.png', image_bytes)}, data=data,
+                headers={'X-Client-Id': f'coalesce-{index}'}, timeout=timeout,
+            )
+        except requests.Timeout:
+            responses[index] = "disconnected"
+        latencies[index] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    runs = metric_value(args.url, "geometrize_jobs_started_total") - started_before
+
+    served = [r for r in responses if r != "disconnected"]
+    ok = [r for r in served if r.status_code == 200]
+    statuses = {}
+    for r in ok:
+        statuses[r.headers.get('X-Cache')] = statuses.get(r.headers.get('X-Cache'), 0) + 1
+    identical = len({json.dumps(r.json()['shapes']) for r in ok}) <= 1
+
+    print(f"{args.clients} identical requests of {args.shapes} shapes ({len(responses) - len(served)} disconnected early)")
+    print(f"single request: {baseline:.2f} s   all {args.clients}: {elapsed:.2f} s")
+    print(f"runs started: {runs:g}   served: {len(ok)}/{len(served)}   X-Cache: {statuses}   identical results: {identical}")
+    return runs == 1 and len(ok) == len(served) and identical
+
+
+def create_noise_image(megabytes):
+    """A PNG of random pixels (which barely compresses) of about `megabytes` MB."""
+    side = int((megabytes * 1_000_000 / 3) ** 0.5)
+    img = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+def benchmark_upload(args):
+    """
+    Request time of a multipart upload vs. the same image as a raw body.
+
+    Every image is generated once first, so the timed requests are result cache hits and
+    measure ingestion (transfer, parsing, spooling, hashing) rather than primitive.
+    """
+    data = {'output_format': 'json', 'shape_count': 1, 'resize_width': 128}
+    for megabytes in args.sizes:
+        image_bytes = create_noise_image(megabytes)
+        _, response = timed_generate(args.url, image_bytes, data)
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+
+        multipart, raw = [], []
+        for _ in range(args.runs):
+            seconds, response = timed_generate(args.url, image_bytes, data)
+            assert response.headers.get('X-Cache') == 'HIT', "Expected a cache hit"
+            multipart.append(seconds)
+
+            started = time.perf_counter()
+            response = requests.post(
+                f"{args.url}/api/generate/raw", params=data, data=image_bytes,
+                headers={'Content-Type': 'image/png'}
+            )
+            raw.append(time.perf_counter() - started)
+            assert response.headers.get('X-Cache') == 'HIT', "Expected a cache hit"
+
+        size = len(image_bytes) / 1_000_000
+        print(f"{size:.1f} MB  multipart: median={statistics.median(multipart) * 1000:.0f} ms  "
+              f"raw body: median={statistics.median(raw) * 1000:.0f} ms")
+    return True
+
+
+def benchmark_pyramid(args):
+    """
+    Similarity, pixel evaluations and run time of the native engine, full resolution vs. pyramid.
+
+    Each image is different (so no result comes from the cache) and is run in both modes.
+    """
+    results = {False: [], True: []}
+    for i in range(args.images):
+        image_bytes = create_test_image(args.size + i, args.size - i)
+        for pyramid in (False, True):
+            seconds, response = timed_generate(
+                args.url, image_bytes,
+                {'output_format': 'json', 'shape_count': args.shapes, 'engine': 'native', 'pyramid': pyramid},
+            )
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+            result = response.json()
+            results[pyramid].append((result['quality']['similarity'], result['engine']['pixels_evaluated'], seconds))
+
+    for pyramid, label in ((False, "full resolution"), (True, "pyramid")):
+        similarity, pixels, seconds = (statistics.mean(column) for column in zip(*results[pyramid]))
+        print(f"{label}: similarity={similarity:.4f}  pixels evaluated={pixels / 1e6:.1f} M  time={seconds:.2f} s")
+    return True
+
+
+def create_turntable_frames(count, width, height):
+    """PNG frames of a static scene with an object turning in the middle."""
+    frames = []
+    for index in range(count):
+        img = Image.new('RGB', (width, height), color=(170, 190, 215))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle([0, height * 3 // 4, width, height], fill=(120, 100, 80))
+        draw.ellipse([width // 20, height // 20, width // 5, height // 4], fill=(250, 230, 120))
+        angle = math.pi * index / count
+        cx, cy, r = width / 2, height / 2, min(width, height) / 4
+        points = [
+            (cx + r * math.cos(angle + k * 2 * math.pi / 5) * (1 if k % 2 else 0.6), cy + r * 0.8 * math.sin(angle + k * 2 * math.pi / 5))
+            for k in range(5)
+        ]
+        draw.polygon(points, fill=(200, 40, 40))
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG')
+        frames.append(buffer.getvalue())
+    return frames
+
+
+def benchmark_sequence(args):
+    """Per-frame time and similarity of /api/generate/sequence vs. an independent native run per frame."""
+    frames = create_turntable_frames(args.frames, args.size, args.size * 3 // 4)
+    data = {'output_format': 'json', 'shape_count': args.shapes}
+
+    started = time.perf_counter()
+    response = requests.post(
+        f"{args.url}/api/generate/sequence", data=data,
+        files=[('frames', (f'frame{i}.png', frame)) for i, frame in enumerate(frames)],
+    )
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+    result = response.json()
+    similarities = [frame['similarity'] for frame in result['frames']]
+    print(f"sequence: {elapsed / len(frames):.2f} s per frame  "
+          f"similarity min={min(similarities):.4f} mean={statistics.mean(similarities):.4f}  "
+          f"shapes added after the first frame: {result['shapes_added'] - result['frames'][0]['shapes_added']}")
+
+    samples, similarities = [], []
+    for frame in frames[:args.independent]:
+        seconds, response = timed_generate(args.url, frame, {**data, 'engine': 'native'})
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        samples.append(seconds)
+        similarities.append(response.json()['similarity'])
+    print(f"independent: {statistics.mean(samples):.2f} s per frame  "
+          f"similarity min={min(similarities):.4f} mean={statistics.mean(similarities):.4f}")
+    return True
+
+
+def benchmark_checkpoints(args):
+    """
+    Several shape counts from one run (checkpoints) vs. one run per count.
+
+    Uses the native engine so the comparison does not depend on an installed primitive.
+    """
+    counts = sorted(args.counts)
+    separate, combined = [], []
+    for i in range(args.runs):
+        image_bytes = create_test_image(args.size + i, args.size - i)
+        started = time.perf_counter()
+        for count in counts:
+            response = requests.post(
+                f"{args.url}/api/generate", files={'image': ('image.png', image_bytes, 'image/png')},
+                data={'output_format': 'json', 'shape_count': count, 'engine': 'native'},
+            )
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        separate.append(time.perf_counter() - started)
+
+        # A different image again, so the checkpoints are not served from the cache
+        image_bytes = create_test_image(args.size + i, args.size - i - 1)
+        seconds, response = timed_generate(
+            args.url, image_bytes,
+            {'output_format': 'json', 'shape_count': ",".join(map(str, counts)), 'engine': 'native'},
+        )
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        assert len(response.json()['checkpoints']) == len(counts) - 1
+        combined.append(seconds)
+
+    summarize(f"one run per count ({len(counts)} runs)", separate)
+    summarize("one run with checkpoints", combined)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Geometrize API benchmarks')
+    parser.add_argument('--url', default='http://localhost:8000', help='Base URL of the API (default: http://localhost:8000)')
+    parser.add_argument('--runs', type=int, default=3, help='Repetitions per measurement (default: 3)')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    tiled = subparsers.add_parser('tiled', help='Single run vs. tiled mode on a large image')
+    tiled.add_argument('--width', type=int, default=3840)
+    tiled.add_argument('--height', type=int, default=2160)
+    tiled.add_argument('--shapes', type=int, default=400)
+    tiled.add_argument('--tile-size', type=int, default=1024)
+    tiled.set_defaults(func=benchmark_tiled)
+
+    fairness = subparsers.add_parser('fairness', help='Interactive latency next to a flood of batch jobs')
+    fairness.add_argument('--requests', type=int, default=30, help='Interactive requests per measurement')
+    fairness.add_argument('--interactive-shapes', type=int, default=50)
+    fairness.add_argument('--batch-clients', type=int, default=8)
+    fairness.add_argument('--batch-shapes', type=int, default=2000)
+    fairness.set_defaults(func=benchmark_fairness)
+
+    load = subparsers.add_parser('load', help='Throughput and latency with concurrent clients')
+    load.add_argument('--clients', type=int, default=8)
+    load.add_argument('--requests', type=int, default=5, help='Jobs per client')
+    load.add_argument('--shapes', type=int, default=300)
+    load.add_argument('--size', type=int, default=512, help='Approximate image side in pixels')
+    load.set_defaults(func=benchmark_load)
+
+    upload = subparsers.add_parser('upload', help='Multipart upload vs. raw request body')
+    upload.add_argument('--sizes', type=float, nargs='+', default=[5, 10, 19], help='Image sizes in MB')
+    upload.set_defaults(func=benchmark_upload)
+
+    pyramid = subparsers.add_parser('pyramid', help='Native engine with and without pyramid mode')
+    pyramid.add_argument('--images', type=int, default=3)
+    pyramid.add_argument('--shapes', type=int, default=200)
+    pyramid.add_argument('--size', type=int, default=512, help='Approximate image side in pixels')
+    pyramid.set_defaults(func=benchmark_pyramid)
+
+    sequence = subparsers.add_parser('sequence', help='Seeded image sequence vs. independent runs')
+    sequence.add_argument('--frames', type=int, default=12)
+    sequence.add_argument('--independent', type=int, default=3, help='Frames also run independently')
+    sequence.add_argument('--shapes', type=int, default=150)
+    sequence.add_argument('--size', type=int, default=512, help='Frame width in pixels')
+    sequence.set_defaults(func=benchmark_sequence)
+
+    checkpoints = subparsers.add_parser('checkpoints', help='Several shape counts from one run vs. one run each')
+    checkpoints.add_argument('--counts', type=int, nargs='+', default=[50, 100, 200])
+    checkpoints.add_argument('--size', type=int, default=512, help='Approximate image side in pixels')
+    checkpoints.set_defaults(func=benchmark_checkpoints)
+
+    coalesce = subparsers.add_parser('coalesce', help='Identical concurrent requests sharing one run')
+    coalesce.add_argument('--clients', type=int, default=16)
+    coalesce.add_argument('--shapes', type=int, default=300)
+    coalesce.add_argument('--size', type=int, default=512, help='Approximate image side in pixels')
+    coalesce.add_argument('--disconnect-after', type=float, default=0.5,
+                          help='Seconds after which the first client gives up (0: never)')
+    coalesce.set_defaults(func=benchmark_coalesce)
+
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"Geometrize API Benchmark: {args.benchmark}")
+    print("=" * 60)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
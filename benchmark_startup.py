@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for the Geometrize API.
+
+Measures two things in fresh interpreters:
+- import time of the `geometrize_api` module (what every cold-started pod pays)
+- startup-to-ready time: from launching `run.py` until GET /ready answers 200
+
+Usage: python benchmark_startup.py [--runs 5] [--port 8011] [--budget-ms 2000]
+"""
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import urllib.request
+import urllib.error
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import geometrize_api; "
+    "print((time.perf_counter() - t) * 1000)"
+)
+
+def measure_import_ms():
+    """Import geometrize_api in a fresh interpreter and return the import time in ms."""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=HERE, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+def measure_ready_ms(port, timeout=30.0):
+    """Start run.py and return (wall ms until /ready is 200, startup_ms reported by the server)."""
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "run.py", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+                    body = json.loads(response.read())
+                    return (time.perf_counter() - started) * 1000, body.get("startup_ms")
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(f"/ready did not answer 200 within {timeout} s")
+    finally:
+        server.terminate()
+        server.wait()
+
+def summarize(name, samples):
+    print(f"{name}: min={min(samples):.1f} ms  median={statistics.median(samples):.1f} ms  max={max(samples):.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description='Geometrize API startup benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh processes per measurement (default: 5)')
+    parser.add_argument('--port', type=int, default=8011, help='Port used for the readiness measurement (default: 8011)')
+    parser.add_argument('--budget-ms', type=float, default=2000, help='Startup-to-ready budget in ms (default: 2000)')
+    parser.add_argument('--skip-ready', action='store_true', help='Only measure module import time')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Geometrize API Startup Benchmark")
+    print("=" * 60)
+
+    summarize("import geometrize_api", [measure_import_ms() for _ in range(args.runs)])
+
+    if args.skip_ready:
+        return True
+
+    wall, reported = [], []
+    for _ in range(args.runs):
+        wall_ms, startup_ms = measure_ready_ms(args.port)
+        wall.append(wall_ms)
+        if startup_ms is not None:
+            reported.append(startup_ms)
+
+    summarize("launch -> /ready (wall)", wall)
+    if reported:
+        summarize("startup_ms (server)", reported)
+
+    within_budget = statistics.median(wall) <= args.budget_ms
+    print("=" * 60)
+    print(f"Budget {args.budget_ms:.0f} ms: {'OK' if within_budget else 'EXCEEDED'}")
+    print("=" * 60)
+    return within_budget
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
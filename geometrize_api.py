@@ -6,23 +6,170 @@ using evolutionary algorithms. Supports multiple shape types and output formats.
 """
 
 import os
+import re
 import json
-import base64
-import tempfile
-import subprocess
+import math
+import operator
+import time
+import hashlib
+import asyncio
 import platform
 import shutil
-import xml.etree.ElementTree as ET
-import re
-from pathlib import Path
-from typing import Optional, List
-from io import BytesIO
+import tempfile
+import functools
+import threading
+from collections import OrderedDict, deque
+from contextlib import ExitStack, asynccontextmanager
+from typing import Callable, Iterator, Optional, List
+
+from fastapi import FastAPI, UploadFile, File, Form, Query, Body, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+
+# NOTE: PIL, subprocess, xml.etree and uvicorn are imported inside the functions that
+# use them. Pods are cold-started frequently by the autoscaler, so module import must
+# stay cheap; the readiness warm-up (see `warm_up`) pays for these imports once, off the
+# request path. Run `python benchmark_startup.py` to measure import and startup time.
+
+# Reference point for the startup-to-ready measurement reported by /ready
+STARTUP_STARTED_AT = time.monotonic()
+
+
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment, falling back to `default`."""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"[WARNING] Ignoring non-integer value for {name}: {value!r}")
+        return default
+
+
+def available_cpus() -> int:
+    """
+    Number of CPUs this process may actually use.
+
+    os.cpu_count() reports the host's cores; inside a container the usable share is
+    limited by the CPU affinity mask and by the cgroup CPU quota (cgroup v2 `cpu.max`,
+    or v1 `cpu.cfs_quota_us` / `cpu.cfs_period_us`). The smallest of these wins; a
+    fractional quota is rounded up.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse, StreamingResponse
-from PIL import Image, Image as PILImage # Keep PIL.Image for main use, and PILImage for clarity in PNG conversion
-import svgwrite
-import uvicorn
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()[:2]
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+# Target time from module import to readiness, in milliseconds
+STARTUP_READY_BUDGET_MS = _env_int("GEOMETRIZE_READY_BUDGET_MS", 2000)
+
+# After a failed warm-up (e.g. primitive not installed yet), /ready retries it at most
+# this often, in seconds
+READY_RETRY_SECONDS = _env_int("GEOMETRIZE_READY_RETRY_SECONDS", 5)
+
+# Upload limits. Uploads are streamed in chunks and refused as soon as they exceed
+# MAX_UPLOAD_BYTES; pixel dimensions are checked from the image header before decoding.
+MAX_UPLOAD_BYTES = _env_int("GEOMETRIZE_MAX_UPLOAD_BYTES", 20 * 1024 * 1024)
+MAX_IMAGE_PIXELS = _env_int("GEOMETRIZE_MAX_IMAGE_PIXELS", 25_000_000)
+MAX_IMAGE_DIMENSION = _env_int("GEOMETRIZE_MAX_IMAGE_DIMENSION", 12_000)
+# Uploads larger than this are spooled from memory to a file in the scratch directory
+UPLOAD_SPOOL_BYTES = _env_int("GEOMETRIZE_UPLOAD_SPOOL_BYTES", 1024 * 1024)
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# Allowance for multipart boundaries and form fields on top of the image itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# Directory for spooled uploads and per-request working files (system temp dir if unset)
+SCRATCH_DIR = os.environ.get("GEOMETRIZE_SCRATCH_DIR") or None
+
+# Hard limit for a single primitive run, in seconds
+PRIMITIVE_TIMEOUT_SECONDS = _env_int("GEOMETRIZE_PRIMITIVE_TIMEOUT", 300)
+# Number of intermediate SVG snapshots written during a time-budgeted run. More snapshots
+# lose fewer shapes when the budget runs out, at the cost of writing more SVG files.
+SNAPSHOTS_PER_RUN = _env_int("GEOMETRIZE_SNAPSHOTS_PER_RUN", 50)
+# primitive scales its input down to this size (its `-r` default) and places shapes at that resolution
+PRIMITIVE_WORKING_SIZE = 256
+# CPUs primitive runs may use altogether (0 = detect from CPU affinity and cgroup quota)
+CPU_BUDGET = _env_int("GEOMETRIZE_CPU_BUDGET", 0) or available_cpus()
+# Worker threads (primitive's -j) per run: 0 = split CPU_BUDGET between the jobs running
+# at the time a job starts, -1 = leave it to primitive (all cores for every run)
+PRIMITIVE_THREADS = _env_int("GEOMETRIZE_PRIMITIVE_THREADS", 0)
+# Number of tiles geometrized in parallel in tiled mode (0 = one per CPU of the job)
+TILE_WORKERS = _env_int("GEOMETRIZE_TILE_WORKERS", 0)
+
+# Job scheduling: primitive runs share this many slots (0 = one per CPU of CPU_BUDGET). Interactive jobs
+# are admitted before batch jobs; batch jobs may only fill part of the slots so that
+# interactive requests always find capacity (0 = half of the slots, at least one).
+MAX_CONCURRENT_JOBS = _env_int("GEOMETRIZE_MAX_CONCURRENT_JOBS", 0)
+BATCH_MAX_CONCURRENT = _env_int("GEOMETRIZE_BATCH_MAX_CONCURRENT", 0)
+INTERACTIVE_MAX_CONCURRENT = _env_int("GEOMETRIZE_INTERACTIVE_MAX_CONCURRENT", 0)
+# Fair-share weights per client key, e.g. "key-a=3,key-b=1" (clients not listed get 1)
+CLIENT_WEIGHTS = os.environ.get("GEOMETRIZE_CLIENT_WEIGHTS", "")
+# Admission control: requests whose estimated queue wait exceeds this many seconds are
+# rejected with 429 and Retry-After (0 = never reject)
+MAX_QUEUE_WAIT_SECONDS = _env_int("GEOMETRIZE_MAX_QUEUE_WAIT", 30)
+BATCH_MAX_QUEUE_WAIT_SECONDS = _env_int("GEOMETRIZE_BATCH_MAX_QUEUE_WAIT", 600)
+
+# Interactive sessions (WebSocket /api/session): at most this many open at once (the
+# longest-idle one is evicted for a new one), closed after this many idle seconds, and
+# holding at most this many shapes
+MAX_SESSIONS = _env_int("GEOMETRIZE_MAX_SESSIONS", 16)
+SESSION_IDLE_SECONDS = _env_int("GEOMETRIZE_SESSION_IDLE_SECONDS", 300)
+SESSION_MAX_SHAPES = _env_int("GEOMETRIZE_SESSION_MAX_SHAPES", 5000)
+
+# Shape counts one /api/generate request may ask for (shape_count=50,100,200)
+MAX_CHECKPOINTS = 16
+
+# Sequences (/api/generate/sequence): at most this many frames per request, and at most
+# this many bytes for all of them together (each file is also held to MAX_UPLOAD_BYTES)
+MAX_SEQUENCE_FRAMES = _env_int("GEOMETRIZE_MAX_SEQUENCE_FRAMES", 240)
+MAX_SEQUENCE_UPLOAD_BYTES = _env_int("GEOMETRIZE_MAX_SEQUENCE_UPLOAD_BYTES", 256 * 1024 * 1024)
+
+# Result cache: outputs of previous runs on disk, keyed by upload hash and parameters.
+# Set GEOMETRIZE_CACHE_MAX_BYTES=0 to disable it.
+CACHE_DIR = os.environ.get("GEOMETRIZE_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "geometrize-cache")
+CACHE_MAX_BYTES = _env_int("GEOMETRIZE_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+# Input cache: decoded and resized working images, keyed by upload hash and resize
+# parameters and referenced by clients as `image_id`. GEOMETRIZE_INPUT_CACHE_MAX_BYTES=0 disables it.
+INPUT_CACHE_DIR = os.environ.get("GEOMETRIZE_INPUT_CACHE_DIR") or CACHE_DIR.rstrip("/\\") + "-inputs"
+INPUT_CACHE_MAX_BYTES = _env_int("GEOMETRIZE_INPUT_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+
+OUTPUT_MEDIA_TYPES = {
+    "svg": "image/svg+xml", "png": "image/png", "json": "application/json", "ndjson": "application/x-ndjson",
+    "webp": "image/webp",
+}
+# Image formats produced by POST /api/render
+RENDER_FORMATS = ("png", "webp")
+# Renders are drawn at this multiple of the requested size and downsampled, for anti-aliasing
+RENDER_SUPERSAMPLE = 2
+# Text outputs are served compressed when the client accepts it; PNG is already compressed
+COMPRESSIBLE_FORMATS = {"svg", "json", "ndjson"}
+# Supported Content-Encodings and their file suffix, in order of preference
+CONTENT_ENCODINGS = {"br": ".br", "gzip": ".gz"}
+MIN_COMPRESS_BYTES = 256
+BROTLI_QUALITY = 9
 
 
 # Shape type mappings for the primitive command-line tool
@@ -53,13 +200,182 @@ SHAPE_MODE_NAMES = {
     8: "polygon",
 }
 
+class Metrics:
+    """
+    Minimal process-wide metrics registry rendered in the Prometheus text format.
+
+    Counters and gauges are identified by name plus an optional set of labels. Updates
+    are thread-safe, since primitive runs are monitored from worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._buckets = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Optional[tuple] = None) -> None:
+        """
+        Register a metric so it is listed (with HELP/TYPE lines) even before its first update.
+
+        Histograms need their upper bucket bounds in `buckets`.
+        """
+        self._meta[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+        if buckets is not None:
+            self._buckets[name] = tuple(sorted(buckets))
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record one observation in a histogram."""
+        key = tuple(sorted(labels.items()))
+        bounds = self._buckets[name]
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            counts, total, count = series.get(key, ([0] * len(bounds), 0.0, 0))
+            counts = [c + 1 if value <= bound else c for c, bound in zip(counts, bounds)]
+            series[key] = (counts, total + value, count + 1)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Increase a counter (or gauge) by `value`."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Set a gauge to `value`."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def get(self, name: str, **labels) -> float:
+        """Current value of a metric series (0 if it was never updated)."""
+        with self._lock:
+            return self._values.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in self._values.items():
+                kind, help_text = self._meta.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if not series and kind == "counter" and name in self._meta:
+                    lines.append(f"{name} 0")
+                for key, value in series.items():
+                    labels = ",".join(f'{label}="{label_value}"' for label, label_value in key)
+                    if kind == "histogram":
+                        counts, total, count = value
+                        prefix = labels + "," if labels else ""
+                        for bound, bucket_count in zip(self._buckets[name], counts):
+                            lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {bucket_count}')
+                        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {count}')
+                        lines.append(f"{name}_sum{{{labels}}} {total:g}" if labels else f"{name}_sum {total:g}")
+                        lines.append(f"{name}_count{{{labels}}} {count}" if labels else f"{name}_count {count}")
+                        continue
+                    lines.append(f"{name}{{{labels}}} {value:g}" if labels else f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("geometrize_jobs_started_total", "counter", "primitive runs started")
+METRICS.describe("geometrize_jobs_cancelled_total", "counter", "primitive runs killed because the client disconnected")
+METRICS.describe("geometrize_jobs_abandoned_total", "counter", "jobs whose client disconnected while queued, by priority class")
+METRICS.describe("geometrize_jobs_rejected_total", "counter", "jobs rejected with 429 by admission control, by priority class")
+METRICS.describe("geometrize_jobs_running", "gauge", "primitive jobs holding a scheduler slot, by priority class")
+METRICS.describe("geometrize_jobs_queued", "gauge", "primitive jobs waiting for a scheduler slot, by priority class")
+METRICS.describe("geometrize_worker_threads", "gauge", "worker threads assigned to running primitive jobs")
+METRICS.describe("geometrize_cpu_budget", "gauge", "CPUs available to primitive runs")
+METRICS.describe("geometrize_sessions_active", "gauge", "open interactive sessions")
+METRICS.describe("geometrize_sessions_evicted_total", "counter", "interactive sessions closed by the server, by reason")
+METRICS.describe("geometrize_session_shapes_total", "counter", "shapes added in interactive sessions")
+METRICS.describe("geometrize_sequence_frames_total", "counter", "frames geometrized by /api/generate/sequence")
+METRICS.describe("geometrize_jobs_coalesced_total", "counter", "requests served by another request's identical in-flight job")
+METRICS.describe("geometrize_job_runs_total", "counter", "engine runs, by shape mode and client")
+METRICS.describe("geometrize_job_wall_seconds_total", "counter", "wall time of engine runs, by shape mode and client")
+METRICS.describe(
+    "geometrize_job_cpu_seconds_total", "counter", "CPU time of engine runs, by shape mode, client and kind (user/system)"
+)
+METRICS.describe("geometrize_job_bytes_in_total", "counter", "bytes uploaded to /api/generate, by shape mode and client")
+METRICS.describe("geometrize_job_bytes_out_total", "counter", "response bytes sent by /api/generate, by shape mode and client")
+METRICS.describe(
+    "geometrize_job_peak_rss_bytes", "histogram", "peak RSS of primitive processes, by shape mode",
+    buckets=tuple(2 ** n * 1024 * 1024 for n in range(3, 13)),
+)
+METRICS.describe(
+    "geometrize_queue_wait_seconds", "histogram", "time jobs waited for a scheduler slot, by priority class",
+    buckets=(0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+# How often a running job checks whether its client is still connected, in seconds
+DISCONNECT_POLL_SECONDS = 0.25
+
+# Readiness state, flipped by `warm_up` once the server can actually serve /api/generate
+READINESS = {
+    "ready": False,
+    "primitive_binary": None,
+    "startup_ms": None,
+    "error": None,
+    "failed_at": None,
+}
+# Held while a warm-up runs, so concurrent /ready probes do not retry it in parallel
+WARM_UP_LOCK = threading.Lock()
+
+
+def warm_up() -> None:
+    """
+    Prepare the process for its first request.
+
+    Resolves the primitive binary and imports the modules used on the request path
+    (Pillow with its format plugins, the SVG parser and subprocess), so the first
+    request does not pay for them. Marks the service ready when done; on failure the
+    error is recorded and /ready calls this again after READY_RETRY_SECONDS.
+    """
+    if not WARM_UP_LOCK.acquire(blocking=False):
+        return
+    try:
+        READINESS["primitive_binary"] = get_primitive_binary()
+
+        import subprocess  # noqa: F401
+        import xml.etree.ElementTree  # noqa: F401
+        from PIL import Image
+        Image.init()
+
+        elapsed_ms = (time.monotonic() - STARTUP_STARTED_AT) * 1000
+        READINESS["startup_ms"] = round(elapsed_ms, 1)
+        READINESS["error"] = None
+        READINESS["ready"] = True
+
+        print(f"[INFO] Ready after {elapsed_ms:.0f} ms (budget: {STARTUP_READY_BUDGET_MS} ms)")
+        if elapsed_ms > STARTUP_READY_BUDGET_MS:
+            print(f"[WARNING] Startup exceeded the ready budget of {STARTUP_READY_BUDGET_MS} ms")
+    except Exception as e:
+        READINESS["error"] = str(e)
+        READINESS["failed_at"] = time.monotonic()
+        print(f"[ERROR] Warm-up failed: {e}")
+    finally:
+        WARM_UP_LOCK.release()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the warm-up in the background so liveness is answered immediately."""
+    loop = asyncio.get_running_loop()
+    warm_up_task = loop.run_in_executor(None, warm_up)
+    yield
+    await warm_up_task
+
+
 app = FastAPI(
     title="Geometrize API",
     description="Transform images into geometric art using shape-based evolutionary algorithms",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 
+@functools.lru_cache(maxsize=1)
 def get_primitive_binary() -> str:
     """
     Get the path to the primitive binary.
@@ -67,6 +383,9 @@ def get_primitive_binary() -> str:
     Supports Windows, Linux, and macOS systems.
     On Windows, looks for primitive.exe in Go bin directory.
     On Unix-like systems, looks for primitive in PATH and common locations.
+
+    The result is cached for the lifetime of the process; a failed lookup is not
+    cached, so installing primitive later is picked up on the next call.
     """
     system = platform.system()
 
@@ -143,481 +462,4883 @@ def extract_points_from_path(path_data: str) -> List[List[float]]:
     return points
 
 
-def parse_svg_shapes(svg_content: str) -> List[dict]:
+SVG_NAMESPACE = "{http://www.w3.org/2000/svg}"
+# primitive wraps rotated shapes in <g transform="translate(x y) rotate(a) scale(sx sy)">
+SHAPE_PLACEMENT = re.compile(
+    r'translate\(([-+\d.eE]+)[ ,]+([-+\d.eE]+)\)\s*rotate\(([-+\d.eE]+)\)\s*scale\(([-+\d.eE]+)[ ,]+([-+\d.eE]+)\)'
+)
+# ... and all shapes in <g transform="scale(s) translate(0.5 0.5)">, mapping working size to output size
+FRAME_SCALE = re.compile(r'scale\(([-+\d.eE]+)\)')
+
+
+def parse_svg_element(tag: str, element, placement: Optional[tuple] = None) -> Optional[dict]:
     """
-    Parse SVG content and extract shape information.
+    Convert one SVG element generated by primitive into a shape dict.
 
-    This parser extracts shape information from SVG generated by the primitive tool.
-    It handles polygons, circles, ellipses, rectangles, and paths.
+    `placement` is the (x, y, angle, sx, sy) of an enclosing translate/rotate/scale group,
+    which primitive uses for rotated rectangles and rotated ellipses.
+    Returns None for elements that are not shapes.
     """
-    shapes = []
-    try:
-        root = ET.fromstring(svg_content)
+    fill = element.get('fill', '#000000')
 
-        # Define namespaces
-        ns = {'svg': 'http://www.w3.org/2000/svg'}
+    # Polygons (Triangles and Polygons)
+    if tag == "polygon":
+        points_str = element.get('points', '')
+        opacity = float(element.get('fill-opacity', 1.0))
 
-        # 1. Extract background color from the first rect element
-        bg_color = "#ffffff"
-        for rect in root.findall('.//svg:rect', ns):
-            fill = rect.get('fill', '#ffffff')
-            width = float(rect.get('width', 0))
-            height = float(rect.get('height', 0))
+        points = []
+        if points_str:
+            coords = points_str.replace(',', ' ').split()
+            for i in range(0, len(coords) - 1, 2):
+                try:
+                    points.append([float(coords[i]), float(coords[i + 1])])
+                except (ValueError, IndexError):
+                    continue
 
-            # The first rect is usually the background
-            if width > 0 and height > 0:
-                bg_color = fill
-                break
+        if not points:
+            return None
+        return {
+            "type": "triangle" if len(points) == 3 else "polygon",
+            "color": fill,
+            "opacity": round(opacity * 255),
+            "points": points
+        }
 
-        # 2. Extract polygons (Triangles and Polygons)
-        for polygon in root.findall('.//svg:polygon', ns):
-            points_str = polygon.get('points', '')
-            fill = polygon.get('fill', '#000000')
-            opacity = float(polygon.get('fill-opacity', 1.0))
-
-            points = []
-            if points_str:
-                coords = points_str.replace(',', ' ').split()
-                for i in range(0, len(coords) - 1, 2):
-                    try:
-                        points.append([float(coords[i]), float(coords[i + 1])])
-                    except (ValueError, IndexError):
-                        continue
+    # Paths (Lines, Quadratic Béziers, Cubic Béziers)
+    if tag == "path":
+        path_data = element.get('d', '')
+        stroke = element.get('stroke', fill)
+        opacity = float(element.get('fill-opacity', element.get('stroke-opacity', 1.0)))
 
-            if points:
-                shape_type = "triangle" if len(points) == 3 else "polygon"
-                shapes.append({
-                    "type": shape_type,
-                    "color": fill,
-                    "opacity": int(opacity * 255),
-                    "points": points
-                })
+        points = extract_points_from_path(path_data)
+        if not points:
+            return None
 
-        # 3. Extract paths (Lines, Quadratic Béziers, Cubic Béziers)
-        for path in root.findall('.//svg:path', ns):
-            path_data = path.get('d', '')
-            fill = path.get('fill', '#000000')
-            stroke = path.get('stroke', fill)
-            opacity = float(path.get('fill-opacity', path.get('stroke-opacity', 1.0)))
-
-            points = extract_points_from_path(path_data)
-
-            if points:
-                shape_type = "bezier"  # Default to general bezier
-
-                # Check for Line (M x1 y1 L x2 y2)
-                # Primitive's line is a path with only two points (M x1 y1 L x2 y2)
-                if len(points) == 2 and path_data.startswith('M') and 'L' in path_data:
-                    shape_type = "line"
-                # Check for Quadratic Bézier (M x1 y1 Q c1x c1y x2 y2) - 3 points in total
-                elif len(points) == 3 and 'Q' in path_data:
-                    shape_type = "quadratic_bezier"
-                # Check for Cubic Bézier (M x1 y1 C c1x c1y c2x c2y x2 y2) - 4 points in total
-                elif len(points) == 4 and 'C' in path_data:
-                    shape_type = "cubic_bezier"
-                # If primitive is run in line mode (m=6, which is beziers), it can output a line path.
-                # If the user requested 'line' and we got a path, we should assume it's a line if it has 2 points.
-                elif len(points) == 2:
-                    shape_type = "line"
-
-                shapes.append({
-                    "type": shape_type,
-                    "color": fill if fill != "none" else stroke,
-                    "opacity": int(opacity * 255),
-                    "points": points
-                })
+        shape_type = "bezier"  # Default to general bezier
 
-        # 4. Extract circles
-        for circle in root.findall('.//svg:circle', ns):
-            cx = float(circle.get('cx', 0))
-            cy = float(circle.get('cy', 0))
-            r = float(circle.get('r', 0))
-            fill = circle.get('fill', '#000000')
-            opacity = float(circle.get('fill-opacity', 1.0))
+        # Check for Line (M x1 y1 L x2 y2)
+        # Primitive's line is a path with only two points (M x1 y1 L x2 y2)
+        if len(points) == 2 and path_data.startswith('M') and 'L' in path_data:
+            shape_type = "line"
+        # Check for Quadratic Bézier (M x1 y1 Q c1x c1y x2 y2) - 3 points in total
+        elif len(points) == 3 and 'Q' in path_data:
+            shape_type = "quadratic_bezier"
+        # Check for Cubic Bézier (M x1 y1 C c1x c1y c2x c2y x2 y2) - 4 points in total
+        elif len(points) == 4 and 'C' in path_data:
+            shape_type = "cubic_bezier"
+        # If primitive is run in line mode (m=6, which is beziers), it can output a line path.
+        # If the user requested 'line' and we got a path, we should assume it's a line if it has 2 points.
+        elif len(points) == 2:
+            shape_type = "line"
 
-            shapes.append({
-                "type": "circle",
-                "color": fill,
-                "opacity": int(opacity * 255),
-                "center": [cx, cy],
-                "radius": r
-            })
+        return {
+            "type": shape_type,
+            "color": fill if fill != "none" else stroke,
+            "opacity": round(opacity * 255),
+            "points": points,
+            "stroke_width": float(element.get('stroke-width', 1.0))
+        }
+
+    # Circles
+    if tag == "circle":
+        return {
+            "type": "circle",
+            "color": fill,
+            "opacity": round(float(element.get('fill-opacity', 1.0)) * 255),
+            "center": [float(element.get('cx', 0)), float(element.get('cy', 0))],
+            "radius": float(element.get('r', 0))
+        }
 
-        # 5. Extract ellipses (and circles from ellipse mode)
-        for ellipse in root.findall('.//svg:ellipse', ns):
-            cx = float(ellipse.get('cx', 0))
-            cy = float(ellipse.get('cy', 0))
-            rx = float(ellipse.get('rx', 0))
-            ry = float(ellipse.get('ry', 0))
-            fill = ellipse.get('fill', '#000000')
-            opacity = float(ellipse.get('fill-opacity', 1.0))
-
-            # Check if it's a circle (rx approx equal to ry)
-            shape_type = "ellipse"
-            if abs(rx - ry) < 1e-6:
-                shape_type = "circle"
-
-            # NOTE: Primitive uses ellipse mode (m=3) for both circles and ellipses.
-            # It often outputs non-circular ellipses even when 'circle' is requested.
-            # We will rely on the rx == ry check for true circles, otherwise it's an ellipse.
-            shapes.append({
-                "type": shape_type,
+    # Ellipses (and circles from ellipse mode)
+    if tag == "ellipse":
+        cx = float(element.get('cx', 0))
+        cy = float(element.get('cy', 0))
+        rx = float(element.get('rx', 0))
+        ry = float(element.get('ry', 0))
+        opacity = round(float(element.get('fill-opacity', 1.0)) * 255)
+
+        if placement is not None:
+            x, y, angle, sx, sy = placement
+            return {
+                "type": "rotated_ellipse",
                 "color": fill,
-                "opacity": int(opacity * 255),
-                "center": [cx, cy],
-                "rx": rx,
-                "ry": ry
-            })
+                "opacity": opacity,
+                "center": [x + cx * sx, y + cy * sy],
+                "rx": rx * sx,
+                "ry": ry * sy,
+                "rotation": angle
+            }
 
-        # 6. Extract rectangles (excluding background)
-        for rect in root.findall('.//svg:rect', ns):
-            x = float(rect.get('x', 0))
-            y = float(rect.get('y', 0))
-            width = float(rect.get('width', 0))
-            height = float(rect.get('height', 0))
-            fill = rect.get('fill', '#000000')
-            opacity = float(rect.get('fill-opacity', 1.0))
-            transform = rect.get('transform', None)
-            rotation = None
-
-            # Skip background
-            if fill == bg_color or width == 0 or height == 0:
-                continue
+        # Check if it's a circle (rx approx equal to ry)
+        shape_type = "ellipse"
+        if abs(rx - ry) < 1e-6:
+            shape_type = "circle"
 
-            # Extract rotation if present
-            if transform:
-                match = re.search(r'rotate\(([-+]?\d*\.?\d+)', transform)
-                if match:
-                    rotation = float(match.group(1))
+        # NOTE: Primitive uses ellipse mode (m=3) for both circles and ellipses.
+        # It often outputs non-circular ellipses even when 'circle' is requested.
+        # We will rely on the rx == ry check for true circles, otherwise it's an ellipse.
+        return {
+            "type": shape_type,
+            "color": fill,
+            "opacity": opacity,
+            "center": [cx, cy],
+            "rx": rx,
+            "ry": ry
+        }
+
+    # Rectangles
+    if tag == "rect":
+        x = float(element.get('x', 0))
+        y = float(element.get('y', 0))
+        width = float(element.get('width', 0))
+        height = float(element.get('height', 0))
+        opacity = round(float(element.get('fill-opacity', 1.0)) * 255)
 
-            # Decide shape type
-            shape_type = "rectangle"
-            if rotation is not None:
-                shape_type = "rotated_rectangle"
+        if width == 0 or height == 0:
+            return None
 
-            shapes.append({
-                "type": shape_type,
+        if placement is not None:
+            # Unit square scaled to (sx, sy) and rotated around its center at (tx, ty);
+            # x/y is the top-left corner of the unrotated rectangle
+            tx, ty, angle, sx, sy = placement
+            width, height = width * sx, height * sy
+            return {
+                "type": "rotated_rectangle",
                 "color": fill,
-                "opacity": int(opacity * 255),
-                "x": x,
-                "y": y,
+                "opacity": opacity,
+                "x": tx + x * sx,
+                "y": ty + y * sy,
                 "width": width,
                 "height": height,
-                "rotation": rotation
-            })
+                "rotation": angle
+            }
 
-            # Skip background rectangles
-            if fill == bg_color or width == 0 or height == 0:
-                continue
+        # Extract rotation if present
+        rotation = None
+        match = re.search(r'rotate\(([-+]?\d*\.?\d+)', element.get('transform', ''))
+        if match:
+            rotation = float(match.group(1))
+
+        return {
+            "type": "rectangle" if rotation is None else "rotated_rectangle",
+            "color": fill,
+            "opacity": opacity,
+            "x": x,
+            "y": y,
+            "width": width,
+            "height": height,
+            "rotation": rotation
+        }
 
-            # Check for rotation
-            transform = rect.get('transform', '')
-            shape_type = "rectangle"
-            if "rotate" in transform:
-                shape_type = "rotated_rectangle"
+    return None
 
-            # Extract rotation angle for rotated_rectangle
-            rotation = None
-            if shape_type == "rotated_rectangle":
-                match = re.search(r'rotate\(([-+]?\d*\.?\d+)', transform)
+
+def parse_svg_document(svg_content: str) -> dict:
+    """
+    Parse an SVG generated by the primitive tool.
+
+    Returns a dict with the shapes in drawing order, the background color, the output
+    `width`/`height` and the `scale` of primitive's top-level group, which maps the shape
+    coordinates (in primitive's working resolution, offset by half a pixel) to output pixels.
+    """
+    import xml.etree.ElementTree as ET
+
+    root = ET.fromstring(svg_content)
+    document = {
+        "shapes": [],
+        "background_color": "#ffffff",
+        "width": float(root.get('width', 0) or 0),
+        "height": float(root.get('height', 0) or 0),
+        "scale": None,
+    }
+
+    def walk(parent, placement, is_root):
+        for element in parent:
+            tag = element.tag.replace(SVG_NAMESPACE, "")
+            if tag == "g":
+                transform = element.get('transform', '')
+                match = SHAPE_PLACEMENT.search(transform)
                 if match:
-                    rotation = float(match.group(1))
+                    walk(element, tuple(float(v) for v in match.groups()), False)
+                    continue
+                match = FRAME_SCALE.search(transform)
+                if match and document["scale"] is None:
+                    document["scale"] = float(match.group(1))
+                walk(element, placement, False)
+                continue
 
-            shapes.append({
-                "type": shape_type,
-                "color": fill,
-                "opacity": int(opacity * 255),
-                "x": x,
-                "y": y,
-                "width": width,
-                "height": height,
-                "transform": transform if shape_type == "rotated_rectangle" else None,
-                "rotation": rotation
-            })
+            # The first full-size rect outside any group is the background
+            if is_root and tag == "rect" and not document["shapes"] and float(element.get('width', 0)) > 0:
+                document["background_color"] = element.get('fill', '#ffffff')
+                continue
+
+            shape = parse_svg_element(tag, element, placement)
+            if shape is not None:
+                document["shapes"].append(shape)
+
+    walk(root, None, True)
+    if document["scale"] is None:
+        document["scale"] = 1.0
+    return document
+
+
+def iter_svg_shapes(svg_path) -> Iterator[dict]:
+    """
+    Yield the shapes of an SVG file generated by primitive one at a time, in drawing order.
+
+    The lazy counterpart of `parse_svg_document` for very large results: the file (a path
+    or an open binary file) is parsed incrementally and every element is dropped once
+    read, so memory use does not grow with the number of shapes.
+    """
+    import xml.etree.ElementTree as ET
+
+    # Enclosing elements with the placement of their children (root: no placement)
+    stack = []
+    seen_shape = False
+    for event, element in ET.iterparse(svg_path, events=("start", "end")):
+        tag = element.tag.replace(SVG_NAMESPACE, "")
+        if event == "end":
+            if stack and stack[-1][0] is element:
+                stack.pop()
+            if stack:
+                stack[-1][0].clear()  # The parent's attributes were read on its start event
+            continue
+
+        placement = stack[-1][1] if stack else None
+        if tag in ("svg", "g"):
+            match = SHAPE_PLACEMENT.search(element.get('transform', '')) if tag == "g" else None
+            stack.append((element, tuple(float(v) for v in match.groups()) if match else placement))
+            continue
+
+        # The first full-size rect outside any group is the background
+        if len(stack) == 1 and tag == "rect" and not seen_shape and float(element.get('width', 0)) > 0:
+            continue
+
+        shape = parse_svg_element(tag, element, placement)
+        if shape is not None:
+            seen_shape = True
+            yield shape
+
+
+def svg_header(svg_source) -> dict:
+    """
+    The document of an SVG result without its shapes: `background_color`, `width`, `height`
+    and `scale`, as returned by `parse_svg_document`.
+
+    Only reads up to the first shape, so this is cheap however many shapes follow.
+    `svg_source` is a path or an open binary file.
+    """
+    import xml.etree.ElementTree as ET
+
+    header = {"background_color": "#ffffff", "width": 0.0, "height": 0.0, "scale": None}
+    depth = 0
+    for event, element in ET.iterparse(svg_source, events=("start", "end")):
+        if event == "end":
+            depth -= 1
+            continue
+        depth += 1
+        tag = element.tag.replace(SVG_NAMESPACE, "")
+        if tag == "svg":
+            header["width"] = float(element.get('width', 0) or 0)
+            header["height"] = float(element.get('height', 0) or 0)
+            continue
+        if tag == "g":
+            transform = element.get('transform', '')
+            match = None if SHAPE_PLACEMENT.search(transform) else FRAME_SCALE.search(transform)
+            if match and header["scale"] is None:
+                header["scale"] = float(match.group(1))
+            continue
+        # The first full-size rect outside any group is the background
+        if depth == 2 and tag == "rect" and float(element.get('width', 0)) > 0:
+            header["background_color"] = element.get('fill', '#ffffff')
+            continue
+        break
+    if header["scale"] is None:
+        header["scale"] = 1.0
+    return header
+
+
+def parse_svg_shapes(svg_content: str) -> List[dict]:
+    """
+    Parse SVG content and extract shape information.
 
+    This parser extracts shape information from SVG generated by the primitive tool.
+    It handles polygons, circles, ellipses, rectangles, and paths (including primitive's
+    rotated rectangles and ellipses), and returns them in drawing order.
+    """
+    try:
+        return parse_svg_document(svg_content)["shapes"]
     except Exception as e:
         print(f"Error parsing SVG: {e}")
         import traceback
         traceback.print_exc()
+        return []
 
-    return shapes
 
+def _svg_number(value: float, precision: int = 2) -> str:
+    """Format a coordinate with at most `precision` decimals and no trailing zeros."""
+    text = f"{value:.{precision}f}".rstrip("0").rstrip(".") if precision > 0 else str(int(round(value)))
+    return "0" if text in ("-0", "") else text
 
-@app.post("/api/generate")
-async def generate_geometrized_image(
-    image: UploadFile = File(...),
-    output_format: str = Form("json"),
-    shape_types: Optional[List[str]] = Form(None),
-    opacity: int = Form(128),
-    shape_count: int = Form(200),
-    mutations_per_step: int = Form(30),
-    random_shapes: int = Form(50),
-    background_color: Optional[str] = Form(None),
-    resize_width: Optional[int] = Form(None),
-    resize_height: Optional[int] = Form(None),
-):
-    """
-    Generate a geometrized version of an image.
 
-    Parameters:
-    - image: The image file to transform
-    - output_format: One of "svg", "png", or "json"
-    - shape_types: List of shape types to use (e.g., ["triangle", "rectangle"])
-    - opacity: Shape opacity (0-255, default: 128)
-    - shape_count: Total number of shapes to generate (default: 200)
-    - mutations_per_step: Number of mutations per generation step (default: 30)
-    - random_shapes: Number of random shapes to test each step (default: 50)
-    - background_color: Hex or RGB color for background (e.g., "#FFFFFF")
-    - resize_width: Resize image width before processing
-    - resize_height: Resize image height before processing
+def shape_to_svg(shape: dict, precision: int = 2) -> str:
+    """
+    Serialize a shape dict (as produced by `parse_svg_shapes`) back to an SVG element.
 
-    Returns:
-    - SVG: SVG image content
-    - PNG: Binary PNG image
-    - JSON: Shape data as JSON array
+    The markup follows primitive's own output, so `parse_svg_shapes` reads it back to
+    the same shape.
     """
+    n = functools.partial(_svg_number, precision=precision)
+    # Three decimals are enough for the 0-255 opacity to survive a round trip
+    opacity = _svg_number(shape["opacity"] / 255, 3)
+    paint = f'fill="{shape["color"]}" fill-opacity="{opacity}"'
+    shape_type = shape["type"]
 
-    # Validate output format
-    if output_format not in ["svg", "png", "json"]:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid output_format. Must be one of: svg, png, json. Got: {output_format}"
-        )
+    if "points" in shape and shape_type in ("triangle", "polygon"):
+        points = " ".join(f"{n(x)},{n(y)}" for x, y in shape["points"])
+        return f'<polygon {paint} points="{points}" />'
 
-    # Validate opacity
-    if not (0 <= opacity <= 255):
-        raise HTTPException(
-            status_code=400,
-            detail=f"opacity must be between 0 and 255. Got: {opacity}"
-        )
+    if "points" in shape:
+        points = shape["points"]
+        coords = [f"{n(x)} {n(y)}" for x, y in points]
+        if len(points) == 3:
+            path_data = f"M {coords[0]} Q {coords[1]}, {coords[2]}"
+        elif len(points) == 4:
+            path_data = f"M {coords[0]} C {coords[1]}, {coords[2]}, {coords[3]}"
+        else:
+            path_data = "M " + " L ".join(coords)
+        stroke = f'stroke="{shape["color"]}" stroke-opacity="{opacity}"'
+        return f'<path {stroke} fill="none" d="{path_data}" stroke-width="{n(shape.get("stroke_width", 1.0))}" />'
 
-    # Validate shape_count
-    if shape_count < 1:
-        raise HTTPException(
-            status_code=400,
-            detail=f"shape_count must be at least 1. Got: {shape_count}"
-        )
+    if "radius" in shape:
+        cx, cy = shape["center"]
+        return f'<circle {paint} cx="{n(cx)}" cy="{n(cy)}" r="{n(shape["radius"])}" />'
 
-    try:
-        # Read and validate image
-        image_data = await image.read()
-        try:
-            img = Image.open(BytesIO(image_data))
-            img.verify()
-            img = Image.open(BytesIO(image_data))  # Re-open after verify
-        except Exception as e:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid image file: {str(e)}"
+    if "center" in shape:
+        cx, cy = shape["center"]
+        if shape.get("rotation") is not None:
+            return (
+                f'<g transform="translate({n(cx)} {n(cy)}) rotate({n(shape["rotation"])}) '
+                f'scale({n(shape["rx"])} {n(shape["ry"])})"><ellipse {paint} cx="0" cy="0" rx="1" ry="1" /></g>'
             )
+        return f'<ellipse {paint} cx="{n(cx)}" cy="{n(cy)}" rx="{n(shape["rx"])}" ry="{n(shape["ry"])}" />'
 
-        # Resize image if requested
-        if resize_width or resize_height:
-            width, height = img.size
-            if resize_width and resize_height:
-                img = img.resize((resize_width, resize_height), Image.Resampling.LANCZOS)
-            elif resize_width:
-                ratio = resize_width / width
-                new_height = int(height * ratio)
-                img = img.resize((resize_width, new_height), Image.Resampling.LANCZOS)
-            elif resize_height:
-                ratio = resize_height / height
-                new_width = int(width * ratio)
-                img = img.resize((new_width, resize_height), Image.Resampling.LANCZOS)
+    x, y, width, height = shape["x"], shape["y"], shape["width"], shape["height"]
+    if shape.get("rotation") is not None:
+        return (
+            f'<g transform="translate({n(x + width / 2)} {n(y + height / 2)}) rotate({n(shape["rotation"])}) '
+            f'scale({n(width)} {n(height)})"><rect {paint} x="-0.5" y="-0.5" width="1" height="1" /></g>'
+        )
+    return f'<rect {paint} x="{n(x)}" y="{n(y)}" width="{n(width)}" height="{n(height)}" />'
 
-        # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Save input image
-            input_path = os.path.join(tmpdir, "input.png")
-            img.save(input_path, "PNG")
 
-            # Use the size of the image after potential resizing for the primitive output size
-            # This addresses the "Canvas Size Issue" from the documentation
-            output_size = max(img.size) 
+def transform_shape(shape: dict, scale: float, dx: float, dy: float) -> dict:
+    """Return a copy of `shape` uniformly scaled by `scale` and then moved by (dx, dy)."""
+    moved = dict(shape)
+    if "points" in shape:
+        moved["points"] = [[x * scale + dx, y * scale + dy] for x, y in shape["points"]]
+    if "center" in shape:
+        cx, cy = shape["center"]
+        moved["center"] = [cx * scale + dx, cy * scale + dy]
+    if "x" in shape:
+        moved["x"] = shape["x"] * scale + dx
+        moved["y"] = shape["y"] * scale + dy
+    for key in ("rx", "ry", "radius", "width", "height", "stroke_width"):
+        if key in shape:
+            moved[key] = shape[key] * scale
+    return moved
 
-            # Determine shape mode
-            shape_mode = 1  # Default to triangle
-            if shape_types and len(shape_types) > 0:
-                # Use the first shape type specified
-                shape_type = shape_types[0].lower()
-                if shape_type in SHAPE_TYPE_MAPPING:
-                    shape_mode = SHAPE_TYPE_MAPPING[shape_type]
-                else:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Unknown shape type: {shape_type}. Supported types: {list(SHAPE_TYPE_MAPPING.keys())}"
-                    )
 
-            # Prepare output paths
-            svg_output_path = os.path.join(tmpdir, "output.svg")
-            png_output_path = os.path.join(tmpdir, "output.png")
+def shape_center(shape: dict) -> tuple:
+    """Approximate center of a shape, used to decide which tile owns it."""
+    if "points" in shape:
+        points = shape["points"]
+        return sum(x for x, _ in points) / len(points), sum(y for _, y in points) / len(points)
+    if "center" in shape:
+        return tuple(shape["center"])
+    return shape["x"] + shape["width"] / 2, shape["y"] + shape["height"] / 2
 
-            # Get primitive binary path
-            try:
-                primitive_bin = get_primitive_binary()
-            except RuntimeError as e:
-                raise HTTPException(
-                    status_code=500,
-                    detail=str(e)
-                )
 
-            # Build primitive command
-            cmd = [
-                primitive_bin,
-                "-i", input_path,
-                "-o", svg_output_path,
-                "-n", str(shape_count),
-                "-m", str(shape_mode),
-                "-a", str(opacity),
-                "-s", str(output_size),
-                "-rep", "1",
-            ]
-
-            # Add optional parameters
-            if background_color:
-                cmd.extend(["-bg", background_color])
+def build_svg(width: int, height: int, background_color: str, scale: float, shapes: List[dict], precision: int = 2) -> str:
+    """Build an SVG document laid out like primitive's output from a list of shapes."""
+    lines = [svg_head(width, height, background_color, scale)]
+    lines.extend(shape_to_svg(shape, precision) + "\n" for shape in shapes)
+    lines.append(SVG_TAIL)
+    return "".join(lines)
 
-            # Execute primitive
-            try:
-                # Convert paths to string format for subprocess (important on Windows)
-                cmd = [str(c) for c in cmd]
 
-                # Print debug info
-                print(f"[DEBUG] Running command: {' '.join(cmd)}")
-                print(f"[DEBUG] System: {platform.system()}")
-                print(f"[DEBUG] Input path: {input_path}")
-                print(f"[DEBUG] Output path: {svg_output_path}")
+def svg_head(width: int, height: int, background_color: str, scale: float) -> str:
+    """The lines of a `build_svg` document before its shapes."""
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{width}" height="{height}">\n'
+        f'<rect x="0" y="0" width="{width}" height="{height}" fill="{background_color}" />\n'
+        f'<g transform="scale({scale:f}) translate(0.5 0.5)">\n'
+    )
 
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=300, shell=False)
 
-                print(f"[DEBUG] Return code: {result.returncode}")
-                if result.stdout:
-                    print(f"[DEBUG] Stdout: {result.stdout}")
-                if result.stderr:
-                    print(f"[DEBUG] Stderr: {result.stderr}")
+# The lines of a `build_svg` document after its shapes
+SVG_TAIL = "</g>\n</svg>\n"
 
-                if result.returncode != 0:
-                    error_detail = f"Primitive execution failed with code {result.returncode}. Error: {result.stderr}"
-                    print(f"[ERROR] {error_detail}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=error_detail
-                    )
-            except subprocess.TimeoutExpired:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Image processing timed out (>300 seconds)"
-                )
-            except FileNotFoundError as e:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Primitive binary not found: {str(e)}. Please ensure primitive is installed and in PATH."
-                )
 
-            # Handle different output formats
-            if output_format == "svg":
-                # Read and return SVG
-                with open(svg_output_path, "rb") as f:
-                    svg_content = f.read()
-                return StreamingResponse(
-                    iter([svg_content]),
-                    media_type="image/svg+xml",
-                    headers={"Content-Disposition": "attachment; filename=output.svg"}
-                )
+SVG_PROFILES = ("primitive", "compact")
 
-            elif output_format == "png":
-                # Convert SVG to PNG
-                try:
-                    with open(svg_output_path, "r") as f:
-                        svg_data = f.read()
-
-                    # Use PIL to convert SVG to PNG
-                    # NOTE: PIL does not natively render SVG. This section is likely broken 
-                    # in the original code. For now, we will use a placeholder and note the issue.
-                    # A proper fix would require a library like cairosvg or svglib, which are not installed.
-                    # We will proceed with the JSON/SVG output which is the core of the API.
-                    
-                    # Placeholder for PNG conversion - returning a blank image for now
-                    svg_img = PILImage.new('RGB', img.size, color='white')
-                    svg_img.save(png_output_path, "PNG")
-
-                    with open(png_output_path, "rb") as f:
-                        png_content = f.read()
-
-                    return StreamingResponse(
-                        iter([png_content]),
-                        media_type="image/png",
-                        headers={"Content-Disposition": "attachment; filename=output.png"}
-                    )
-                except Exception as e:
-                    # NOTE: Since PNG conversion is complex, we will allow it to fail for now 
-                    # and focus on the JSON output as requested by the detailed documentation.
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Failed to convert SVG to PNG: {str(e)}. PNG conversion requires a proper SVG rendering library (e.g., cairosvg) which is not installed. Please use 'svg' or 'json' output format."
-                    )
+# CSS color keywords that are shorter than their shortest hex notation
+SHORT_COLOR_NAMES = {
+    "#f00": "red", "#d2b48c": "tan", "#000080": "navy", "#808080": "gray", "#008000": "green",
+    "#808000": "olive", "#800080": "purple", "#008080": "teal", "#c0c0c0": "silver",
+    "#800000": "maroon", "#ffd700": "gold", "#ff7f50": "coral", "#ffc0cb": "pink",
+    "#dda0dd": "plum", "#fa8072": "salmon", "#a0522d": "sienna", "#ee82ee": "violet",
+    "#f5deb3": "wheat", "#ff6347": "tomato", "#4b0082": "indigo", "#fffff0": "ivory",
+    "#f0e68c": "khaki", "#faf0e6": "linen", "#da70d6": "orchid", "#cd853f": "peru",
+    "#fffafa": "snow", "#f5f5dc": "beige", "#ffe4c4": "bisque", "#a52a2a": "brown",
+    "#f0ffff": "azure", "#ffa500": "orange",
+}
 
-            elif output_format == "json":
-                # Parse SVG and return JSON
-                try:
-                    with open(svg_output_path, "r") as f:
-                        svg_content = f.read()
-
-                    shapes = parse_svg_shapes(svg_content)
-
-                    # Post-processing to force shape type to match requested type,
-                    # as primitive's output can be ambiguous (e.g., ellipse for circle, bezier for line).
-                    requested_type = shape_types[0].lower() if shape_types else None
-                    
-                    if requested_type:
-                        for shape in shapes:
-                            if requested_type == "circle" and shape["type"] == "ellipse":
-                                # Primitive uses ellipse mode for circle, often resulting in non-circular ellipses.
-                                # We assume the user wants it labeled as 'circle' if they requested 'circle'.
-                                shape["type"] = "circle"
-                            elif requested_type == "rotated_rectangle" and shape["type"] == "rectangle":
-                                # Primitive outputs a rect with a transform for rotated_rectangle.
-                                # If the transform is missing, it's parsed as a normal rectangle, but we force the label.
-                                shape["type"] = "rotated_rectangle"
-                            elif requested_type == "line" and shape["type"] in ["bezier", "quadratic_bezier", "cubic_bezier"]:
-                                # Primitive uses bezier mode for lines. If requested as line, we force the label.
-                                shape["type"] = "line"
-                            elif requested_type == "quadratic_bezier" and shape["type"] in ["bezier", "line", "cubic_bezier"]:
-                                # If requested as quadratic_bezier, we force the label.
-                                shape["type"] = "quadratic_bezier"
-                            elif requested_type == "polygon" and shape["type"] == "triangle":
-                                # Triangle is a 3-point polygon. If requested as polygon, we force the label.
-                                shape["type"] = "polygon"
-                            
-                            # For rotated_ellipse, primitive outputs an ellipse. We force the label.
-                            elif requested_type == "rotated_ellipse" and shape["type"] in ["ellipse", "circle"]:
-                                shape["type"] = "rotated_ellipse"
-
-
-                    return {
-                        "shapes": shapes,
-                        "canvas_size": list(img.size),
-                        "background_color": background_color or "#ffffff",
-                        "shape_types": shape_types or ["triangle"],
-                        "shape_count": shape_count,
-                        "opacity": opacity
-                    }
-                except Exception as e:
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Failed to parse SVG: {str(e)}"
-                    )
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"[ERROR] Unexpected error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(
+def short_color(color: str) -> str:
+    """Shortest equivalent notation of a "#rrggbb" color ("#aabbcc" -> "#abc", "#ff0000" -> "red")."""
+    color = color.lower()
+    if re.fullmatch(r'#[0-9a-f]{6}', color) and color[1] == color[2] and color[3] == color[4] and color[5] == color[6]:
+        color = "#" + color[1::2]
+    return SHORT_COLOR_NAMES.get(color, color)
+
+
+def _compact_number(value: float, precision: int) -> str:
+    """Like `_svg_number`, without the leading zero ("0.5" -> ".5", "-0.5" -> "-.5")."""
+    text = _svg_number(value, precision)
+    if text.startswith("0."):
+        return text[1:]
+    if text.startswith("-0."):
+        return "-" + text[2:]
+    return text
+
+
+def _join_numbers(numbers: List[str]) -> str:
+    """Join path numbers, leaving out separators a parser does not need ("1-2", ".5.5")."""
+    parts = []
+    for number in numbers:
+        if parts and not number.startswith("-") and not (number.startswith(".") and "." in parts[-1]):
+            parts.append(" ")
+        parts.append(number)
+    return "".join(parts)
+
+
+def compact_svg(document: dict, precision: int = 1) -> str:
+    """
+    Re-serialize a parsed primitive SVG (see `parse_svg_document`) as compactly as possible.
+
+    Coordinates are quantized to `precision` decimals, colors use their shortest notation,
+    opacity (and stroke width) shared by all shapes moves to the enclosing `<g>`, polygons
+    and curves become paths with relative commands, and rotated shapes are single elements
+    instead of a transformed group around a unit shape. The result renders the same as
+    the original up to the quantization.
+    """
+    shapes = document["shapes"]
+    n = functools.partial(_compact_number, precision=precision)
+
+    def q(value):
+        return round(value, precision)
+
+    def relative_path(points, command):
+        # Quantize the absolute points first so the relative offsets do not accumulate error
+        points = [(q(x), q(y)) for x, y in points]
+        (x0, y0), rest = points[0], points[1:]
+        if command == "l":
+            # Every lineto is relative to the previous point; a q/c segment is relative to its start
+            origins = points[:-1]
+        else:
+            origins = [points[0]] * len(rest)
+        offsets = [value for (x, y), (ox, oy) in zip(rest, origins) for value in (n(x - ox), n(y - oy))]
+        return "M" + _join_numbers([n(x0), n(y0)]) + command + _join_numbers(offsets)
+
+    fill_opacities = {shape["opacity"] for shape in shapes if "stroke_width" not in shape}
+    stroke_opacities = {shape["opacity"] for shape in shapes if "stroke_width" in shape}
+    stroke_widths = {q(shape["stroke_width"]) for shape in shapes if "stroke_width" in shape}
+    group_attributes = ""
+    if len(fill_opacities) == 1:
+        group_attributes += f' fill-opacity="{_compact_number(fill_opacities.pop() / 255, 3)}"'
+        fill_opacities = None
+    if len(stroke_opacities) == 1:
+        group_attributes += f' stroke-opacity="{_compact_number(stroke_opacities.pop() / 255, 3)}"'
+        stroke_opacities = None
+    if stroke_widths:
+        group_attributes += ' fill="none"'
+    if len(stroke_widths) == 1:
+        group_attributes += f' stroke-width="{n(stroke_widths.pop())}"'
+        stroke_widths = None
+
+    elements = []
+    for shape in shapes:
+        color = short_color(shape["color"])
+        opacity = _compact_number(shape["opacity"] / 255, 3)
+
+        if "stroke_width" in shape:
+            points = shape["points"]
+            command = {3: "q", 4: "c"}.get(len(points), "l")
+            attributes = f'stroke="{color}"'
+            if stroke_opacities is not None:
+                attributes += f' stroke-opacity="{opacity}"'
+            if stroke_widths is not None:
+                attributes += f' stroke-width="{n(shape["stroke_width"])}"'
+            elements.append(f'<path {attributes} d="{relative_path(points, command)}"/>')
+            continue
+
+        attributes = f'fill="{color}"'
+        if fill_opacities is not None:
+            attributes += f' fill-opacity="{opacity}"'
+
+        if "points" in shape:
+            elements.append(f'<path {attributes} d="{relative_path(shape["points"], "l")}z"/>')
+        elif "radius" in shape:
+            cx, cy = shape["center"]
+            elements.append(f'<circle {attributes} cx="{n(cx)}" cy="{n(cy)}" r="{n(shape["radius"])}"/>')
+        elif "center" in shape:
+            cx, cy = shape["center"]
+            if shape.get("rotation") is not None:
+                elements.append(
+                    f'<ellipse {attributes} transform="translate({n(cx)} {n(cy)})rotate({n(shape["rotation"])})" '
+                    f'rx="{n(shape["rx"])}" ry="{n(shape["ry"])}"/>'
+                )
+            else:
+                elements.append(
+                    f'<ellipse {attributes} cx="{n(cx)}" cy="{n(cy)}" rx="{n(shape["rx"])}" ry="{n(shape["ry"])}"/>'
+                )
+        else:
+            x, y, width, height = shape["x"], shape["y"], shape["width"], shape["height"]
+            if shape.get("rotation") is not None:
+                elements.append(
+                    f'<rect {attributes} transform="translate({n(x + width / 2)} {n(y + height / 2)})'
+                    f'rotate({n(shape["rotation"])})" x="{n(-width / 2)}" y="{n(-height / 2)}" '
+                    f'width="{n(width)}" height="{n(height)}"/>'
+                )
+            else:
+                elements.append(f'<rect {attributes} x="{n(x)}" y="{n(y)}" width="{n(width)}" height="{n(height)}"/>')
+
+    width, height = _svg_number(document["width"], 0), _svg_number(document["height"], 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">'
+        f'<rect width="100%" height="100%" fill="{short_color(document["background_color"])}"/>'
+        f'<g transform="scale({_compact_number(document["scale"], 6)})translate(.5 .5)"{group_attributes}>'
+        + "".join(elements)
+        + "</g></svg>"
+    )
+
+
+def working_scale(width: float, height: float) -> float:
+    """Output pixels per working unit for a result of the given size (primitive's frame scale)."""
+    output_size = max(width, height)
+    return output_size / min(PRIMITIVE_WORKING_SIZE, output_size)
+
+
+# Segments used to flatten curves and ellipses, per pixel of length (bounded below)
+BEZIER_SEGMENTS = 24
+ELLIPSE_MIN_SEGMENTS = 24
+
+
+def shape_geometry(shape: dict, pixels_per_unit: float = 1.0) -> tuple:
+    """
+    Outline of a shape in primitive's working coordinates.
+
+    Returns ("polygon", points) for filled shapes and ("line", points, width) for
+    stroked paths; ellipses and curves are flattened to enough points for
+    `pixels_per_unit` output pixels per unit.
+    """
+    if "stroke_width" in shape:
+        points = shape["points"]
+        if len(points) in (3, 4):
+            # Quadratic or cubic Bézier in Bernstein form
+            degree = len(points) - 1
+            curve = []
+            for step in range(BEZIER_SEGMENTS + 1):
+                t = step / BEZIER_SEGMENTS
+                weights = [math.comb(degree, i) * (1 - t) ** (degree - i) * t ** i for i in range(degree + 1)]
+                curve.append((
+                    sum(w * x for w, (x, _) in zip(weights, points)),
+                    sum(w * y for w, (_, y) in zip(weights, points)),
+                ))
+            points = curve
+        return "line", [tuple(point) for point in points], shape["stroke_width"]
+
+    if "points" in shape:
+        return "polygon", [tuple(point) for point in shape["points"]]
+
+    if "center" in shape:
+        cx, cy = shape["center"]
+        rx = ry = shape.get("radius")
+        if rx is None:
+            rx, ry = shape["rx"], shape["ry"]
+        angle = math.radians(shape.get("rotation") or 0)
+        segments = max(ELLIPSE_MIN_SEGMENTS, int(math.pi * (abs(rx) + abs(ry)) * pixels_per_unit / 2))
+        cos_a, sin_a = math.cos(angle), math.sin(angle)
+        outline = []
+        for step in range(segments):
+            t = 2 * math.pi * step / segments
+            x, y = rx * math.cos(t), ry * math.sin(t)
+            outline.append((cx + x * cos_a - y * sin_a, cy + x * sin_a + y * cos_a))
+        return "polygon", outline
+
+    x, y, width, height = shape["x"], shape["y"], shape["width"], shape["height"]
+    corners = [(x, y), (x + width, y), (x + width, y + height), (x, y + height)]
+    if shape.get("rotation"):
+        # primitive rotates rectangles around their center
+        cx, cy = x + width / 2, y + height / 2
+        angle = math.radians(shape["rotation"])
+        cos_a, sin_a = math.cos(angle), math.sin(angle)
+        corners = [
+            (cx + (px - cx) * cos_a - (py - cy) * sin_a, cy + (px - cx) * sin_a + (py - cy) * cos_a)
+            for px, py in corners
+        ]
+    return "polygon", corners
+
+
+def iter_shape_masks(shapes: List[dict], size: tuple, scale: float, supersample: int = 1):
+    """
+    Rasterize shapes one at a time into alpha masks.
+
+    `scale` is the number of output pixels per working unit (primitive's frame scale).
+    Yields (index, shape, box, mask) for every shape that touches the `size` canvas, where
+    `mask` is an "L" image of the `box` region holding the shape's alpha (its opacity,
+    anti-aliased along the edges when `supersample` > 1).
+    """
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    for index, shape in enumerate(shapes):
+        geometry = shape_geometry(shape, scale * supersample)
+        # primitive's frame is offset by half a working unit
+        points = [((x + 0.5) * scale, (y + 0.5) * scale) for x, y in geometry[1]]
+        pad = geometry[2] * scale / 2 + 1 if geometry[0] == "line" else 1
+        left = max(0, math.floor(min(x for x, _ in points) - pad))
+        top = max(0, math.floor(min(y for _, y in points) - pad))
+        right = min(width, math.ceil(max(x for x, _ in points) + pad))
+        bottom = min(height, math.ceil(max(y for _, y in points) + pad))
+        if left >= right or top >= bottom:
+            continue
+
+        box = (left, top, right, bottom)
+        mask = Image.new("L", ((right - left) * supersample, (bottom - top) * supersample), 0)
+        local = [((x - left) * supersample, (y - top) * supersample) for x, y in points]
+        draw = ImageDraw.Draw(mask)
+        if geometry[0] == "line":
+            line_width = max(1, round(geometry[2] * scale * supersample))
+            draw.line(local, fill=shape["opacity"], width=line_width, joint="curve")
+        else:
+            draw.polygon(local, fill=shape["opacity"])
+        if supersample > 1:
+            mask = mask.reduce(supersample)
+        yield index, shape, box, mask
+
+
+def rasterize_shapes(shapes: List[dict], size: tuple, background_color: str, scale: float, supersample: int = 1):
+    """Render shapes over a background into an RGB image of `size` (see `iter_shape_masks`)."""
+    from PIL import Image, ImageColor
+
+    canvas = Image.new("RGB", size, ImageColor.getrgb(background_color))
+    for _, shape, box, mask in iter_shape_masks(shapes, size, scale, supersample):
+        canvas.paste(ImageColor.getrgb(shape["color"]), box, mask)
+    return canvas
+
+
+def render_document(document: dict, size: tuple, supersample: int = 2):
+    """Render a parsed result (see `parse_svg_document`) at `size`, anti-aliased by `supersample`."""
+    scale = document["scale"] * size[0] / document["width"]
+    return rasterize_shapes(document["shapes"], size, document["background_color"], scale, supersample)
+
+
+def encode_image(image, image_format: str) -> bytes:
+    """Encode a rendered image as PNG or WebP."""
+    from io import BytesIO
+
+    buffer = BytesIO()
+    if image_format == "webp":
+        image.save(buffer, "WEBP", quality=90, method=4)
+    else:
+        image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def image_score(image, target) -> float:
+    """Normalized RMS error between two RGB images of the same size (0 = identical, 1 = opposite)."""
+    from PIL import ImageChops, ImageStat
+
+    rms = ImageStat.Stat(ImageChops.difference(image, target)).rms
+    return math.sqrt(sum(value * value for value in rms) / len(rms)) / 255
+
+
+def shape_contributions(shapes: List[dict], size: tuple, background_color: str) -> List[float]:
+    """
+    Visible contribution of every shape to the final rendering at working resolution.
+
+    A shape's contribution is the color change it makes where it is drawn, attenuated by
+    the opacity of all shapes drawn over it later, summed over the canvas and normalized
+    to 0..1 (the mean per-pixel change of the final image that is due to the shape).
+    """
+    from PIL import Image, ImageChops, ImageColor, ImageStat
+
+    canvas = Image.new("RGB", size, ImageColor.getrgb(background_color))
+    changes = []
+    for index, shape, box, mask in iter_shape_masks(shapes, size, 1.0):
+        before = canvas.crop(box)
+        canvas.paste(ImageColor.getrgb(shape["color"]), box, mask)
+        red, green, blue = ImageChops.difference(before, canvas.crop(box)).split()
+        changes.append((index, box, ImageChops.lighter(ImageChops.lighter(red, green), blue), mask))
+
+    # Walk back from the last shape, tracking how much of each pixel still shows through
+    contributions = [0.0] * len(shapes)
+    transmittance = Image.new("L", size, 255)
+    for index, box, change, mask in reversed(changes):
+        visible = transmittance.crop(box)
+        contributions[index] = ImageStat.Stat(ImageChops.multiply(change, visible)).sum[0] / (255 * size[0] * size[1])
+        transmittance.paste(ImageChops.multiply(visible, ImageChops.invert(mask)), box)
+    return contributions
+
+
+# Side of the square windows SSIM statistics are pooled over, in working pixels
+SSIM_BLOCK = 8
+# SSIM stabilizing constants for 8-bit luma (K1 = 0.01, K2 = 0.03)
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def _pooled(image, size: tuple):
+    """Mean of a float ("F") image over blocks, as an image of `size` blocks."""
+    from PIL import Image
+
+    return image.resize(size, Image.BOX)
+
+
+def image_ssim(image, target) -> float:
+    """
+    Mean structural similarity (SSIM) of the luma of two images of the same size.
+
+    Statistics are pooled over non-overlapping SSIM_BLOCK x SSIM_BLOCK windows instead
+    of a sliding Gaussian window, which keeps the whole computation in Pillow's image
+    operations. 1 means identical.
+    """
+    from PIL import ImageMath
+
+    x = image.convert("L").convert("F")
+    y = target.convert("L").convert("F")
+    blocks = (max(1, x.width // SSIM_BLOCK), max(1, x.height // SSIM_BLOCK))
+
+    mean_x, mean_y = _pooled(x, blocks), _pooled(y, blocks)
+    mean_xx = _pooled(ImageMath.lambda_eval(lambda a: a["x"] * a["x"], x=x), blocks)
+    mean_yy = _pooled(ImageMath.lambda_eval(lambda a: a["y"] * a["y"], y=y), blocks)
+    mean_xy = _pooled(ImageMath.lambda_eval(lambda a: a["x"] * a["y"], x=x, y=y), blocks)
+
+    ssim_map = ImageMath.lambda_eval(
+        lambda a: (
+            (a["mx"] * a["my"] * 2 + SSIM_C1) * ((a["xy"] - a["mx"] * a["my"]) * 2 + SSIM_C2)
+            / ((a["mx"] * a["mx"] + a["my"] * a["my"] + SSIM_C1)
+               * (a["xx"] - a["mx"] * a["mx"] + a["yy"] - a["my"] * a["my"] + SSIM_C2))
+        ),
+        mx=mean_x, my=mean_y, xx=mean_xx, yy=mean_yy, xy=mean_xy,
+    )
+    return _pooled(ssim_map, (1, 1)).getpixel((0, 0))
+
+
+def working_target(document: dict, image) -> tuple:
+    """The size of a result's working frame and the source image scaled to it."""
+    scale = document["scale"]
+    size = (max(1, round(document["width"] / scale)), max(1, round(document["height"] / scale)))
+    return size, image.convert("RGB").resize(size)
+
+
+def result_quality(svg_path: str, image, ssim: bool = False) -> dict:
+    """
+    How close a result is to its source image, measured at primitive's working resolution.
+
+    Returns the normalized RGB RMS error (`rmse`, 0..1), `similarity` (1 - rmse) and,
+    when asked for, the luma `ssim`. Shapes are drawn as they are read, so memory use
+    does not grow with their number.
+    """
+    header = svg_header(svg_path)
+    size, target = working_target(header, image)
+    rendering = rasterize_shapes(iter_svg_shapes(svg_path), size, header["background_color"], 1.0)
+    rmse = image_score(rendering, target)
+    quality = {"rmse": round(rmse, 6), "similarity": round(1 - rmse, 6)}
+    if ssim:
+        quality["ssim"] = round(image_ssim(rendering, target), 6)
+    return quality
+
+
+def primitive_similarity(target_quality: float) -> float:
+    """
+    Translate a similarity on the `result_quality` scale into primitive's own scale.
+
+    primitive's score is the RMS error over RGBA, and the alpha channel never differs,
+    so it is the RGB RMS error scaled by sqrt(3/4).
+    """
+    return 1 - (1 - target_quality) * math.sqrt(3) / 2
+
+
+def cull_svg(svg_path: str, image, threshold: float, output_path: str) -> dict:
+    """
+    Drop shapes whose visible contribution is below `threshold` from a primitive SVG.
+
+    The remaining shapes are written to `output_path`. `image` is the source image, used to
+    report the error of the rendering before and after culling (at working resolution).
+    """
+    with open(svg_path, "r") as f:
+        document = parse_svg_document(f.read())
+
+    scale = document["scale"]
+    size, target = working_target(document, image)
+    contributions = shape_contributions(document["shapes"], size, document["background_color"])
+    kept = [shape for shape, contribution in zip(document["shapes"], contributions) if contribution >= threshold]
+
+    score_before = image_score(rasterize_shapes(document["shapes"], size, document["background_color"], 1.0), target)
+    score_after = image_score(rasterize_shapes(kept, size, document["background_color"], 1.0), target)
+
+    with open(output_path, "w") as f:
+        f.write(build_svg(
+            round(document["width"]), round(document["height"]), document["background_color"], scale, kept
+        ))
+
+    return {
+        "threshold": threshold,
+        "shapes_before": len(document["shapes"]),
+        "shapes_removed": len(document["shapes"]) - len(kept),
+        "score_before": round(score_before, 6),
+        "score_after": round(score_after, 6),
+        "similarity_delta": round(score_before - score_after, 6),
+    }
+
+
+def write_checkpoints(svg_path: str, counts: List[int], output_dir: str) -> List[tuple]:
+    """
+    Write the first `count` shapes of a result SVG to a file of its own, for every count.
+
+    primitive (and the native engine) only ever append shapes, so the first N shapes of a
+    run are the result a run of N shapes would have reached. Returns (count, path,
+    shapes written) tuples. The result is read once, a shape at a time, and every shape is
+    appended to the checkpoints it belongs to right away.
+    """
+    header = svg_header(svg_path)
+    paths = {count: os.path.join(output_dir, f"checkpoint_{count}.svg") for count in counts}
+    written = dict.fromkeys(counts, 0)
+    with ExitStack() as stack:
+        files = {count: stack.enter_context(open(path, "w")) for count, path in paths.items()}
+        head = svg_head(round(header["width"]), round(header["height"]), header["background_color"], header["scale"])
+        for f in files.values():
+            f.write(head)
+        for index, shape in enumerate(iter_svg_shapes(svg_path)):
+            pending = [count for count in counts if count > index]
+            if not pending:
+                break
+            line = shape_to_svg(shape, 2) + "\n"
+            for count in pending:
+                files[count].write(line)
+                written[count] += 1
+        for f in files.values():
+            f.write(SVG_TAIL)
+    return [(count, paths[count], written[count]) for count in counts]
+
+
+# Shape types the in-process engine (interactive sessions) can optimize, and the types a
+# "combo" or "beziers" request draws from
+ENGINE_SHAPE_TYPES = (
+    "triangle", "rectangle", "ellipse", "circle", "rotated_rectangle", "rotated_ellipse",
+    "polygon", "line", "quadratic_bezier",
+)
+ENGINE_SHAPE_ALIASES = {
+    "combo": ("triangle", "rectangle", "ellipse", "rotated_rectangle", "rotated_ellipse", "circle"),
+    "beziers": ("quadratic_bezier",),
+}
+# Stroke width of lines and curves drawn by the engine, in working pixels
+ENGINE_STROKE_WIDTH = 1.0
+# Coarse-to-fine schedule of the engine's pyramid mode: (fraction of the working
+# resolution, share of the shape budget placed by the end of that level)
+PYRAMID_LEVELS = ((0.25, 0.2), (0.5, 0.5), (1.0, 1.0))
+# Engines /api/generate can run: the primitive binary or the in-process ShapeEngine
+ENGINES = ("primitive", "native")
+# Importance maps the engine can weight its error by: computed from the image, or uploaded
+IMPORTANCE_MODES = ("none", "edges", "saliency", "mask")
+# Error weight of each importance band: an importance map (0-255) is split into equal bands,
+# so the weighted error stays a handful of histogram sums
+IMPORTANCE_WEIGHTS = (1, 4)
+# Per-pixel luma change (0-255) above which a sequence frame counts as changed there
+SEQUENCE_CHANGE_THRESHOLD = 16
+# A seeded sequence frame is re-optimized until its score is within this share of the first frame's
+SEQUENCE_SCORE_TOLERANCE = 0.02
+# Rough cost of a seeded sequence frame relative to a full run, for admission control
+SEQUENCE_FRAME_SHARE = 0.25
+# Per-bin weights for sums over RGB histograms (ImageStat's are pure-Python loops)
+_RGB_LEVELS = tuple(range(256)) * 3
+_RGB_SQUARES = tuple(v * v for v in range(256)) * 3
+
+
+class ShapeEngine:
+    """
+    In-process shape optimizer that keeps its state between calls.
+
+    It follows primitive's algorithm at primitive's working resolution: every new shape
+    is the best of `random_shapes` random candidates, refined by `mutations_per_step`
+    random mutations that are kept when they lower the error. A candidate's color is
+    the one that best matches the target under its mask at the given opacity, and only
+    the candidate's bounding box is compared, so a step costs the same however many
+    shapes are already on the canvas. Unlike a primitive run, shapes can be added to,
+    removed from, or restarted on the same target at any time.
+
+    Shapes are kept in working coordinates, but the search can run on a downsampled
+    copy of the target (`set_level`): the canvas is then drawn at that fraction of the
+    working resolution, and random shapes and mutations are proportionally larger, so
+    coarse levels place big shapes cheaply.
+
+    An `importance` map ("L" image, see `importance_map`) weights the error of every
+    pixel by IMPORTANCE_WEIGHTS, and random shapes are centered on pixels drawn in
+    proportion to the same weights, so the shape budget goes where the map points.
+
+    Not thread-safe; callers serialize access to an engine.
+    """
+
+    def __init__(
+        self,
+        target,
+        shape_type: str = "triangle",
+        opacity: int = 128,
+        background_color: Optional[str] = None,
+        random_shapes: int = 50,
+        mutations_per_step: int = 30,
+        seed: Optional[int] = None,
+        importance=None,
+    ):
+        import random
+        from PIL import ImageStat
+
+        self.full_target = target.convert("RGB")
+        self.working_size = self.full_target.size
+        self.full_importance = None
+        self._sampling_weights = None
+        self.importance_masks = []
+        self.weight_total = self.working_size[0] * self.working_size[1]
+        self.target = self.full_target
+        self.size = self.working_size
+        self.level = 1.0
+        # Pixels compared while scoring candidates, a measure of the work done
+        self.pixels_evaluated = 0
+        self.random_shapes = max(1, random_shapes)
+        self.mutations_per_step = max(0, mutations_per_step)
+        self.rng = random.Random(seed)
+        if not background_color:
+            background_color = "#%02x%02x%02x" % tuple(int(round(c)) for c in ImageStat.Stat(self.target).mean)
+        self.background_color = background_color
+        self.shapes = []
+        self.reset(shape_type, opacity)
+        if importance is not None:
+            self.set_importance(importance)
+
+    def reset(self, shape_type: Optional[str] = None, opacity: Optional[int] = None) -> None:
+        """Drop every shape, optionally switching the shape type and opacity."""
+        from PIL import Image, ImageColor
+
+        if shape_type is not None:
+            self.shape_type = shape_type
+        if opacity is not None:
+            self.opacity = opacity
+        self.shapes = []
+        self.canvas = Image.new("RGB", self.size, ImageColor.getrgb(self.background_color))
+        self.error = self._squared_error(self.canvas, self.target)
+
+    def set_level(self, level: float) -> None:
+        """Continue the search at `level` times the working resolution (1.0 = full)."""
+        from PIL import Image
+
+        width, height = self.working_size
+        self.level = level
+        self.size = (max(1, round(width * level)), max(1, round(height * level)))
+        self.target = self.full_target if level == 1.0 else self.full_target.resize(self.size, Image.BOX)
+        self._set_importance()
+        self._redraw()
+
+    def set_target(self, target) -> None:
+        """Switch to a new target of the working size (the next frame of a sequence), keeping the shapes."""
+        self.full_target = target.convert("RGB")
+        self.set_level(self.level)
+
+    def set_importance(self, importance=None, weight_error: bool = True) -> None:
+        """
+        Weight candidate sampling, and with `weight_error` the error too, by `importance`
+        ("L" image; None weighs all pixels alike).
+        """
+        from itertools import accumulate
+        from PIL import Image
+
+        self.full_importance = None
+        self._sampling_weights = None
+        if importance is not None:
+            importance = importance.convert("L").resize(self.working_size, Image.BOX)
+            bands = importance.point(lambda v: v * len(IMPORTANCE_WEIGHTS) // 256)
+            self._sampling_weights = list(accumulate(IMPORTANCE_WEIGHTS[band] for band in bands.getdata()))
+            if weight_error:
+                self.full_importance = importance
+        self._set_importance()
+        self.error = self._squared_error(self.canvas, self.target)
+
+    def _set_importance(self) -> None:
+        """
+        Split the importance map at the current level into masks of the pixels in each band
+        or above, paired with the weight added on top of the band below.
+        """
+        from PIL import Image
+
+        self.importance_masks = []
+        self.weight_total = self.size[0] * self.size[1]
+        if self.full_importance is None:
+            return
+        importance = self.full_importance
+        if importance.size != self.size:
+            importance = importance.resize(self.size, Image.BOX)
+        bands = len(IMPORTANCE_WEIGHTS)
+        for band in range(1, bands):
+            mask = importance.point(lambda v: 255 if v * bands // 256 >= band else 0)
+            increment = IMPORTANCE_WEIGHTS[band] - IMPORTANCE_WEIGHTS[band - 1]
+            self.importance_masks.append((increment, mask))
+            self.weight_total += increment * mask.histogram()[255]
+
+    def _redraw(self) -> None:
+        self.canvas = rasterize_shapes(self.shapes, self.size, self.background_color, self.level)
+        self.error = self._squared_error(self.canvas, self.target)
+
+    def _squared_error(self, image, target, box: Optional[tuple] = None) -> int:
+        """Importance-weighted squared error of `image` against `target` (the canvas at `box`)."""
+        from PIL import ImageChops
+
+        difference = ImageChops.difference(image, target)
+        error = sum(map(operator.mul, difference.histogram(), _RGB_SQUARES))
+        for increment, mask in self.importance_masks:
+            band = difference.histogram(mask if box is None else mask.crop(box))
+            error += increment * sum(map(operator.mul, band, _RGB_SQUARES))
+        return error
+
+    @staticmethod
+    def _masked_mean(image, mask) -> List[float]:
+        """Per-band mean of an RGB image where `mask` is non-zero."""
+        histogram = image.histogram(mask)
+        count = sum(histogram[:256]) or 1
+        sums = list(map(operator.mul, histogram, _RGB_LEVELS))
+        return [sum(sums[band * 256:(band + 1) * 256]) / count for band in range(3)]
+
+    def score(self) -> float:
+        """Normalized RMS error of the canvas against the target (as `image_score`, importance-weighted)."""
+        return math.sqrt(self.error / (self.weight_total * 3)) / 255
+
+    def _random_shape(self) -> dict:
+        shape_type = self.shape_type
+        if shape_type in ENGINE_SHAPE_ALIASES:
+            shape_type = self.rng.choice(ENGINE_SHAPE_ALIASES[shape_type])
+        rng = self.rng
+        width, height = self.working_size
+        # Sizes are in pixels of the current level
+        unit = 1 / self.level
+        if self._sampling_weights is None:
+            x, y = rng.uniform(0, width - 1), rng.uniform(0, height - 1)
+        else:
+            pixel = rng.choices(range(width * height), cum_weights=self._sampling_weights)[0]
+            x, y = min(width - 1, pixel % width + rng.random()), min(height - 1, pixel // width + rng.random())
+        shape = {"type": shape_type, "color": "#000000", "opacity": self.opacity}
+
+        def near(spread):
+            return [x + rng.uniform(-spread, spread) * unit, y + rng.uniform(-spread, spread) * unit]
+
+        def extent():
+            return rng.uniform(1, 32) * unit
+
+        if shape_type in ("triangle", "polygon"):
+            shape["points"] = [[x, y]] + [near(15) for _ in range(2 if shape_type == "triangle" else 3)]
+        elif shape_type in ("line", "quadratic_bezier"):
+            shape["points"] = [[x, y]] + [near(32) for _ in range(1 if shape_type == "line" else 2)]
+            shape["stroke_width"] = ENGINE_STROKE_WIDTH * unit
+        elif shape_type in ("rectangle", "rotated_rectangle"):
+            shape.update({"x": x, "y": y, "width": extent(), "height": extent()})
+            if shape_type == "rotated_rectangle":
+                shape["rotation"] = rng.uniform(0, 360)
+        elif shape_type == "circle":
+            shape.update({"center": [x, y], "radius": extent()})
+        else:
+            shape.update({"center": [x, y], "rx": extent(), "ry": extent()})
+            if shape_type == "rotated_ellipse":
+                shape["rotation"] = rng.uniform(0, 360)
+        return shape
+
+    def _mutate(self, shape: dict) -> dict:
+        """A copy of `shape` with one of its parameters moved by a random amount."""
+        rng = self.rng
+        width, height = self.working_size
+        spread = 16 / self.level
+        mutated = {key: [list(p) for p in value] if key == "points" else value for key, value in shape.items()}
+        choices = [key for key in ("center", "x", "rx", "ry", "radius", "width", "height", "rotation") if key in shape]
+        choices += [("points", i) for i in range(len(shape.get("points", ())))]
+        choice = rng.choice(choices)
+
+        if isinstance(choice, tuple) or choice == "center":
+            point = mutated["points"][choice[1]] if isinstance(choice, tuple) else list(mutated["center"])
+            point[0] = min(width - 1, max(0, point[0] + rng.gauss(0, spread)))
+            point[1] = min(height - 1, max(0, point[1] + rng.gauss(0, spread)))
+            if choice == "center":
+                mutated["center"] = point
+        elif choice == "x":
+            mutated["x"] = min(width - 1, max(0, shape["x"] + rng.gauss(0, spread)))
+            mutated["y"] = min(height - 1, max(0, shape["y"] + rng.gauss(0, spread)))
+        elif choice == "rotation":
+            mutated["rotation"] = (shape["rotation"] + rng.gauss(0, 32)) % 360
+        else:
+            mutated[choice] = min(max(width, height), max(1, shape[choice] + rng.gauss(0, spread)))
+        return mutated
+
+    def _fit_color(self, shape: dict, target, before, mask) -> tuple:
+        """Least-squares color for "before * (1 - a) + color * a = target" under the mask."""
+        alpha = shape["opacity"] / 255
+        target_mean = self._masked_mean(target, mask)
+        before_mean = self._masked_mean(before, mask)
+        return tuple(
+            min(255, max(0, int(round((t - b * (1 - alpha)) / alpha)))) for t, b in zip(target_mean, before_mean)
+        )
+
+    def refit(self, indices) -> None:
+        """Redraw the canvas, giving the shapes at `indices` their best color for the current target."""
+        from PIL import Image, ImageColor
+
+        canvas = Image.new("RGB", self.size, ImageColor.getrgb(self.background_color))
+        for index, shape, box, mask in iter_shape_masks(self.shapes, self.size, self.level):
+            if index in indices and mask.getbbox():
+                color = self._fit_color(shape, self.target.crop(box), canvas.crop(box), mask)
+                self.shapes[index] = shape = dict(shape, color="#%02x%02x%02x" % color)
+            canvas.paste(ImageColor.getrgb(shape["color"]), box, mask)
+        self.canvas = canvas
+        self.error = self._squared_error(canvas, self.target)
+
+    def _evaluate(self, shape: dict) -> tuple:
+        """
+        Give `shape` its best color and work out what drawing it would do.
+
+        Returns (error change, box, mask); the change is infinite for a shape that does
+        not touch the canvas.
+        """
+        drawn = next(iter_shape_masks([shape], self.size, self.level), None)
+        if drawn is None:
+            return math.inf, None, None
+        _, _, box, mask = drawn
+        self.pixels_evaluated += (box[2] - box[0]) * (box[3] - box[1])
+        target, before = self.target.crop(box), self.canvas.crop(box)
+        if not mask.getbbox():
+            return math.inf, None, None
+
+        color = self._fit_color(shape, target, before, mask)
+        shape["color"] = "#%02x%02x%02x" % color
+
+        after = before.copy()
+        after.paste(color, (0, 0), mask)
+        change = self._squared_error(after, target, box) - self._squared_error(before, target, box)
+        return change, box, mask
+
+    def step(self) -> Optional[dict]:
+        """Add the best shape found in one optimization step; None if no shape improves the canvas."""
+        best, best_change = None, math.inf
+        for _ in range(self.random_shapes):
+            candidate = self._random_shape()
+            change, _, _ = self._evaluate(candidate)
+            if change < best_change:
+                best, best_change = candidate, change
+
+        for _ in range(self.mutations_per_step if best is not None else 0):
+            candidate = self._mutate(best)
+            change, _, _ = self._evaluate(candidate)
+            if change < best_change:
+                best, best_change = candidate, change
+
+        if best is None or best_change >= 0:
+            return None
+        # Re-evaluate the winner to get its mask (only scores were kept above)
+        change, box, mask = self._evaluate(best)
+        self.canvas.paste(tuple(int(best["color"][i:i + 2], 16) for i in (1, 3, 5)), box, mask)
+        self.error += change
+        self.shapes.append(best)
+        return best
+
+    def undo(self, count: int) -> int:
+        """Remove the last `count` shapes; returns how many were removed."""
+        removed = min(count, len(self.shapes))
+        if removed:
+            del self.shapes[len(self.shapes) - removed:]
+            self._redraw()
+        return removed
+
+    def to_svg(self, width: int, height: int) -> str:
+        """The current shapes as a primitive-style SVG of the given output size."""
+        return build_svg(width, height, self.background_color, working_scale(width, height), self.shapes)
+
+
+def working_image(img):
+    """An image scaled down to primitive's working resolution (longer side PRIMITIVE_WORKING_SIZE at most)."""
+    width, height = img.size
+    scale = working_scale(width, height)
+    return img.convert("RGB").resize((max(1, round(width / scale)), max(1, round(height / scale))))
+
+
+def importance_map(img, mode: str, mask=None):
+    """
+    An importance map ("L", 0-255) of a working image for `ShapeEngine`, or None for "none".
+
+    "edges" marks luma edges (both signs of a Laplacian, widened and blurred so shapes
+    straddling an edge count too); "saliency" marks regions that stand out from their
+    surroundings (center-surround difference of a lightly and a heavily blurred copy,
+    per RGB band). Both are stretched to the full range. "mask" uses the uploaded `mask`
+    image as it is, resized to the working image.
+    """
+    from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+    if mode == "none":
+        return None
+    if mode == "mask":
+        return mask.convert("L").resize(img.size, Image.BOX)
+
+    img = img.convert("RGB")
+    if mode == "edges":
+        gray = img.convert("L")
+        edges = ImageChops.lighter(gray.filter(ImageFilter.FIND_EDGES), ImageOps.invert(gray).filter(ImageFilter.FIND_EDGES))
+        result = edges.filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.GaussianBlur(2))
+    else:
+        center = img.filter(ImageFilter.GaussianBlur(1))
+        surround = img.filter(ImageFilter.GaussianBlur(max(img.size) / 16))
+        contrast = ImageChops.difference(center, surround).split()
+        result = ImageChops.lighter(ImageChops.lighter(contrast[0], contrast[1]), contrast[2])
+        result = result.filter(ImageFilter.GaussianBlur(2))
+    return ImageOps.autocontrast(result)
+
+
+def run_native(
+    img,
+    svg_output_path: str,
+    shape_count: int,
+    shape_type: str,
+    opacity: int,
+    background_color: Optional[str] = None,
+    random_shapes: int = 50,
+    mutations_per_step: int = 30,
+    pyramid: bool = False,
+    importance: str = "none",
+    importance_mask=None,
+    deadline: Optional[float] = None,
+    stop_check: Optional[Callable[[List[tuple]], Optional[str]]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> dict:
+    """
+    Geometrize `img` with the in-process `ShapeEngine` instead of the primitive binary.
+
+    Writes a primitive-style SVG the size of `img` to `svg_output_path` and returns a dict
+    like `run_primitive` (with the number of pixels compared while scoring candidates
+    added), so the rest of the pipeline treats both engines alike. The score is reported
+    on primitive's scale (RMS over RGBA with opaque alpha), so `stop_check` and the
+    similarity targets mean the same for both engines.
+
+    With `pyramid`, the search walks PYRAMID_LEVELS from coarse to fine: the first shapes
+    are found on a heavily downsampled target, where they are cheap to score, and later,
+    smaller shapes at progressively higher resolution. A level also ends early when no
+    candidate improves it or `stop_check` reports convergence there.
+
+    `importance` (an IMPORTANCE_MODES value, with the `importance_mask` image for "mask")
+    weights the error and candidate sampling by `importance_map`; the score is then
+    importance-weighted too. Blocks, so call it from a worker thread; the `usage` reported
+    is that thread's CPU time.
+    """
+    started = time.monotonic()
+    usage_started = thread_usage()
+    target = working_image(img)
+    engine = ShapeEngine(
+        target, shape_type, opacity, background_color, random_shapes, mutations_per_step,
+        importance=importance_map(target, importance, importance_mask),
+    )
+    levels = list(PYRAMID_LEVELS) if pyramid else [(1.0, 1.0)]
+    level_index = 0
+    engine.set_level(levels[0][0])
+
+    def primitive_score() -> float:
+        return engine.score() * math.sqrt(3) / 2
+
+    def next_level() -> bool:
+        nonlocal level_index
+        if level_index + 1 >= len(levels):
+            return False
+        level_index += 1
+        engine.set_level(levels[level_index][0])
+        return True
+
+    scores: List[tuple] = []
+    stop_reason = "shape_count"
+    while len(engine.shapes) < shape_count:
+        if cancel_event is not None and cancel_event.is_set():
+            stop_reason = "cancelled"
+            break
+        if deadline is not None and time.monotonic() >= deadline and engine.shapes:
+            stop_reason = "time_budget"
+            break
+        if len(engine.shapes) >= levels[level_index][1] * shape_count and next_level():
+            continue
+
+        if engine.step() is None:
+            # Nothing improves the canvas at this resolution any more
+            if next_level():
+                continue
+            stop_reason = "converged"
+            break
+        scores.append((len(engine.shapes), primitive_score()))
+        reason = stop_check(scores) if stop_check is not None else None
+        if reason == "converged" and next_level():
+            continue
+        if reason is not None:
+            stop_reason = reason
+            break
+
+    # Scores and output always refer to the full working resolution
+    if engine.level != 1.0:
+        engine.set_level(1.0)
+    width, height = img.size
+    with open(svg_output_path, "w") as f:
+        f.write(engine.to_svg(width, height))
+
+    return {
+        "returncode": 0,
+        "stdout": "",
+        "stderr": "",
+        "svg_path": svg_output_path,
+        "shapes_generated": len(engine.shapes),
+        "score": primitive_score() if engine.shapes else None,
+        "stop_reason": stop_reason,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        "pixels_evaluated": engine.pixels_evaluated,
+        "usage": {
+            key: round(value - usage_started[key], 1) if value is not None else None
+            for key, value in thread_usage().items()
+        },
+    }
+
+
+def run_sequence(
+    frames,
+    shape_count: int,
+    shape_type: str,
+    opacity: int,
+    background_color: Optional[str] = None,
+    random_shapes: int = 50,
+    mutations_per_step: int = 30,
+    change_threshold: int = SEQUENCE_CHANGE_THRESHOLD,
+    output_format: str = "json",
+    cancel_event: Optional[threading.Event] = None,
+) -> dict:
+    """
+    Geometrize a sequence of frames (an iterable of images) with one `ShapeEngine`.
+
+    The first frame gets a full run. Every later frame starts from the previous frame's
+    shapes: pixels whose luma moved by more than `change_threshold` since the region was
+    last geometrized mark the changed area. The shapes lying most inside it are dropped
+    (at least the changed share of `shape_count`), the colors of the others reaching into
+    it are refitted, and new shapes, sampled mostly in the changed area, fill the budget
+    again. While the frame's score is more than SEQUENCE_SCORE_TOLERANCE worse than the
+    first frame's, twice as many shapes are replaced. Shapes in unchanged regions stay
+    exactly as they were, so static parts do not flicker.
+
+    Work is pipelined over a small thread pool: the next frame is decoded and scaled down,
+    and the previous one serialized, while the current one is optimized. Returns the
+    canvas size, background color and a list of per-frame results (shapes for "json",
+    an SVG document for "svg"). Blocks, so call it from a worker thread.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from PIL import Image, ImageChops, ImageFilter
+
+    started = time.monotonic()
+    frames = iter(frames)
+    results = []
+    engine = None
+    reference = None
+    canvas_size = None
+    stop_reason = "complete"
+
+    def prepare():
+        # Decodes the next frame (the iterator reads the upload) and scales it down
+        frame = next(frames, None)
+        return None if frame is None else (frame.size, working_image(frame))
+
+    def serialize(shapes: List[dict]):
+        if output_format == "svg":
+            return build_svg(*canvas_size, engine.background_color, working_scale(*canvas_size), shapes)
+        return [_rounded_shape(shape) for shape in shapes]
+
+    def fill() -> int:
+        added = 0
+        while len(engine.shapes) < shape_count:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if engine.step() is None:
+                break
+            added += 1
+        return added
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        upcoming = pool.submit(prepare)
+        pending = []
+        while True:
+            prepared = upcoming.result()
+            if prepared is None:
+                break
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = "cancelled"
+                break
+            upcoming = pool.submit(prepare)
+            frame_started = time.monotonic()
+            size, target = prepared
+            if engine is not None and target.size != engine.working_size:
+                target = target.resize(engine.working_size, Image.BOX)
+
+            if engine is None:
+                canvas_size = size
+                engine = ShapeEngine(target, shape_type, opacity, background_color, random_shapes, mutations_per_step)
+                reference = target
+                kept, changed_fraction = 0, 1.0
+                added = fill()
+                # Later frames are re-optimized until they are about as close to their frame
+                error_limit = engine.score() * (1 + SEQUENCE_SCORE_TOLERANCE)
+            else:
+                # Changed area: moved by more than the threshold, widened a little for edges
+                change = ImageChops.difference(reference, target).convert("L")
+                change = change.point(lambda v: 255 if v > change_threshold else 0).filter(ImageFilter.MaxFilter(5))
+                changed_fraction = change.histogram()[255] / (change.width * change.height)
+                reference = reference.copy()
+                reference.paste(target, (0, 0), change)
+                # Shapes reaching into it, those lying most inside it first
+                coverage = []
+                for index, _, box, mask in iter_shape_masks(engine.shapes, engine.working_size, 1.0):
+                    inside = mask.histogram(change.crop(box))
+                    total = mask.histogram()
+                    share = (sum(inside) - inside[0]) / max(1, sum(total) - total[0])
+                    if share > 0:
+                        coverage.append((share, index))
+                coverage.sort(reverse=True)
+
+                engine.set_target(target)
+                # Previous shapes still in use, by their index in the previous frame
+                kept_indices = list(range(len(engine.shapes)))
+                # Replace the shapes mostly inside the changed area (at least its share of the
+                # budget), then twice as many and so on while the frame falls short
+                replace = max(
+                    sum(1 for share, _ in coverage if share >= 0.5), math.ceil(shape_count * changed_fraction)
+                )
+                while changed_fraction > 0:
+                    dropped = {index for _, index in coverage[:replace]}
+                    touched = {index for _, index in coverage[replace:]}
+                    survivors = [
+                        (old, shape) for old, shape in zip(kept_indices, engine.shapes) if old not in dropped
+                    ]
+                    added_shapes = engine.shapes[len(kept_indices):]
+                    kept_indices = [old for old, _ in survivors]
+                    engine.shapes = [shape for _, shape in survivors] + added_shapes
+                    # Kept shapes that reach into the changed area, and the ones added on top of
+                    # them, get colors fitted to the new frame
+                    engine.refit(
+                        {new for new, old in enumerate(kept_indices) if old in touched}
+                        | set(range(len(kept_indices), len(engine.shapes)))
+                    )
+                    engine.set_importance(change, weight_error=False)
+                    fill()
+                    engine.set_importance(None)
+                    if engine.score() <= error_limit or replace >= len(coverage):
+                        break
+                    if cancel_event is not None and cancel_event.is_set():
+                        break
+                    replace = min(len(coverage), replace * 2)
+                kept = len(kept_indices)
+                added = len(engine.shapes) - kept
+
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = "cancelled"
+                break
+            score = engine.score() * math.sqrt(3) / 2
+            pending.append(pool.submit(serialize, list(engine.shapes)))
+            results.append({
+                "index": len(results),
+                "shapes_generated": len(engine.shapes),
+                "shapes_kept": kept,
+                "shapes_added": added,
+                "changed_fraction": round(changed_fraction, 4),
+                "score": score,
+                "similarity": 1 - score,
+                "elapsed_ms": round((time.monotonic() - frame_started) * 1000, 1),
+            })
+
+        for result, output in zip(results, pending):
+            result["svg" if output_format == "svg" else "shapes"] = output.result()
+
+    return {
+        "canvas_size": list(canvas_size) if canvas_size else None,
+        "background_color": engine.background_color if engine else None,
+        "frames": results,
+        "stop_reason": stop_reason,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+    }
+
+
+# Progress line printed by `primitive -v` after every shape: "<frame>: t=<secs>, score=<score>, ..."
+PRIMITIVE_PROGRESS_LINE = re.compile(r'^(\d+): t=([\d.]+), score=([\d.]+)')
+SNAPSHOT_FILE = re.compile(r'^frame_(\d+)\.svg$')
+
+
+def _process_group_kwargs() -> dict:
+    """Popen arguments that start the child in its own process group."""
+    if platform.system() == "Windows":
+        import subprocess
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def _terminate_process(proc) -> None:
+    """Kill a child started with `_process_group_kwargs` together with its process group."""
+    # Not proc.poll(): that would reap the child before `wait_process` reads its usage
+    if proc.returncode is not None:
+        return
+    try:
+        if platform.system() == "Windows":
+            proc.kill()
+        else:
+            import signal
+            os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def rusage_usage(rusage, rss: bool = True) -> dict:
+    """CPU time in ms and peak RSS in bytes from a `resource.struct_rusage`."""
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    rss_unit = 1 if platform.system() == "Darwin" else 1024
+    return {
+        "cpu_user_ms": round(rusage.ru_utime * 1000, 1),
+        "cpu_system_ms": round(rusage.ru_stime * 1000, 1),
+        "peak_rss_bytes": rusage.ru_maxrss * rss_unit if rss else None,
+    }
+
+
+def wait_process(proc, timeout: Optional[float] = None) -> Optional[dict]:
+    """
+    `proc.wait(timeout)` that also returns the child's resource usage (see `rusage_usage`).
+
+    On POSIX the child is reaped with os.wait4, which reports its own CPU time and peak
+    RSS; elsewhere, or when the child has been reaped already, the usage is None. Raises
+    subprocess.TimeoutExpired like `proc.wait`.
+    """
+    import subprocess
+
+    if proc.returncode is not None or not hasattr(os, "wait4"):
+        proc.wait(timeout)
+        return None
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            proc.wait(timeout)
+            return None
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return rusage_usage(rusage)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(min(0.005, remaining))
+
+
+def thread_usage() -> dict:
+    """CPU time used so far by the calling thread, like `rusage_usage` (no RSS: it is shared)."""
+    try:
+        import resource
+        return rusage_usage(resource.getrusage(resource.RUSAGE_THREAD), rss=False)
+    except (ImportError, AttributeError):
+        # No per-thread rusage (not Linux): thread_time() does not split user and system
+        return {"cpu_user_ms": round(time.thread_time() * 1000, 1), "cpu_system_ms": 0.0, "peak_rss_bytes": None}
+
+
+def combine_usage(usages: List[Optional[dict]]) -> Optional[dict]:
+    """Usage of several processes run for one job: CPU times add up, peak RSS is the largest."""
+    if not usages or any(usage is None for usage in usages):
+        return None
+    rss = [usage["peak_rss_bytes"] for usage in usages if usage["peak_rss_bytes"] is not None]
+    return {
+        "cpu_user_ms": round(sum(usage["cpu_user_ms"] for usage in usages), 1),
+        "cpu_system_ms": round(sum(usage["cpu_system_ms"] for usage in usages), 1),
+        "peak_rss_bytes": max(rss) if rss else None,
+    }
+
+
+def find_snapshot(snapshot_dir: str, min_frame: Optional[int] = None) -> Optional[tuple]:
+    """
+    Return (frame, path) of a complete snapshot in `snapshot_dir`, or None.
+
+    Without `min_frame` this is the newest complete snapshot; with it, the oldest complete
+    snapshot taken at or after that frame. primitive writes a snapshot right after
+    reporting the frame, so the newest file can still be partially written when the run
+    is stopped; incomplete files are skipped.
+    """
+    try:
+        names = os.listdir(snapshot_dir)
+    except FileNotFoundError:
+        return None
+
+    frames = sorted(
+        (int(match.group(1)), name)
+        for name in names
+        for match in [SNAPSHOT_FILE.match(name)] if match
+    )
+    if min_frame is None:
+        candidates = reversed(frames)
+    else:
+        candidates = [(frame, name) for frame, name in frames if frame >= min_frame]
+
+    for frame, name in candidates:
+        path = os.path.join(snapshot_dir, name)
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - 16))
+            if f.read().rstrip().endswith(b"</svg>"):
+                return frame, path
+    return None
+
+
+def snapshot_args(snapshot_dir: str, shape_count: int) -> List[str]:
+    """primitive arguments that write an intermediate SVG every few shapes into `snapshot_dir`."""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    nth = max(1, -(-shape_count // max(1, SNAPSHOTS_PER_RUN)))
+    return ["-o", os.path.join(snapshot_dir, "frame_%d.svg"), "-nth", str(nth)]
+
+
+def convergence_check(
+    window: int = 20,
+    threshold: Optional[float] = None,
+    target_similarity: Optional[float] = None,
+) -> Callable[[List[tuple]], Optional[str]]:
+    """
+    Build a `stop_check` for `run_primitive` that ends a run once more shapes stop paying off.
+
+    The run is stopped when the similarity (1 - primitive's score, where the score is the
+    RMS pixel error normalized to 0..1) reaches `target_similarity`, or when the relative
+    error reduction per shape, averaged over the last `window` shapes, falls below
+    `threshold`.
+    """
+    def check(scores: List[tuple]) -> Optional[str]:
+        frame, score = scores[-1]
+        if target_similarity is not None and 1 - score >= target_similarity:
+            return "target_similarity"
+        if threshold is not None and len(scores) > window:
+            _, past_score = scores[-1 - window]
+            if past_score > 0 and (past_score - score) / past_score / window < threshold:
+                return "converged"
+        return None
+
+    return check
+
+
+def primitive_command(
+    primitive_bin: str,
+    input_path: str,
+    svg_output_path: str,
+    shape_count: int,
+    shape_mode: int,
+    opacity: int,
+    output_size: int,
+    background_color: Optional[str] = None,
+    workers: Optional[int] = None,
+) -> List[str]:
+    """Build the primitive command line for one run (with `-v` for progress reporting)."""
+    cmd = [
+        primitive_bin,
+        "-i", input_path,
+        "-o", svg_output_path,
+        "-n", str(shape_count),
+        "-m", str(shape_mode),
+        "-a", str(opacity),
+        "-s", str(output_size),
+        "-rep", "1",
+        "-v",
+    ]
+
+    # Add optional parameters
+    if background_color:
+        cmd.extend(["-bg", background_color])
+    if workers:
+        cmd.extend(["-j", str(workers)])
+
+    # Convert paths to string format for subprocess (important on Windows)
+    return [str(c) for c in cmd]
+
+
+def run_primitive(
+    cmd: List[str],
+    shape_count: int,
+    svg_output_path: str,
+    snapshot_dir: Optional[str] = None,
+    deadline: Optional[float] = None,
+    stop_check: Optional[Callable[[List[tuple]], Optional[str]]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> dict:
+    """
+    Run primitive and follow its progress until it finishes or has to be stopped.
+
+    `cmd` must include `-v` so primitive reports every shape it adds. A run can be ended
+    early in two ways, both of which need snapshots written to `snapshot_dir` (see
+    `snapshot_args`), because the newest complete snapshot becomes the result:
+    - `deadline` (a `time.monotonic()` value): stop as soon as it has passed and any
+      snapshot is available.
+    - `stop_check`: called with the (frame, score) history after every shape; when it
+      returns a reason, the run stops at the first snapshot that includes that frame.
+    Setting `cancel_event` kills the child (and its process group) right away; the
+    stop reason is then "cancelled" and there is no usable output.
+    Blocks, so call it from a worker thread.
+
+    Returns a dict with the return code, the SVG to use (`svg_path`), the number of
+    shapes in it (`shapes_generated`), primitive's score for it, the stop reason
+    ("shape_count", "time_budget" or the reason given by `stop_check`), stdout/stderr
+    and the wall time, plus the child's CPU time and peak RSS (`usage`, see `wait_process`).
+    Raises subprocess.TimeoutExpired after PRIMITIVE_TIMEOUT_SECONDS.
+    """
+    import subprocess
+
+    started = time.monotonic()
+    scores: List[tuple] = []
+    stop_request = {"reason": None, "frame": None}
+    stdout_lines: List[str] = []
+    stderr_lines: List[str] = []
+
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        shell=False,
+        **_process_group_kwargs(),
+    )
+
+    def read_stdout():
+        for line in proc.stdout:
+            match = PRIMITIVE_PROGRESS_LINE.match(line)
+            if not match:
+                stdout_lines.append(line)
+                continue
+            scores.append((int(match.group(1)), float(match.group(3))))
+            if stop_check is not None and stop_request["reason"] is None:
+                reason = stop_check(scores)
+                if reason is not None:
+                    stop_request.update({"reason": reason, "frame": scores[-1][0]})
+
+    def read_stderr():
+        for line in proc.stderr:
+            stderr_lines.append(line)
+
+    readers = [threading.Thread(target=read_stdout, daemon=True), threading.Thread(target=read_stderr, daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    stop_reason = "shape_count"
+    snapshot = None
+    usage = None
+    try:
+        while True:
+            try:
+                usage = wait_process(proc, timeout=0.05)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = "cancelled"
+                break
+
+            now = time.monotonic()
+            if now - started > PRIMITIVE_TIMEOUT_SECONDS:
+                raise subprocess.TimeoutExpired(cmd, PRIMITIVE_TIMEOUT_SECONDS)
+            if not snapshot_dir:
+                continue
+
+            if stop_request["reason"] is not None:
+                snapshot = find_snapshot(snapshot_dir, min_frame=stop_request["frame"])
+                if snapshot is not None:
+                    stop_reason = stop_request["reason"]
+                    break
+
+            if deadline is not None and now >= deadline:
+                snapshot = find_snapshot(snapshot_dir)
+                if snapshot is not None:
+                    stop_reason = "time_budget"
+                    break
+    finally:
+        _terminate_process(proc)
+        if proc.returncode is None:
+            usage = wait_process(proc)
+        for reader in readers:
+            reader.join(timeout=1)
+
+    killed = snapshot is not None and proc.returncode != 0
+    if not killed and stop_reason == "time_budget":
+        # The run completed just as the budget ran out
+        stop_reason = "shape_count"
+    if stop_reason == "shape_count" and stop_request["reason"] is not None and proc.returncode == 0:
+        # The criterion was met on the final stretch; the run simply completed
+        stop_reason = stop_request["reason"]
+
+    result = {
+        "returncode": proc.returncode,
+        "svg_path": svg_output_path,
+        "shapes_generated": shape_count,
+        "score": scores[-1][1] if scores else None,
+        "stop_reason": stop_reason,
+        "stdout": "".join(stdout_lines),
+        "stderr": "".join(stderr_lines),
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        "usage": usage,
+    }
+
+    if killed:
+        # The child was killed on purpose; the snapshot is the result
+        frame, path = snapshot
+        frame_scores = dict(scores)
+        result.update({
+            "returncode": 0,
+            "svg_path": path,
+            "shapes_generated": frame,
+            "score": frame_scores.get(frame, result["score"]),
+        })
+
+    return result
+
+
+def plan_tiles(width: int, height: int, tile_size: int, tile_overlap: int) -> List[dict]:
+    """
+    Split a width x height canvas into a grid of overlapping tiles.
+
+    Every tile has a `core` box (the grid cell it is responsible for, at most `tile_size`
+    pixels per side) and a `box` extending the core by `tile_overlap` pixels on each side
+    (clamped to the canvas), which is the area actually geometrized. Boxes are
+    (left, top, right, bottom) tuples.
+    """
+    columns = max(1, -(-width // tile_size))
+    rows = max(1, -(-height // tile_size))
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            core = (
+                column * width // columns,
+                row * height // rows,
+                (column + 1) * width // columns,
+                (row + 1) * height // rows,
+            )
+            box = (
+                max(0, core[0] - tile_overlap),
+                max(0, core[1] - tile_overlap),
+                min(width, core[2] + tile_overlap),
+                min(height, core[3] + tile_overlap),
+            )
+            tiles.append({"core": core, "box": box})
+    return tiles
+
+
+def allocate_shapes(total: int, weights: List[float]) -> List[int]:
+    """Split `total` shapes proportionally to `weights` (largest remainder, at least 1 each)."""
+    weight_sum = sum(weights) or 1.0
+    shares = [total * weight / weight_sum for weight in weights]
+    counts = [max(1, int(share)) for share in shares]
+    remaining = total - sum(counts)
+    by_remainder = sorted(range(len(shares)), key=lambda i: shares[i] - int(shares[i]), reverse=True)
+    for i in by_remainder[:max(0, remaining)]:
+        counts[i] += 1
+    return counts
+
+
+def run_tiled(
+    primitive_bin: str,
+    img,
+    tmpdir: str,
+    shape_count: int,
+    shape_mode: int,
+    opacity: int,
+    background_color: Optional[str],
+    tile_size: int,
+    tile_overlap: int,
+    deadline: Optional[float] = None,
+    stop_check: Optional[Callable[[List[tuple]], Optional[str]]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    threads: Optional[int] = None,
+) -> dict:
+    """
+    Geometrize a large image as overlapping tiles in parallel and merge the results.
+
+    Each tile gets a share of `shape_count` proportional to its area weighted by how much
+    detail it contains, and runs as its own primitive process (up to TILE_WORKERS at a
+    time, splitting the job's `threads` between them; all of CPU_BUDGET if not given). The tile results are merged into one
+    primitive-style SVG in `tmpdir`/output.svg, in the coordinate frame a single run on
+    the whole image would use, so the output formats treat it like any other result.
+
+    Seams: all tiles share one background color, each shape is kept only by the tile
+    whose core contains its center, and shapes are interleaved by their position in
+    their tile's run, so the large early shapes of every tile are drawn before the
+    detail of any tile. Returns a dict like `run_primitive`, with the tile count added
+    and the usage of all tile processes combined (see `combine_usage`).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from PIL import ImageStat
+
+    started = time.monotonic()
+    width, height = img.size
+    img = img.convert("RGB")
+
+    if not background_color:
+        # One background for every tile, so the tiles' backgrounds do not show as seams
+        background_color = "#%02x%02x%02x" % tuple(int(round(c)) for c in ImageStat.Stat(img).mean)
+
+    tiles = plan_tiles(width, height, tile_size, tile_overlap)
+    weights = []
+    for tile in tiles:
+        left, top, right, bottom = tile["core"]
+        detail = sum(ImageStat.Stat(img.crop(tile["core"])).stddev) / 3
+        weights.append((right - left) * (bottom - top) * (1 + detail))
+    budgets = allocate_shapes(shape_count, weights)
+
+    cpus = threads or CPU_BUDGET
+    parallel = min(len(tiles), TILE_WORKERS or cpus)
+    workers = max(1, cpus // parallel)
+
+    jobs = []
+    for i, (tile, budget) in enumerate(zip(tiles, budgets)):
+        left, top, right, bottom = tile["box"]
+        core_left, core_top, core_right, core_bottom = tile["core"]
+        # Shapes centered in the overlap are dropped later, so run proportionally more
+        coverage = ((right - left) * (bottom - top)) / ((core_right - core_left) * (core_bottom - core_top))
+        tile["count"] = max(1, int(round(budget * coverage)))
+
+        tile_dir = os.path.join(tmpdir, f"tile_{i}")
+        os.makedirs(tile_dir)
+        input_path = os.path.join(tile_dir, "input.png")
+        img.crop(tile["box"]).save(input_path, "PNG")
+        tile_output_path = os.path.join(tile_dir, "output.svg")
+
+        cmd = primitive_command(
+            primitive_bin, input_path, tile_output_path, tile["count"], shape_mode, opacity,
+            max(right - left, bottom - top), background_color, workers,
+        )
+        snapshot_dir = None
+        if deadline is not None or stop_check is not None:
+            snapshot_dir = os.path.join(tile_dir, "frames")
+            cmd.extend(snapshot_args(snapshot_dir, tile["count"]))
+        jobs.append((cmd, tile["count"], tile_output_path, snapshot_dir))
+
+    print(f"[DEBUG] Tiled run: {len(tiles)} tiles, {parallel} in parallel, -j {workers}")
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = [
+            pool.submit(
+                run_primitive, cmd, count, output_path,
+                snapshot_dir=snapshot_dir, deadline=deadline, stop_check=stop_check, cancel_event=cancel_event,
+            )
+            for cmd, count, output_path, snapshot_dir in jobs
+        ]
+        results = [future.result() for future in futures]
+
+    merged = {
+        "returncode": 0,
+        "svg_path": os.path.join(tmpdir, "output.svg"),
+        "shapes_generated": 0,
+        "score": None,
+        "stop_reason": "shape_count",
+        "stdout": "".join(result["stdout"] for result in results),
+        "stderr": "".join(result["stderr"] for result in results),
+        "elapsed_ms": 0,
+        "tiles": len(tiles),
+        "usage": combine_usage([result["usage"] for result in results]),
+    }
+    for result in results:
+        if result["stop_reason"] == "cancelled" or result["returncode"] != 0:
+            merged.update({"returncode": result["returncode"], "stop_reason": result["stop_reason"]})
+            merged["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+            return merged
+        if merged["stop_reason"] == "shape_count":
+            merged["stop_reason"] = result["stop_reason"]
+
+    # Frame of a single run on the whole image: shapes in working resolution, `scale` to pixels
+    frame_scale = working_scale(width, height)
+
+    ranked = []
+    for tile, result in zip(tiles, results):
+        with open(result["svg_path"], "r") as f:
+            document = parse_svg_document(f.read())
+        left, top = tile["box"][:2]
+        core_left, core_top, core_right, core_bottom = tile["core"]
+        tile_scale = document["scale"]
+        for index, shape in enumerate(document["shapes"]):
+            # Tile working coordinates -> canvas pixels (primitive offsets by half a pixel)
+            center_x, center_y = shape_center(shape)
+            center_x = min(max((center_x + 0.5) * tile_scale + left, 0), width - 1)
+            center_y = min(max((center_y + 0.5) * tile_scale + top, 0), height - 1)
+            if not (core_left <= center_x < core_right and core_top <= center_y < core_bottom):
+                continue
+            # ... and canvas pixels -> working coordinates of the whole image
+            moved = transform_shape(
+                shape,
+                tile_scale / frame_scale,
+                (0.5 * tile_scale + left) / frame_scale - 0.5,
+                (0.5 * tile_scale + top) / frame_scale - 0.5,
+            )
+            ranked.append(((index + 1) / result["shapes_generated"], len(ranked), moved))
+
+    ranked.sort(key=lambda item: item[:2])
+    shapes = [shape for _, _, shape in ranked[:shape_count]]
+
+    with open(merged["svg_path"], "w") as f:
+        f.write(build_svg(width, height, background_color, frame_scale, shapes))
+
+    scores = [(tile, result["score"]) for tile, result in zip(tiles, results)]
+    if all(score is not None for _, score in scores):
+        # Combine the per-tile RMS errors weighted by the area each tile is responsible for
+        areas = [(t["core"][2] - t["core"][0]) * (t["core"][3] - t["core"][1]) for t, _ in scores]
+        merged["score"] = (sum(area * score ** 2 for area, (_, score) in zip(areas, scores)) / sum(areas)) ** 0.5
+
+    merged["shapes_generated"] = len(shapes)
+    merged["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+    return merged
+
+
+async def run_until_disconnected(request: Request, func: Callable, *args, **kwargs):
+    """
+    Run a blocking job in the threadpool while watching the client connection.
+
+    `func` must accept a `cancel_event` keyword argument. When the client (`request`, or
+    the `Flight` of a job shared by identical requests) disconnects before the job has
+    finished, the event is set so the job can stop its work (see `run_primitive`), and the
+    job's result is still awaited and returned.
+    """
+    cancel_event = threading.Event()
+    job = asyncio.ensure_future(run_in_threadpool(func, *args, cancel_event=cancel_event, **kwargs))
+    while not job.done():
+        done, _ = await asyncio.wait({job}, timeout=DISCONNECT_POLL_SECONDS)
+        if not done and not cancel_event.is_set() and await request.is_disconnected():
+            print("[INFO] Client disconnected, cancelling job")
+            cancel_event.set()
+    return job.result()
+
+
+PRIORITY_CLASSES = ("interactive", "batch")
+
+
+def parse_client_weights(spec: str) -> dict:
+    """Parse "key=weight,..." into a dict of positive integer weights (invalid entries are skipped)."""
+    weights = {}
+    for item in spec.split(","):
+        key, _, weight = item.strip().rpartition("=")
+        try:
+            if key and int(weight) > 0:
+                weights[key] = int(weight)
+        except ValueError:
+            print(f"[WARNING] Ignoring invalid client weight: {item!r}")
+    return weights
+
+
+def client_key(request: Request) -> str:
+    """Key jobs are shared fairly by: the API key, else the X-Client-Id header, else the client address."""
+    return (
+        request.headers.get("x-api-key")
+        or request.headers.get("x-client-id")
+        or (request.client.host if request.client else "unknown")
+    )
+
+
+def client_label(request: Request) -> str:
+    """`client_key` for metrics and logs, with API keys replaced by a short hash so they are never exposed."""
+    api_key = request.headers.get("x-api-key")
+    if api_key:
+        return "key-" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+    return client_key(request)
+
+
+def run_resources(result: dict, bytes_in: int) -> dict:
+    """
+    What an engine run cost: wall time, CPU time and peak RSS of its process(es), and the upload size.
+
+    `bytes_out` is filled in with the size of the body when it is written (see `json_body`).
+    """
+    return {
+        "wall_ms": result["elapsed_ms"],
+        **(result.get("usage") or {"cpu_user_ms": None, "cpu_system_ms": None, "peak_rss_bytes": None}),
+        "bytes_in": bytes_in,
+        "bytes_out": None,
+        "served_from_cache": False,
+    }
+
+
+def cached_resources(bytes_in: Optional[int]) -> dict:
+    """
+    The `resources` of a response that ran nothing (a cache hit, or coalesced into an identical run).
+
+    `bytes_in` is None in bodies stored in the cache, which are shared between requests.
+    """
+    return {
+        "wall_ms": 0,
+        "cpu_user_ms": 0,
+        "cpu_system_ms": 0,
+        "peak_rss_bytes": 0,
+        "bytes_in": bytes_in,
+        "bytes_out": None,
+        "served_from_cache": True,
+    }
+
+
+def record_job_usage(
+    request: Request, mode: str, resources: Optional[dict], bytes_in: int, response: Optional[FileResponse] = None,
+    bytes_out: Optional[int] = None,
+) -> None:
+    """
+    Log what one /api/generate request cost and add it to the per-client metrics.
+
+    `resources` is the usage of the engine run the request started (see `run_resources`),
+    None when it was served from the cache or by an identical request's run. Bytes out
+    is the size of the response body sent from disk (after compression), 0 without one;
+    streamed responses count it while sending and pass it as `bytes_out`.
+    """
+    client = client_label(request)
+    if bytes_out is None:
+        bytes_out = os.path.getsize(response.path) if response is not None else 0
+    METRICS.inc("geometrize_job_bytes_in_total", bytes_in, mode=mode, client=client)
+    METRICS.inc("geometrize_job_bytes_out_total", bytes_out, mode=mode, client=client)
+    if resources is None:
+        print(f"[INFO] Job usage: client={client} mode={mode} run=none bytes_in={bytes_in} bytes_out={bytes_out}")
+        return
+
+    METRICS.inc("geometrize_job_runs_total", mode=mode, client=client)
+    METRICS.inc("geometrize_job_wall_seconds_total", resources["wall_ms"] / 1000, mode=mode, client=client)
+    for kind in ("user", "system"):
+        if resources[f"cpu_{kind}_ms"] is not None:
+            METRICS.inc(
+                "geometrize_job_cpu_seconds_total", resources[f"cpu_{kind}_ms"] / 1000, mode=mode, client=client, kind=kind
+            )
+    if resources["peak_rss_bytes"] is not None:
+        METRICS.observe("geometrize_job_peak_rss_bytes", resources["peak_rss_bytes"], mode=mode)
+    print(
+        f"[INFO] Job usage: client={client} mode={mode} "
+        f"wall_ms={resources['wall_ms']} cpu_user_ms={resources['cpu_user_ms']} "
+        f"cpu_system_ms={resources['cpu_system_ms']} peak_rss_bytes={resources['peak_rss_bytes']} "
+        f"bytes_in={bytes_in} bytes_out={bytes_out}"
+    )
+
+
+class JobScheduler:
+    """
+    Admits primitive jobs to a fixed number of slots.
+
+    Waiting jobs are admitted by priority class first (interactive before batch), then by
+    weighted round-robin over the clients of that class: a client with weight w gets up
+    to w jobs admitted in a row before the next client with waiting jobs gets its turn,
+    so one client's large submission cannot starve others. Each class also has its own
+    concurrency limit, which keeps part of the capacity free for interactive jobs while
+    batch jobs use what is left. All state lives on the event loop; no locking needed.
+
+    Jobs carry an estimated cost in seconds (see `CostModel`), from which the scheduler
+    estimates how long a new job would wait for a slot.
+
+    Admitted jobs are also given a number of worker threads out of `cpu_budget`, so that
+    concurrent primitive runs together use at most as many threads as there are CPUs
+    instead of each spawning one per core (as long as `max_running` does not exceed
+    `cpu_budget`).
+    """
+
+    def __init__(
+        self, max_running: int, class_limits: dict, weights: Optional[dict] = None, cpu_budget: int = 1
+    ):
+        self.max_running = max_running
+        self.class_limits = class_limits
+        self.weights = weights or {}
+        self.cpu_budget = cpu_budget
+        self.running = {priority: 0 for priority in PRIORITY_CLASSES}
+        # Per class: client -> FIFO of waiting futures, in round-robin order
+        self._waiting = {priority: OrderedDict() for priority in PRIORITY_CLASSES}
+        # Per class: remaining turns of the client at the head of the rotation
+        self._credits = {priority: 0 for priority in PRIORITY_CLASSES}
+        # Estimated cost of every queued or running job, and the start time of running ones
+        self._costs = {}
+        self._started = {}
+        # Worker threads assigned to every running job, and the most a waiting job can use
+        self._threads = {}
+        self._thread_caps = {}
+
+    def queued(self, priority: str) -> int:
+        return sum(len(queue) for queue in self._waiting[priority].values())
+
+    def _can_start(self, priority: str) -> bool:
+        return sum(self.running.values()) < self.max_running and self.running[priority] < self.class_limits[priority]
+
+    def _next_waiter(self, priority: str):
+        """Pop the next waiting future of a class in weighted round-robin order."""
+        waiting = self._waiting[priority]
+        client, queue = next(iter(waiting.items()))
+        if self._credits[priority] <= 0:
+            self._credits[priority] = self.weights.get(client, 1)
+        self._credits[priority] -= 1
+        future = queue.popleft()
+        if not queue:
+            del waiting[client]
+            self._credits[priority] = 0
+        elif self._credits[priority] <= 0:
+            waiting.move_to_end(client)
+        return future
+
+    def _assign_threads(self, future) -> int:
+        """
+        Worker threads for a job being admitted.
+
+        Its fair share of the CPU budget among all running and waiting jobs, but no more
+        than the job can use, and no more than what running jobs leave unassigned minus
+        one thread for every other free slot (and always at least one). Threads of
+        running processes cannot be taken back, so holding one back per free slot lets
+        every job admitted later start with a thread of its own without overbooking the
+        budget. A job started on an idle server gets every CPU but those.
+        """
+        jobs = sum(self.running.values()) + sum(self.queued(priority) for priority in PRIORITY_CLASSES)
+        fair_share = self.cpu_budget // max(1, jobs)
+        # Called after the job was counted as running
+        free_slots = self.max_running - sum(self.running.values())
+        unassigned = self.cpu_budget - sum(self._threads.values()) - free_slots
+        return max(1, min(fair_share, unassigned, self._thread_caps.pop(future, self.cpu_budget)))
+
+    def _dispatch(self) -> None:
+        for priority in PRIORITY_CLASSES:
+            while self._waiting[priority] and self._can_start(priority):
+                future = self._next_waiter(priority)
+                self.running[priority] += 1
+                self._threads[future] = self._assign_threads(future)
+                self._started[future] = time.monotonic()
+                future.set_result(self._started[future])
+        self._update_metrics()
+
+    def _update_metrics(self) -> None:
+        for priority in PRIORITY_CLASSES:
+            METRICS.set("geometrize_jobs_running", self.running[priority], **{"class": priority})
+            METRICS.set("geometrize_jobs_queued", self.queued(priority), **{"class": priority})
+        METRICS.set("geometrize_worker_threads", sum(self._threads.values()))
+
+    def _withdraw(self, priority: str, client: str, future) -> None:
+        """Remove a waiter that gave up; if it was admitted meanwhile, give its slot back."""
+        queue = self._waiting[priority].get(client)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._waiting[priority][client]
+            self._costs.pop(future, None)
+            self._thread_caps.pop(future, None)
+            self._update_metrics()
+        elif future.done() and not future.cancelled():
+            self.release(priority, future)
+
+    def release(self, priority: str, future=None) -> None:
+        self.running[priority] -= 1
+        self._costs.pop(future, None)
+        self._started.pop(future, None)
+        self._threads.pop(future, None)
+        self._dispatch()
+
+    def estimated_wait(self, priority: str) -> float:
+        """
+        Seconds a job of class `priority` submitted now would probably wait for a slot.
+
+        The remaining work of the running jobs plus the work queued ahead of it (all waiting
+        jobs of its own and higher classes) is spread over the slots the class may use.
+        """
+        ahead = PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority) + 1]
+        queued = [future for cls in ahead for queue in self._waiting[cls].values() for future in queue]
+        if not queued and self._can_start(priority):
+            return 0.0
+
+        now = time.monotonic()
+        remaining = sum(max(0.0, self._costs.get(future, 0.0) - (now - started)) for future, started in self._started.items())
+        work = remaining + sum(self._costs.get(future, 0.0) for future in queued)
+        return work / min(self.max_running, self.class_limits[priority])
+
+    @asynccontextmanager
+    async def slot(
+        self, priority: str, client: str, request: Optional[Request] = None, cost: float = 0.0,
+        max_threads: Optional[int] = None,
+    ):
+        """
+        Wait for a slot for a job of `client` in class `priority` and hold it for the block.
+
+        `cost` is the job's estimated run time in seconds; `max_threads` caps the threads
+        assigned to jobs that cannot use the whole budget (single-threaded work). While waiting, the client
+        connection (`request`, or a `Flight`) is checked every DISCONNECT_POLL_SECONDS; a job whose client went away
+        leaves the queue with 499. Yields the number of worker threads the job may use.
+        """
+        enqueued = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._costs[future] = cost
+        if max_threads is not None:
+            self._thread_caps[future] = max_threads
+        self._waiting[priority].setdefault(client, deque()).append(future)
+        self._dispatch()
+
+        try:
+            while not future.done():
+                await asyncio.wait({future}, timeout=DISCONNECT_POLL_SECONDS)
+                if not future.done() and request is not None and await request.is_disconnected():
+                    METRICS.inc("geometrize_jobs_abandoned_total", **{"class": priority})
+                    raise HTTPException(
+                        status_code=499,
+                        detail="Client disconnected while the job was queued"
+                    )
+        except BaseException:
+            self._withdraw(priority, client, future)
+            raise
+
+        waited = future.result() - enqueued
+        METRICS.observe("geometrize_queue_wait_seconds", waited, **{"class": priority})
+        if waited > 0.001:
+            print(f"[DEBUG] {priority} job waited {waited * 1000:.0f} ms for a slot")
+        try:
+            yield self._threads[future]
+        finally:
+            self.release(priority, future)
+
+
+def primitive_threads(assigned: int) -> Optional[int]:
+    """Worker threads (-j) for a run the scheduler assigned `assigned` threads; None = primitive's default."""
+    if PRIMITIVE_THREADS > 0:
+        return PRIMITIVE_THREADS
+    if PRIMITIVE_THREADS < 0:
+        return None
+    return assigned
+
+
+def create_scheduler() -> JobScheduler:
+    """Build the scheduler from the GEOMETRIZE_* scheduling settings."""
+    slots = MAX_CONCURRENT_JOBS or CPU_BUDGET
+    limits = {
+        "interactive": min(slots, INTERACTIVE_MAX_CONCURRENT or slots),
+        "batch": min(slots, BATCH_MAX_CONCURRENT or max(1, slots // 2)),
+    }
+    return JobScheduler(slots, limits, parse_client_weights(CLIENT_WEIGHTS), CPU_BUDGET)
+
+
+SCHEDULER = create_scheduler()
+METRICS.set("geometrize_cpu_budget", CPU_BUDGET)
+
+
+class Flight:
+    """
+    A result being computed by one request (the leader) and the identical requests waiting for it.
+
+    Stands in for the leader's request wherever a job watches its client (`SCHEDULER.slot`,
+    `run_until_disconnected`): it only counts as disconnected once the leader and every
+    follower have gone, so the job keeps running as long as anybody still wants its result.
+    """
+
+    def __init__(self, key: str, request: Request):
+        self.key = key
+        self.request = request
+        self.followers = 0
+        # Set when the job fails; followers get the same error instead of running it again
+        self.error: Optional[HTTPException] = None
+        self._done = asyncio.get_running_loop().create_future()
+
+    async def is_disconnected(self) -> bool:
+        if self.followers or not await self.request.is_disconnected():
+            return False
+        # Nobody is left: requests arriving from now on start a job of their own
+        IN_FLIGHT.discard(self)
+        return True
+
+    async def wait(self, request: Request) -> None:
+        """
+        Wait for the leader to finish, as a follower.
+
+        Raises the leader's error if the job failed, or 499 if `request` disconnects while
+        waiting (the job goes on for the others). On return the result is in the cache.
+        """
+        self.followers += 1
+        try:
+            while not self._done.done():
+                await asyncio.wait({self._done}, timeout=DISCONNECT_POLL_SECONDS)
+                if not self._done.done() and await request.is_disconnected():
+                    raise HTTPException(
+                        status_code=499,
+                        detail="Client disconnected while waiting for an identical job"
+                    )
+        finally:
+            self.followers -= 1
+        if self.error is not None:
+            raise HTTPException(status_code=self.error.status_code, detail=self.error.detail, headers=self.error.headers)
+
+    def finish(self, error: Optional[HTTPException] = None) -> None:
+        """Wake the followers (only the first call counts)."""
+        IN_FLIGHT.discard(self)
+        if not self._done.done():
+            self.error = error
+            self._done.set_result(None)
+
+
+class InFlightJobs:
+    """
+    Single-flight registry: at most one running job per result cache key.
+
+    A request whose result is neither cached nor being computed becomes the leader of a
+    `Flight`; identical requests arriving meanwhile (same input and parameters) wait for
+    it and are then served from the result cache. Lives on the event loop; no locking.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    def get(self, key: str) -> Optional[Flight]:
+        return self._flights.get(key)
+
+    def lead(self, key: str, request: Request) -> Flight:
+        flight = Flight(key, request)
+        self._flights[key] = flight
+        return flight
+
+    def discard(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+
+IN_FLIGHT = InFlightJobs()
+
+
+class CostModel:
+    """
+    Estimates how long a job takes, calibrated from the jobs that actually ran.
+
+    A primitive run costs `shape_count` x (working pixels / PRIMITIVE_WORKING_SIZE^2)
+    units, per shape mode: primitive works on the downscaled image, so only the aspect
+    ratio of large inputs matters. Finishing the job (culling, quality report, building
+    the output) costs `shape_count` units, times the output megapixels for PNG. Seconds
+    per unit start from rough defaults and follow an exponentially weighted moving
+    average of observed timings.
+    """
+
+    DEFAULT_RATES = {
+        "run": 0.03,
+        "finish:svg": 0.00005,
+        "finish:json": 0.0001,
+        "finish:png": 0.002,
+    }
+
+    def __init__(self, smoothing: float = 0.2):
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._samples = {}
+
+    @staticmethod
+    def run_units(width: int, height: int, shape_count: int) -> float:
+        scale = min(1.0, PRIMITIVE_WORKING_SIZE / max(width, height))
+        return shape_count * (width * scale) * (height * scale) / PRIMITIVE_WORKING_SIZE ** 2
+
+    @staticmethod
+    def finish_units(output_format: str, width: int, height: int, shape_count: int) -> float:
+        if output_format == "png":
+            return shape_count * (1 + width * height / 1_000_000)
+        return shape_count
+
+    @staticmethod
+    def run_key(shape_mode: int, engine: str = "primitive", pyramid: bool = False, importance: str = "none") -> str:
+        """Rate key of a run: per shape mode for primitive, per search mode for the native engine."""
+        if engine == "native":
+            return "run:native" + ("-pyramid" if pyramid else "") + ("-importance" if importance != "none" else "")
+        return f"run:{shape_mode}"
+
+    def rate(self, key: str) -> float:
+        """Seconds per unit for `key` (a `run_key` or "finish:<output format>")."""
+        with self._lock:
+            if key in self._rates:
+                return self._rates[key]
+        return self.DEFAULT_RATES.get(key, self.DEFAULT_RATES["run"] if key.startswith("run:") else 0.0)
+
+    def record(self, key: str, units: float, seconds: float) -> None:
+        """Fold one observed timing (`seconds` for `units` of work) into the rate for `key`."""
+        if units <= 0:
+            return
+        observed = seconds / units
+        with self._lock:
+            count = self._samples.get(key, 0)
+            if count == 0:
+                self._rates[key] = observed
+            else:
+                self._rates[key] += self.smoothing * (observed - self._rates[key])
+            self._samples[key] = count + 1
+
+    def estimate(
+        self,
+        shape_mode: int,
+        output_format: str,
+        width: int,
+        height: int,
+        shape_count: int,
+        time_budget_ms: Optional[int] = None,
+        tile_size: Optional[int] = None,
+        tile_overlap: int = 0,
+        engine: str = "primitive",
+        pyramid: bool = False,
+        importance: str = "none",
+    ) -> dict:
+        """Estimated seconds for the primitive (or native engine) run and for finishing the job."""
+        if tile_size is not None and max(width, height) > tile_size:
+            # Tiles are geometrized side by side, each at (up to) the working size
+            tiles = len(plan_tiles(width, height, tile_size, tile_overlap))
+            parallel = min(tiles, TILE_WORKERS or CPU_BUDGET)
+            tile_side = tile_size + 2 * tile_overlap
+            run_units = self.run_units(tile_side, tile_side, shape_count) / parallel
+        else:
+            run_units = self.run_units(width, height, shape_count)
+        run_seconds = self.rate(self.run_key(shape_mode, engine, pyramid, importance)) * run_units
+        if time_budget_ms is not None:
+            run_seconds = min(run_seconds, time_budget_ms / 1000)
+        finish_seconds = self.rate(f"finish:{output_format}") * self.finish_units(output_format, width, height, shape_count)
+        return {
+            "run_seconds": round(run_seconds, 3),
+            "finish_seconds": round(finish_seconds, 3),
+            "total_seconds": round(run_seconds + finish_seconds, 3),
+        }
+
+    def calibration(self) -> dict:
+        """Current seconds-per-unit rates and how many samples each is based on."""
+        with self._lock:
+            return {key: {"rate": rate, "samples": self._samples[key]} for key, rate in self._rates.items()}
+
+
+COST_MODEL = CostModel()
+
+
+def admission_check(priority: str, estimated_seconds: float) -> dict:
+    """
+    Decide whether a job can be queued right now.
+
+    Returns the estimated queue wait, the class's limit, whether the job is admitted and,
+    when it is not, the number of seconds after which a retry is likely to be admitted.
+    """
+    limit = BATCH_MAX_QUEUE_WAIT_SECONDS if priority == "batch" else MAX_QUEUE_WAIT_SECONDS
+    wait = SCHEDULER.estimated_wait(priority)
+    admitted = not limit or wait <= limit
+    return {
+        "estimated_queue_wait_seconds": round(wait, 3),
+        "max_queue_wait_seconds": limit,
+        "admitted": admitted,
+        "retry_after_seconds": None if admitted else max(1, math.ceil(wait - limit)),
+    }
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that refuses request bodies larger than `max_body_bytes` with 413.
+
+    Requests announcing a larger Content-Length are rejected before any of the body is
+    read; chunked bodies are counted as they stream in and cut off at the limit, so an
+    oversized upload is never buffered or parsed in full. `route_limits` maps request
+    paths that take several files (sequences) to limits of their own.
+    """
+
+    def __init__(self, app, max_body_bytes: int, route_limits: Optional[dict] = None):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+        self.route_limits = route_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        max_body_bytes = self.route_limits.get(scope["path"], self.max_body_bytes)
+        if max_body_bytes <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > max_body_bytes:
+            await self._reject(scope, send, max_body_bytes)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body_bytes:
+                    exceeded = True
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # Once the limit is hit, the app's own error response is replaced by our 413
+            if exceeded and not response_started:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded or response_started:
+                raise
+
+        if exceeded and not response_started:
+            await self._reject(scope, send, max_body_bytes)
+
+    async def _reject(self, scope, send, max_body_bytes: int):
+        response = JSONResponse(
+            status_code=413,
+            content={"detail": f"Request body exceeds the upload limit of {max_body_bytes} bytes"},
+            headers={"Connection": "close"},
+        )
+        await response(scope, None, send)
+
+
+app.add_middleware(
+    UploadLimitMiddleware,
+    max_body_bytes=MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    route_limits={"/api/generate/sequence": MAX_SEQUENCE_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES},
+)
+
+
+async def spool_upload(chunks) -> tuple:
+    """
+    Copy an uploaded image from an async iterator of byte chunks into a spool file.
+
+    The spool stays in memory up to UPLOAD_SPOOL_BYTES and moves to SCRATCH_DIR beyond
+    that. Raises 413 as soon as more than MAX_UPLOAD_BYTES have been received.
+    Returns the spool (rewound) and the SHA-256 hex digest of its content.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, dir=SCRATCH_DIR)
+    digest = hashlib.sha256()
+    total = 0
+    try:
+        async for chunk in chunks:
+            total += len(chunk)
+            if total > MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Image exceeds the upload limit of {MAX_UPLOAD_BYTES} bytes"
+                )
+            digest.update(chunk)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+
+    if total == 0:
+        spool.close()
+        raise HTTPException(status_code=400, detail="Invalid image file: empty upload")
+
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+def spool_size(spool) -> int:
+    """Size in bytes of a spooled upload, which is left rewound."""
+    size = spool.seek(0, os.SEEK_END)
+    spool.seek(0)
+    return size
+
+
+async def iter_upload_file(upload: UploadFile):
+    """Yield an UploadFile's content in UPLOAD_CHUNK_BYTES chunks."""
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        yield chunk
+
+
+def resized_dimensions(
+    width: int, height: int, resize_width: Optional[int] = None, resize_height: Optional[int] = None
+) -> Optional[tuple]:
+    """Target size of the optional resize (aspect ratio kept when only one side is given), or None."""
+    if resize_width and resize_height:
+        return (resize_width, resize_height)
+    if resize_width:
+        return (resize_width, int(height * resize_width / width))
+    if resize_height:
+        return (int(width * resize_height / height), resize_height)
+    return None
+
+
+def decode_image(spool, resize_width: Optional[int] = None, resize_height: Optional[int] = None):
+    """
+    Validate and decode a spooled upload, applying the requested resize.
+
+    The pixel dimensions are read from the image header and checked against
+    MAX_IMAGE_DIMENSION and MAX_IMAGE_PIXELS before any pixel data is decoded. When
+    shrinking a JPEG, the decoder is asked for a reduced-scale draft so the full-size
+    bitmap is never materialized. Returns a fully loaded PIL image.
+    """
+    from PIL import Image
+
+    # Keep Pillow's own decompression-bomb guard in line with our limit
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+    try:
+        img = Image.open(spool)  # Only parses the header
+        width, height = img.size
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image file: {str(e)}"
+        )
+
+    if width > MAX_IMAGE_DIMENSION or height > MAX_IMAGE_DIMENSION or width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(
+            status_code=413,
+            detail=(
+                f"Image dimensions {width}x{height} exceed the limit "
+                f"({MAX_IMAGE_DIMENSION} px per side, {MAX_IMAGE_PIXELS} pixels total)"
+            )
+        )
+
+    try:
+        img.verify()
+        spool.seek(0)
+        img = Image.open(spool)  # Re-open after verify
+
+        # Work out the target size of the optional resize
+        target_size = resized_dimensions(width, height, resize_width, resize_height)
+
+        if target_size and target_size[0] < width and target_size[1] < height:
+            # JPEG can decode directly at 1/2, 1/4 or 1/8 scale (no-op for other formats)
+            img.draft(img.mode, target_size)
+
+        img.load()
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image file: {str(e)}"
+        )
+
+    # Resize image if requested
+    if target_size:
+        img = img.resize(target_size, Image.Resampling.LANCZOS)
+
+    return img
+
+
+def probe_frames(spool) -> tuple:
+    """Size and number of frames (1 unless it is an animation) of a spooled upload; reads only the header."""
+    from PIL import Image
+
+    try:
+        img = Image.open(spool)
+        size, count = img.size, getattr(img, "n_frames", 1)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image file: {str(e)}"
+        )
+    spool.seek(0)
+    return size, count
+
+
+def iter_frames(spools, resize_width: Optional[int] = None, resize_height: Optional[int] = None):
+    """
+    Decode the frames of spooled uploads one at a time, in order.
+
+    Each upload is a still image or an animation (GIF, APNG, animated WebP), validated
+    like a single upload by `decode_image`. Every frame is resized to the size of the
+    first one.
+    """
+    from PIL import Image
+
+    size = None
+    for spool in spools:
+        first = decode_image(spool, resize_width, resize_height)
+        size = size or first.size
+        yield first if first.size == size else first.resize(size, Image.Resampling.LANCZOS)
+
+        spool.seek(0)
+        animation = Image.open(spool)
+        for index in range(1, getattr(animation, "n_frames", 1)):
+            try:
+                animation.seek(index)
+                frame = animation.convert("RGB")
+            except Exception as e:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid image file: {str(e)}"
+                )
+            yield frame if frame.size == size else frame.resize(size, Image.Resampling.LANCZOS)
+
+
+def _brotli_module():
+    """The optional `brotli` package, or None when it is not installed."""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def available_encodings() -> List[str]:
+    """Content encodings this server can produce, in order of preference."""
+    return [encoding for encoding in CONTENT_ENCODINGS if encoding != "br" or _brotli_module() is not None]
+
+
+def compress_file(source_path: str, destination, encoding: str) -> None:
+    """
+    Compress a file with the given Content-Encoding ("gzip" or "br") into the open binary
+    file `destination`, a chunk at a time so memory use does not grow with the file size.
+    """
+    with open(source_path, "rb") as source:
+        if encoding == "br":
+            compressor = _brotli_module().Compressor(quality=BROTLI_QUALITY)
+            for chunk in iter(functools.partial(source.read, UPLOAD_CHUNK_BYTES), b""):
+                destination.write(compressor.process(chunk))
+            destination.write(compressor.finish())
+            return
+
+        import gzip
+        with gzip.GzipFile(filename="", fileobj=destination, mode="wb", compresslevel=9, mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed, UPLOAD_CHUNK_BYTES)
+
+
+def iter_chunks(pieces: Iterator[bytes], size: int = UPLOAD_CHUNK_BYTES) -> Iterator[bytes]:
+    """Join small pieces (such as NDJSON lines) into chunks of about `size` bytes for sending."""
+    buffer, buffered = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b"".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def compress_chunks(chunks: Iterator[bytes], encoding: str) -> Iterator[bytes]:
+    """
+    Compress a stream of chunks with the given Content-Encoding ("gzip" or "br").
+
+    Every chunk is flushed, so the client can decode everything sent so far.
+    """
+    if encoding == "br":
+        compressor = _brotli_module().Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+
+    import zlib
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def negotiate_encoding(accept_encoding: Optional[str], output_format: str, size: int) -> Optional[str]:
+    """
+    Pick the Content-Encoding for a response from the request's Accept-Encoding header.
+
+    Returns None (identity) for binary formats, tiny payloads, or when the client accepts
+    none of the available encodings. Among acceptable encodings the server's preference
+    (brotli, then gzip) wins.
+    """
+    if output_format not in COMPRESSIBLE_FORMATS or size < MIN_COMPRESS_BYTES or not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in available_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def _write_atomic(path: str, content) -> None:
+    """
+    Write a file so that concurrent readers never see it half-written.
+
+    `content` is either the bytes to write or a function that writes to the open file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if callable(content):
+                content(f)
+            else:
+                f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ResultCache:
+    """
+    Disk cache of generated outputs, evicted least-recently-used by total size.
+
+    Each entry is a directory named by its key, holding `meta.json` (run information
+    needed to rebuild responses) and one file per rendering produced so far, named
+    `output.<rendering>` (e.g. `output.json`, `output.compact-1.svg`). primitive's own
+    SVG is always stored, since every other rendering can be derived from it. Compressed
+    variants (`.br`/`.gz`) are written next to an output the first time a client asks
+    for them, so repeat hits are served from disk without recompressing.
+
+    The same layout holds normalized input images (INPUT_CACHE), one `output.png` per
+    entry.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None  # OrderedDict of key -> entry size, least recently used first
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(content_hash: str, params: dict) -> str:
+        """Cache key for an upload (by content hash) and the parameters applied to it."""
+        payload = json.dumps({"content": content_hash, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key: str, output_format: str, encoding: Optional[str] = None) -> str:
+        """Path of an output (or of one of its compressed variants) inside an entry."""
+        suffix = CONTENT_ENCODINGS[encoding] if encoding else ""
+        return os.path.join(self.directory, key, f"output.{output_format}{suffix}")
+
+    def has(self, key: str, output_format: str, encoding: Optional[str] = None) -> bool:
+        return os.path.exists(self.path(key, output_format, encoding))
+
+    @staticmethod
+    def _entry_size(entry_dir: str) -> int:
+        """Total size of an entry's files, skipping any renamed or removed while counting."""
+        size = 0
+        for name in os.listdir(entry_dir):
+            try:
+                size += os.path.getsize(os.path.join(entry_dir, name))
+            except FileNotFoundError:
+                continue  # e.g. the temporary file of a concurrent write, renamed meanwhile
+        return size
+
+    def _load_index(self) -> None:
+        """Build the LRU index from the cache directory (entries ordered by last use)."""
+        if self._index is not None:
+            return
+
+        entries = []
+        if os.path.isdir(self.directory):
+            for key in os.listdir(self.directory):
+                entry_dir = os.path.join(self.directory, key)
+                try:
+                    size = self._entry_size(entry_dir)
+                    entries.append((os.path.getmtime(entry_dir), key, size))
+                except OSError:
+                    continue
+        self._index = OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    def _update(self, key: str) -> None:
+        """Record an entry's current size as most recently used and evict to fit the budget."""
+        size = self._entry_size(os.path.join(self.directory, key))
+        with self._lock:
+            self._load_index()
+            self._index[key] = size
+            self._index.move_to_end(key)
+            total = sum(self._index.values())
+            while total > self.max_bytes and len(self._index) > 1:
+                evicted, evicted_size = self._index.popitem(last=False)
+                shutil.rmtree(os.path.join(self.directory, evicted), ignore_errors=True)
+                total -= evicted_size
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Return the metadata of a cached entry and mark it recently used, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(os.path.join(self.directory, key, "meta.json")) as f:
+                metadata = json.load(f)
+            os.utime(os.path.join(self.directory, key))
+        except (OSError, ValueError):
+            return None
+        return metadata
+
+    def store(self, key: str, output_format: str, content: bytes, metadata: dict) -> None:
+        """Add an output (and the entry's metadata) to the cache."""
+        os.makedirs(os.path.join(self.directory, key), exist_ok=True)
+        _write_atomic(self.path(key, output_format), content)
+        _write_atomic(os.path.join(self.directory, key, "meta.json"), json.dumps(metadata).encode())
+        self._update(key)
+
+    def store_file(self, key: str, output_format: str, source_path: str, metadata: dict) -> None:
+        """Add an output file to the cache without reading it into memory."""
+        def copy(f):
+            with open(source_path, "rb") as source:
+                shutil.copyfileobj(source, f, UPLOAD_CHUNK_BYTES)
+
+        self.store(key, output_format, copy, metadata)
+
+    def variant(self, key: str, output_format: str, encoding: str) -> str:
+        """Path of a compressed variant of a cached output, creating it on first use."""
+        path = self.path(key, output_format, encoding)
+        if not os.path.exists(path):
+            _write_atomic(path, functools.partial(compress_file, self.path(key, output_format), encoding=encoding))
+            self._update(key)
+        return path
+
+
+RESULT_CACHE = ResultCache(CACHE_DIR, CACHE_MAX_BYTES)
+INPUT_CACHE = ResultCache(INPUT_CACHE_DIR, INPUT_CACHE_MAX_BYTES)
+
+
+def image_id_for(content_hash: str, resize_width: Optional[int], resize_height: Optional[int]) -> str:
+    """Id of the working image an upload normalizes to (by content hash and resize parameters)."""
+    return INPUT_CACHE.make_key(content_hash, {"resize_width": resize_width, "resize_height": resize_height})
+
+
+def load_input_image(
+    image_id: str, spool=None, resize_width: Optional[int] = None, resize_height: Optional[int] = None
+):
+    """
+    The normalized working image for `image_id`.
+
+    Served from the input cache when present, which skips validating, decoding and
+    resizing; otherwise decoded from the upload in `spool` and added to the cache. Without
+    an upload, an unknown id is a 404.
+    """
+    from PIL import Image
+
+    if INPUT_CACHE.lookup(image_id) is not None:
+        try:
+            img = Image.open(INPUT_CACHE.path(image_id, "png"))
+            img.load()
+            print(f"[DEBUG] Input cache hit: {image_id}")
+            return img
+        except OSError:
+            pass  # Evicted in the meantime
+
+    if spool is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Unknown or expired image_id: {image_id}"
+        )
+
+    img = decode_image(spool, resize_width, resize_height)
+    if INPUT_CACHE.enabled:
+        INPUT_CACHE.store(image_id, "png", lambda f: img.save(f, "PNG"), {"size": list(img.size)})
+    return img
+
+
+class SessionRegistry:
+    """
+    Open interactive sessions (see `/api/session`), bounded in number.
+
+    Every session holds its working image, canvas and shapes in memory. When all
+    MAX_SESSIONS are taken, a new session evicts the one that has been idle longest;
+    sessions busy with a command are never evicted. All state lives on the event loop.
+    """
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session id -> session dict, least recently active first
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def open(self, session: dict) -> bool:
+        """Register a session, evicting the longest-idle one if needed; False when all are busy."""
+        if len(self._sessions) >= self.max_sessions:
+            idle = next((other for other in self._sessions.values() if not other["busy"]), None)
+            if idle is None:
+                return False
+            self.close(idle["id"])
+            METRICS.inc("geometrize_sessions_evicted_total", reason="capacity")
+            asyncio.ensure_future(idle["websocket"].close(code=1001, reason="Evicted to make room for a new session"))
+        self._sessions[session["id"]] = session
+        METRICS.set("geometrize_sessions_active", len(self._sessions))
+        return True
+
+    def touch(self, session_id: str) -> None:
+        if session_id in self._sessions:
+            self._sessions.move_to_end(session_id)
+
+    def close(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+        METRICS.set("geometrize_sessions_active", len(self._sessions))
+
+
+SESSIONS = SessionRegistry(MAX_SESSIONS)
+
+
+def relabel_shapes(shapes: List[dict], shape_types: Optional[List[str]]) -> None:
+    """
+    Force shape types to match the requested type, in place.
+
+    Primitive's output can be ambiguous (e.g., ellipse for circle, bezier for line).
+    """
+    requested_type = shape_types[0].lower() if shape_types else None
+    if not requested_type:
+        return
+
+    for shape in shapes:
+        if requested_type == "circle" and shape["type"] == "ellipse":
+            # Primitive uses ellipse mode for circle, often resulting in non-circular ellipses.
+            # We assume the user wants it labeled as 'circle' if they requested 'circle'.
+            shape["type"] = "circle"
+        elif requested_type == "rotated_rectangle" and shape["type"] == "rectangle":
+            # Primitive outputs a rect with a transform for rotated_rectangle.
+            # If the transform is missing, it's parsed as a normal rectangle, but we force the label.
+            shape["type"] = "rotated_rectangle"
+        elif requested_type == "line" and shape["type"] in ["bezier", "quadratic_bezier", "cubic_bezier"]:
+            # Primitive uses bezier mode for lines. If requested as line, we force the label.
+            shape["type"] = "line"
+        elif requested_type == "quadratic_bezier" and shape["type"] in ["bezier", "line", "cubic_bezier"]:
+            # If requested as quadratic_bezier, we force the label.
+            shape["type"] = "quadratic_bezier"
+        elif requested_type == "polygon" and shape["type"] == "triangle":
+            # Triangle is a 3-point polygon. If requested as polygon, we force the label.
+            shape["type"] = "polygon"
+
+        # For rotated_ellipse, primitive outputs an ellipse. We force the label.
+        elif requested_type == "rotated_ellipse" and shape["type"] in ["ellipse", "circle"]:
+            shape["type"] = "rotated_ellipse"
+
+
+def output_rendering(output_format: str, svg_profile: str = "primitive", svg_precision: int = 1) -> str:
+    """Name of the rendering a request asks for, used as its file name in the result cache."""
+    if output_format == "svg" and svg_profile == "compact":
+        return f"compact-{svg_precision}.svg"
+    return output_format
+
+
+def result_summary(metadata: dict, params: dict) -> dict:
+    """Everything the JSON output reports about a result besides its shapes."""
+    score = metadata["score"]
+    return {
+        "canvas_size": metadata["canvas_size"],
+        # The background the run used (primitive defaults to the image's mean color);
+        # results cached before it was recorded fall back to the requested one
+        "background_color": metadata.get("background_color") or params["background_color"] or "#ffffff",
+        "shape_types": params["shape_types"] or ["triangle"],
+        "shape_count": params["shape_count"],
+        "shapes_generated": metadata["shapes_generated"],
+        "stop_reason": metadata["stop_reason"],
+        "score": score,
+        "similarity": 1 - score if score is not None else None,
+        "tiles": metadata["tiles"],
+        "engine": metadata.get("engine"),
+        "culling": metadata.get("culling"),
+        "quality": metadata.get("quality"),
+        "checkpoints": metadata.get("checkpoints"),
+        "resources": metadata.get("resources"),
+        "result_id": metadata.get("result_id"),
+        "image_id": metadata.get("image_id"),
+        "opacity": params["opacity"]
+    }
+
+
+def iter_ndjson(svg_path, metadata: dict, params: dict) -> Iterator[bytes]:
+    """
+    Yield a result as newline-delimited JSON, one line at a time.
+
+    The first line is the `result_summary` (canvas size, background color, scores, ...);
+    every further line is one shape, in drawing order. Shapes are read from the SVG (a
+    path or an open binary file) as the lines are consumed, so memory use does not depend
+    on the number of shapes.
+    """
+    yield json.dumps(result_summary(metadata, params), separators=(",", ":")).encode() + b"\n"
+    for shape in iter_svg_shapes(svg_path):
+        relabel_shapes([shape], params["shape_types"])
+        yield json.dumps(shape, separators=(",", ":")).encode() + b"\n"
+
+
+def write_ndjson(destination, svg_path: str, metadata: dict, params: dict) -> None:
+    """Write a result as newline-delimited JSON (see `iter_ndjson`) to the open binary file `destination`."""
+    for line in iter_ndjson(svg_path, metadata, params):
+        destination.write(line)
+
+
+def write_output(
+    destination,
+    svg_path: str,
+    output_format: str,
+    metadata: dict,
+    params: dict,
+    svg_profile: str = "primitive",
+    svg_precision: int = 1,
+) -> None:
+    """Write the response body for `output_format` (see `render_output`) to the open binary file `destination`."""
+    if output_format == "ndjson":
+        try:
+            write_ndjson(destination, svg_path, metadata, params)
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to parse SVG: {str(e)}"
+            )
+        return
+    destination.write(render_output(svg_path, output_format, metadata, params, svg_profile, svg_precision))
+
+
+def render_output(
+    svg_path: str,
+    output_format: str,
+    metadata: dict,
+    params: dict,
+    svg_profile: str = "primitive",
+    svg_precision: int = 1,
+) -> bytes:
+    """
+    Produce the response body for `output_format` from a result SVG.
+
+    `metadata` holds the run information (canvas size, shapes generated, stop reason,
+    score, tiles) and `params` the request parameters echoed in the JSON output.
+    """
+    if output_format == "svg":
+        if svg_profile == "compact":
+            with open(svg_path, "r") as f:
+                return compact_svg(parse_svg_document(f.read()), svg_precision).encode()
+        with open(svg_path, "rb") as f:
+            return f.read()
+
+    if output_format == "png":
+        # Rasterize the shapes with the built-in renderer (no SVG library needed)
+        try:
+            with open(svg_path, "r") as f:
+                document = parse_svg_document(f.read())
+            image = render_document(document, tuple(metadata["canvas_size"]), RENDER_SUPERSAMPLE)
+            return encode_image(image, "png")
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to render PNG: {str(e)}"
+            )
+
+    # Parse SVG and return JSON
+    try:
+        with open(svg_path, "r") as f:
+            svg_content = f.read()
+
+        shapes = parse_svg_shapes(svg_content)
+        relabel_shapes(shapes, params["shape_types"])
+
+        return json_body({"shapes": shapes, **result_summary(metadata, params)})
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to parse SVG: {str(e)}"
+        )
+
+
+def json_body(document: dict) -> bytes:
+    """
+    Serialize a JSON output document, with `resources.bytes_out` set to the size of the result.
+
+    The size is that of the uncompressed body, including the number itself; a few passes
+    settle it, since only the number of its digits can change the length.
+    """
+    body = json.dumps(document, separators=(",", ":")).encode()
+    resources = document.get("resources")
+    if resources is None:
+        return body
+    for _ in range(4):
+        if resources["bytes_out"] == len(body):
+            break
+        resources["bytes_out"] = len(body)
+        body = json.dumps(document, separators=(",", ":")).encode()
+    return body
+
+
+# Output formats whose body reports what producing it cost (the `resources` object)
+RUN_REPORT_FORMATS = ("json", "ndjson")
+
+# Response headers reporting what a request cost; zero run cost when it ran nothing.
+# X-Job-Bytes-Out (the bytes sent, after compression) is added once the body is known.
+RESOURCE_HEADERS = {
+    "wall_ms": "X-Job-Wall-Ms",
+    "cpu_user_ms": "X-Job-CPU-User-Ms",
+    "cpu_system_ms": "X-Job-CPU-System-Ms",
+    "peak_rss_bytes": "X-Job-Peak-RSS-Bytes",
+    "bytes_in": "X-Job-Bytes-In",
+}
+
+
+def output_headers(output_format: str, metadata: dict) -> dict:
+    """Response headers describing a result (shared by fresh and cached responses)."""
+    headers = {
+        "X-Shapes-Generated": str(metadata["shapes_generated"]),
+        "X-Stop-Reason": metadata["stop_reason"],
+    }
+    if metadata["score"] is not None:
+        headers["X-Score"] = f"{metadata['score']:.6f}"
+    if metadata["tiles"] > 1:
+        headers["X-Tiles"] = str(metadata["tiles"])
+    if metadata.get("culling"):
+        headers["X-Shapes-Culled"] = str(metadata["culling"]["shapes_removed"])
+    if metadata.get("quality"):
+        headers["X-Quality-RMSE"] = f"{metadata['quality']['rmse']:.6f}"
+        if "ssim" in metadata["quality"]:
+            headers["X-Quality-SSIM"] = f"{metadata['quality']['ssim']:.6f}"
+    for key, header in RESOURCE_HEADERS.items():
+        value = (metadata.get("resources") or {}).get(key)
+        if value is not None:
+            headers[header] = str(value)
+    if metadata.get("result_id"):
+        headers["X-Result-Id"] = metadata["result_id"]
+    if metadata.get("checkpoints"):
+        headers["X-Checkpoints"] = ",".join(
+            f"{checkpoint['shape_count']}={checkpoint['result_id'] or ''}" for checkpoint in metadata["checkpoints"]
+        )
+    if metadata.get("image_id"):
+        headers["X-Image-Id"] = metadata["image_id"]
+    if output_format in ("svg", "png"):
+        headers["Content-Disposition"] = f"attachment; filename=output.{output_format}"
+    if output_format in COMPRESSIBLE_FORMATS:
+        headers["Vary"] = "Accept-Encoding"
+    return headers
+
+
+async def cached_output_response(
+    request: Request, key: str, output_format: str, metadata: dict, cache_status: str, rendering: Optional[str] = None
+):
+    """Serve a cached output from disk, precompressed when the client accepts it."""
+    rendering = rendering or output_format
+    path = RESULT_CACHE.path(key, rendering)
+    headers = output_headers(output_format, metadata)
+    headers["X-Cache"] = cache_status
+
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"), output_format, os.path.getsize(path))
+    if encoding:
+        path = await run_in_threadpool(RESULT_CACHE.variant, key, rendering, encoding)
+        headers["Content-Encoding"] = encoding
+    headers["X-Job-Bytes-Out"] = str(os.path.getsize(path))
+
+    return FileResponse(path, media_type=OUTPUT_MEDIA_TYPES[output_format], headers=headers)
+
+
+class TemporaryFileResponse(FileResponse):
+    """
+    FileResponse that deletes the directory holding its file once the response is over.
+
+    Unlike a background task, the cleanup also runs when sending fails because the client
+    went away.
+    """
+
+    def __init__(self, path: str, directory: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self.directory = directory
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(shutil.rmtree, self.directory, True)
+
+
+async def temporary_output_response(
+    request: Request, path: str, output_format: str, metadata: dict, cache_status: Optional[str] = None
+):
+    """
+    Serve a freshly generated output file that is not cached (the cache is disabled, or
+    the body reports the run's cost and so cannot be shared with later requests).
+
+    The file is moved out of the request's working directory, which is deleted when the
+    handler returns, into a directory owned by the response.
+    """
+    directory = tempfile.mkdtemp(dir=SCRATCH_DIR)
+    try:
+        served_path = os.path.join(directory, os.path.basename(path))
+        shutil.move(path, served_path)
+        headers = output_headers(output_format, metadata)
+
+        encoding = negotiate_encoding(request.headers.get("accept-encoding"), output_format, os.path.getsize(served_path))
+        if encoding:
+            compressed_path = served_path + CONTENT_ENCODINGS[encoding]
+            with open(compressed_path, "wb") as f:
+                await run_in_threadpool(compress_file, served_path, f, encoding)
+            served_path = compressed_path
+            headers["Content-Encoding"] = encoding
+        headers["X-Job-Bytes-Out"] = str(os.path.getsize(served_path))
+        if cache_status:
+            headers["X-Cache"] = cache_status
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    return TemporaryFileResponse(
+        served_path, directory, media_type=OUTPUT_MEDIA_TYPES[output_format], headers=headers
+    )
+
+
+class StreamedOutputResponse(StreamingResponse):
+    """
+    StreamingResponse that calls `cleanup` with the number of bytes sent once the response
+    is over, also when sending fails because the client went away.
+    """
+
+    def __init__(self, content: Iterator[bytes], cleanup: Callable[[int], None], **kwargs):
+        self.bytes_sent = 0
+        self.cleanup = cleanup
+        super().__init__(self._count(content), **kwargs)
+
+    def _count(self, content: Iterator[bytes]) -> Iterator[bytes]:
+        for chunk in content:
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.cleanup, self.bytes_sent)
+
+
+def ndjson_response(
+    request: Request, svg_file, metadata: dict, params: dict, cache_status: Optional[str],
+    finished: Callable[[int], None],
+) -> StreamedOutputResponse:
+    """
+    Stream a result as NDJSON, converting the shapes of the open SVG file `svg_file` while
+    they are sent.
+
+    Neither the document nor the body is held in memory or written out first, so clients
+    get the first lines right away. The file is closed when the response is over, then
+    `finished` is called with the bytes sent (after compression).
+    """
+    headers = output_headers("ndjson", metadata)
+    if cache_status:
+        headers["X-Cache"] = cache_status
+    chunks = iter_chunks(iter_ndjson(svg_file, metadata, params))
+    # The SVG's size stands in for the body's, which is only known once it has been sent
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"), "ndjson", os.fstat(svg_file.fileno()).st_size)
+    if encoding:
+        chunks = compress_chunks(chunks, encoding)
+        headers["Content-Encoding"] = encoding
+
+    def cleanup(bytes_sent: int) -> None:
+        svg_file.close()
+        finished(bytes_sent)
+
+    return StreamedOutputResponse(chunks, cleanup, media_type=OUTPUT_MEDIA_TYPES["ndjson"], headers=headers)
+
+
+def temporary_ndjson_response(
+    request: Request, svg_path: str, metadata: dict, params: dict, cache_status: Optional[str],
+    finished: Callable[[int], None],
+) -> StreamedOutputResponse:
+    """
+    Stream a freshly generated result as NDJSON (see `ndjson_response`).
+
+    The SVG is moved out of the request's working directory, which is deleted when the
+    handler returns, into a directory that is deleted once the response is over.
+    """
+    directory = tempfile.mkdtemp(dir=SCRATCH_DIR)
+    try:
+        served_path = os.path.join(directory, os.path.basename(svg_path))
+        shutil.move(svg_path, served_path)
+        svg_file = open(served_path, "rb")
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    def cleanup(bytes_sent: int) -> None:
+        shutil.rmtree(directory, ignore_errors=True)
+        finished(bytes_sent)
+
+    return ndjson_response(request, svg_file, metadata, params, cache_status, cleanup)
+
+
+def parse_shape_counts(values: List[str]) -> List[int]:
+    """
+    Parse `shape_count` form/query values into a sorted list of distinct counts.
+
+    Accepts repeated fields and comma-separated lists ("50,100,200"); raises 400 for
+    anything that is not a positive integer or for more than MAX_CHECKPOINTS counts.
+    """
+    try:
+        counts = sorted({int(item) for value in values for item in str(value).split(",") if item.strip()})
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"shape_count must be an integer or a comma-separated list of integers. Got: {','.join(values)}"
+        )
+    if not counts or counts[0] < 1:
+        raise HTTPException(
+            status_code=400,
+            detail=f"shape_count must be at least 1. Got: {','.join(values)}"
+        )
+    if len(counts) > MAX_CHECKPOINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_CHECKPOINTS} shape counts can be requested at once. Got: {len(counts)}"
+        )
+    return counts
+
+
+@app.post("/api/generate")
+async def generate_geometrized_image(
+    request: Request,
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    output_format: str = Form("json"),
+    shape_types: Optional[List[str]] = Form(None),
+    opacity: int = Form(128),
+    shape_count: List[str] = Form(["200"]),
+    mutations_per_step: int = Form(30),
+    random_shapes: int = Form(50),
+    background_color: Optional[str] = Form(None),
+    resize_width: Optional[int] = Form(None),
+    resize_height: Optional[int] = Form(None),
+    time_budget_ms: Optional[int] = Form(None),
+    convergence_threshold: Optional[float] = Form(None),
+    convergence_window: int = Form(20),
+    target_similarity: Optional[float] = Form(None),
+    tile_size: Optional[int] = Form(None),
+    tile_overlap: int = Form(32),
+    svg_profile: str = Form("primitive"),
+    svg_precision: int = Form(1),
+    cull_threshold: Optional[float] = Form(None),
+    target_quality: Optional[float] = Form(None),
+    ssim: bool = Form(False),
+    priority: str = Form("interactive"),
+    engine: str = Form("primitive"),
+    pyramid: bool = Form(False),
+    importance: Optional[str] = Form(None),
+    importance_mask: Optional[UploadFile] = File(None),
+):
+    """
+    Generate a geometrized version of an image.
+
+    Parameters:
+    - image: The image file to transform
+    - image_id: Instead of `image`, the id of an image uploaded before (`image_id` in JSON
+      output, `X-Image-Id` header); its resize was applied when it was uploaded
+    - output_format: One of "svg", "png", "json", or "ndjson" (JSON lines: a summary, then
+      one shape per line, streamed for very large shape counts)
+    - shape_types: List of shape types to use (e.g., ["triangle", "rectangle"])
+    - opacity: Shape opacity (0-255, default: 128)
+    - shape_count: Total number of shapes to generate (default: 200), or several counts
+      ("50,100,200" or repeated fields): one run of the largest count, with the smaller
+      ones returned as checkpoints
+    - mutations_per_step: Number of mutations per generation step (default: 30)
+    - random_shapes: Number of random shapes to test each step (default: 50)
+    - background_color: Hex or RGB color for background (e.g., "#FFFFFF")
+    - resize_width: Resize image width before processing
+    - resize_height: Resize image height before processing
+    - time_budget_ms: Stop adding shapes once this much time has passed and return
+      the shapes generated so far (the achieved count is reported in the response)
+    - convergence_threshold: Stop once the relative error reduction per shape, averaged
+      over the last `convergence_window` shapes, drops below this value (e.g. 0.001)
+    - convergence_window: Number of shapes the convergence check averages over (default: 20)
+    - target_similarity: Stop once the similarity to the input (1 - normalized RMS error,
+      0..1) reaches this value
+    - tile_size: Geometrize images larger than this (in pixels, after resizing) as
+      overlapping tiles of at most this size, in parallel
+    - tile_overlap: Overlap between neighbouring tiles in pixels (default: 32)
+    - svg_profile: "primitive" (primitive's SVG as is) or "compact" (regenerated with
+      quantized coordinates, shared styles and relative path commands)
+    - svg_precision: Decimals kept for coordinates in the compact SVG profile (0-4, default: 1)
+    - target_quality: Add shapes only until the reported quality similarity (1 - RGB RMS
+      error at working resolution, 0..1) reaches this value
+    - ssim: Also report the structural similarity (SSIM) of the result
+    - priority: Scheduling class, "interactive" (default) or "batch"; batch jobs only use
+      capacity that interactive jobs leave free
+    - cull_threshold: Drop shapes whose visible contribution to the final image (mean
+      per-pixel change, 0..1) is below this value, e.g. 0.00005
+    - engine: "primitive" (default, the primitive binary) or "native" (the in-process
+      engine, which also uses `random_shapes` and `mutations_per_step`)
+    - pyramid: With the native engine, search coarse-to-fine: early shapes on a
+      downsampled target, later ones at progressively higher resolution
+    - importance: With the native engine, weight the error and candidate sampling by an
+      importance map: "edges", "saliency", or "mask" (the `importance_mask` upload)
+    - importance_mask: Grayscale image marking important regions (white) for
+      importance="mask", stretched to the image
+
+    Returns:
+    - SVG: SVG image content
+    - PNG: Binary PNG image
+    - JSON: Shape data as JSON array
+    """
+    return await generate_result(
+        request, iter_upload_file(image) if image is not None else None, image_id,
+        iter_upload_file(importance_mask) if importance_mask is not None else None,
+        output_format=output_format,
+        shape_types=shape_types,
+        opacity=opacity,
+        shape_count=parse_shape_counts(shape_count),
+        mutations_per_step=mutations_per_step,
+        random_shapes=random_shapes,
+        background_color=background_color,
+        resize_width=resize_width,
+        resize_height=resize_height,
+        time_budget_ms=time_budget_ms,
+        convergence_threshold=convergence_threshold,
+        convergence_window=convergence_window,
+        target_similarity=target_similarity,
+        tile_size=tile_size,
+        tile_overlap=tile_overlap,
+        svg_profile=svg_profile,
+        svg_precision=svg_precision,
+        cull_threshold=cull_threshold,
+        target_quality=target_quality,
+        ssim=ssim,
+        priority=priority,
+        engine=engine,
+        pyramid=pyramid,
+        importance=importance,
+    )
+
+
+@app.post("/api/generate/raw")
+async def generate_from_raw_body(
+    request: Request,
+    output_format: str = Query("json"),
+    shape_types: Optional[List[str]] = Query(None),
+    opacity: int = Query(128),
+    shape_count: List[str] = Query(["200"]),
+    mutations_per_step: int = Query(30),
+    random_shapes: int = Query(50),
+    background_color: Optional[str] = Query(None),
+    resize_width: Optional[int] = Query(None),
+    resize_height: Optional[int] = Query(None),
+    time_budget_ms: Optional[int] = Query(None),
+    convergence_threshold: Optional[float] = Query(None),
+    convergence_window: int = Query(20),
+    target_similarity: Optional[float] = Query(None),
+    tile_size: Optional[int] = Query(None),
+    tile_overlap: int = Query(32),
+    svg_profile: str = Query("primitive"),
+    svg_precision: int = Query(1),
+    cull_threshold: Optional[float] = Query(None),
+    target_quality: Optional[float] = Query(None),
+    ssim: bool = Query(False),
+    priority: str = Query("interactive"),
+    engine: str = Query("primitive"),
+    pyramid: bool = Query(False),
+    importance: Optional[str] = Query(None),
+):
+    """
+    Generate a geometrized version of an image sent as the raw request body.
+
+    Same as /api/generate, but the body is the image itself (`Content-Type:
+    application/octet-stream` or `image/*`) and the parameters are passed in the query
+    string. The body is streamed straight into the upload spool, with no multipart
+    parsing or buffering in between. There is no `importance_mask`; computed importance
+    maps work as usual.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type != "application/octet-stream" and not content_type.startswith("image/"):
+        raise HTTPException(
+            status_code=415,
+            detail=f"Content-Type must be application/octet-stream or image/*. Got: {content_type or 'none'}"
+        )
+    return await generate_result(
+        request, request.stream(), None, None,
+        output_format=output_format,
+        shape_types=shape_types,
+        opacity=opacity,
+        shape_count=parse_shape_counts(shape_count),
+        mutations_per_step=mutations_per_step,
+        random_shapes=random_shapes,
+        background_color=background_color,
+        resize_width=resize_width,
+        resize_height=resize_height,
+        time_budget_ms=time_budget_ms,
+        convergence_threshold=convergence_threshold,
+        convergence_window=convergence_window,
+        target_similarity=target_similarity,
+        tile_size=tile_size,
+        tile_overlap=tile_overlap,
+        svg_profile=svg_profile,
+        svg_precision=svg_precision,
+        cull_threshold=cull_threshold,
+        target_quality=target_quality,
+        ssim=ssim,
+        priority=priority,
+        engine=engine,
+        pyramid=pyramid,
+        importance=importance,
+    )
+
+
+async def generate_result(
+    request: Request,
+    upload,
+    image_id: Optional[str],
+    importance_mask=None,
+    *,
+    output_format: str,
+    shape_types: Optional[List[str]],
+    opacity: int,
+    shape_count: List[int],
+    mutations_per_step: int,
+    random_shapes: int,
+    background_color: Optional[str],
+    resize_width: Optional[int],
+    resize_height: Optional[int],
+    time_budget_ms: Optional[int],
+    convergence_threshold: Optional[float],
+    convergence_window: int,
+    target_similarity: Optional[float],
+    tile_size: Optional[int],
+    tile_overlap: int,
+    svg_profile: str,
+    svg_precision: int,
+    cull_threshold: Optional[float],
+    target_quality: Optional[float],
+    ssim: bool,
+    priority: str,
+    engine: str,
+    pyramid: bool,
+    importance: Optional[str],
+) -> Response:
+    """
+    Shared implementation of /api/generate and /api/generate/raw.
+
+    `upload` is an async iterator over the bytes of the uploaded image, or None when the
+    image is referenced by `image_id`, and `importance_mask` likewise for the optional
+    importance mask. `shape_count` is the parsed list of requested counts (see
+    `parse_shape_counts`); the other parameters are those of /api/generate.
+    """
+
+    if (upload is None) == (image_id is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Exactly one of 'image' or 'image_id' must be given"
+        )
+    if image_id is not None and (resize_width or resize_height):
+        raise HTTPException(
+            status_code=400,
+            detail="resize_width and resize_height cannot be combined with image_id (it is already resized)"
+        )
+
+    # Validate output format
+    if output_format not in ["svg", "png", "json", "ndjson"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid output_format. Must be one of: svg, png, json, ndjson. Got: {output_format}"
+        )
+
+    # Validate opacity
+    if not (0 <= opacity <= 255):
+        raise HTTPException(
+            status_code=400,
+            detail=f"opacity must be between 0 and 255. Got: {opacity}"
+        )
+
+    # Several shape counts: one run of the largest, the others are checkpoints along the way
+    checkpoint_counts = shape_count[:-1]
+    shape_count = shape_count[-1]
+
+    import subprocess
+
+    request_started = time.monotonic()
+
+    # Validate time_budget_ms
+    if time_budget_ms is not None and time_budget_ms < 1:
+        raise HTTPException(
+            status_code=400,
+            detail=f"time_budget_ms must be at least 1. Got: {time_budget_ms}"
+        )
+
+    # Validate early-stopping parameters
+    if convergence_threshold is not None and convergence_threshold < 0:
+        raise HTTPException(
+            status_code=400,
+            detail=f"convergence_threshold must be non-negative. Got: {convergence_threshold}"
+        )
+    if convergence_window < 1:
+        raise HTTPException(
+            status_code=400,
+            detail=f"convergence_window must be at least 1. Got: {convergence_window}"
+        )
+    if target_similarity is not None and not (0 < target_similarity <= 1):
+        raise HTTPException(
+            status_code=400,
+            detail=f"target_similarity must be between 0 and 1. Got: {target_similarity}"
+        )
+    if target_quality is not None and not (0 < target_quality <= 1):
+        raise HTTPException(
+            status_code=400,
+            detail=f"target_quality must be between 0 and 1. Got: {target_quality}"
+        )
+    if target_quality is not None and target_similarity is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="target_quality and target_similarity cannot be combined"
+        )
+
+    # Validate scheduling class
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid priority. Must be one of: {', '.join(PRIORITY_CLASSES)}. Got: {priority}"
+        )
+
+    # Validate SVG output parameters
+    if svg_profile not in SVG_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid svg_profile. Must be one of: {', '.join(SVG_PROFILES)}. Got: {svg_profile}"
+        )
+    if not (0 <= svg_precision <= 4):
+        raise HTTPException(
+            status_code=400,
+            detail=f"svg_precision must be between 0 and 4. Got: {svg_precision}"
+        )
+
+    # Validate culling threshold
+    if cull_threshold is not None and not (0 <= cull_threshold < 1):
+        raise HTTPException(
+            status_code=400,
+            detail=f"cull_threshold must be between 0 and 1. Got: {cull_threshold}"
+        )
+    if cull_threshold is not None and output_format == "ndjson":
+        # Culling weighs every shape against all later ones, so it needs the whole result in memory
+        raise HTTPException(
+            status_code=400,
+            detail="cull_threshold cannot be combined with output_format=ndjson"
+        )
+
+    # Validate engine selection
+    if engine not in ENGINES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid engine. Must be one of: {', '.join(ENGINES)}. Got: {engine}"
+        )
+    if pyramid and engine != "native":
+        raise HTTPException(
+            status_code=400,
+            detail="pyramid requires engine=native"
+        )
+    if engine == "native" and tile_size is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="tile_size cannot be combined with engine=native"
+        )
+    if engine == "native" and opacity < 1:
+        # primitive reads 0 as "pick alpha automatically"; the native engine has no such mode
+        raise HTTPException(
+            status_code=400,
+            detail=f"opacity must be between 1 and 255 with engine=native. Got: {opacity}"
+        )
+
+    # Validate importance weighting (an uploaded mask implies importance=mask)
+    if importance is None:
+        importance = "mask" if importance_mask is not None else "none"
+    if importance not in IMPORTANCE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid importance. Must be one of: {', '.join(IMPORTANCE_MODES)}. Got: {importance}"
+        )
+    if (importance == "mask") != (importance_mask is not None):
+        raise HTTPException(
+            status_code=400,
+            detail="importance_mask must be given exactly when importance=mask"
+        )
+    if importance != "none" and engine != "native":
+        raise HTTPException(
+            status_code=400,
+            detail="importance requires engine=native"
+        )
+
+    # Validate tiling parameters
+    if tile_size is not None and tile_size < 64:
+        raise HTTPException(
+            status_code=400,
+            detail=f"tile_size must be at least 64. Got: {tile_size}"
+        )
+    if tile_overlap < 0 or (tile_size is not None and tile_overlap >= tile_size // 2):
+        raise HTTPException(
+            status_code=400,
+            detail=f"tile_overlap must be between 0 and half of tile_size. Got: {tile_overlap}"
+        )
+
+    # Everything that affects the generated shapes besides the working image (identified by
+    # image_id, which includes the resize); output_format only selects a rendering
+    params = {
+        "shape_types": shape_types,
+        "opacity": opacity,
+        "shape_count": checkpoint_counts + [shape_count] if checkpoint_counts else shape_count,
+        "mutations_per_step": mutations_per_step,
+        "random_shapes": random_shapes,
+        "background_color": background_color,
+        "time_budget_ms": time_budget_ms,
+        "convergence_threshold": convergence_threshold,
+        "convergence_window": convergence_window,
+        "target_similarity": target_similarity,
+        "target_quality": target_quality,
+        "ssim": ssim,
+        "tile_size": tile_size,
+        "tile_overlap": tile_overlap,
+        "cull_threshold": cull_threshold,
+        "engine": engine,
+        "pyramid": pyramid,
+        "importance": importance,
+    }
+
+    flight = None
+    # Shape mode label of the request's resource accounting
+    usage_mode = (shape_types[0] if shape_types else "triangle").lower()
+    try:
+        # Stream the upload into a bounded spool, then validate and decode it
+        spool = None
+        mask_spool = None
+        mask = None
+        bytes_in = 0
+        if upload is not None:
+            spool, content_hash = await spool_upload(upload)
+            image_id = image_id_for(content_hash, resize_width, resize_height)
+            bytes_in += spool_size(spool)
+        try:
+            if importance_mask is not None:
+                mask_spool, params["importance_mask"] = await spool_upload(importance_mask)
+                bytes_in += spool_size(mask_spool)
+            cache_key = RESULT_CACHE.make_key(image_id, params)
+            rendering = output_rendering(output_format, svg_profile, svg_precision)
+            cache_status = "HIT"
+            while True:
+                metadata = await run_in_threadpool(RESULT_CACHE.lookup, cache_key)
+                if metadata is not None:
+                    # Nothing runs for this request, so neither its body nor its headers
+                    # repeat the cost of the run that produced the result
+                    if output_format == "ndjson":
+                        # Streamed from the stored SVG; opened now, so eviction cannot pull it away
+                        print(f"[DEBUG] Cache {cache_status.lower()}: {cache_key}")
+                        return ndjson_response(
+                            request, open(RESULT_CACHE.path(cache_key, "svg"), "rb"),
+                            {**metadata, "resources": cached_resources(bytes_in)}, params, cache_status,
+                            functools.partial(record_job_usage, request, usage_mode, None, bytes_in, None),
+                        )
+                    if not RESULT_CACHE.has(cache_key, rendering):
+                        content = functools.partial(
+                            write_output, svg_path=RESULT_CACHE.path(cache_key, "svg"), output_format=output_format,
+                            metadata={**metadata, "resources": cached_resources(None)}, params=params,
+                            svg_profile=svg_profile, svg_precision=svg_precision,
+                        )
+                        await run_in_threadpool(RESULT_CACHE.store, cache_key, rendering, content, metadata)
+                    print(f"[DEBUG] Cache {cache_status.lower()}: {cache_key}")
+                    response = await cached_output_response(
+                        request, cache_key, output_format, {**metadata, "resources": cached_resources(bytes_in)},
+                        cache_status, rendering,
+                    )
+                    record_job_usage(request, usage_mode, None, bytes_in, response)
+                    return response
+
+                # An identical request is already computing this result: wait for it to land
+                # in the cache instead of running the same job again
+                leader = IN_FLIGHT.get(cache_key) if RESULT_CACHE.enabled else None
+                if leader is None:
+                    break
+                print(f"[DEBUG] Waiting for identical in-flight job: {cache_key}")
+                await leader.wait(request)
+                METRICS.inc("geometrize_jobs_coalesced_total")
+                cache_status = "COALESCED"
+            if RESULT_CACHE.enabled:
+                flight = IN_FLIGHT.lead(cache_key, request)
+
+            # The working image, decoded and resized once per upload and then reused
+            img = await run_in_threadpool(load_input_image, image_id, spool, resize_width, resize_height)
+            if mask_spool is not None:
+                mask = await run_in_threadpool(decode_image, mask_spool)
+        finally:
+            if spool is not None:
+                spool.close()
+            if mask_spool is not None:
+                mask_spool.close()
+
+        # Create temporary directory for processing
+        with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmpdir:
+            # Save input image (a copy of the cached one when there is one, saving the PNG encode)
+            input_path = os.path.join(tmpdir, "input.png")
+            try:
+                shutil.copyfile(INPUT_CACHE.path(image_id, "png"), input_path)
+            except OSError:
+                img.save(input_path, "PNG")
+
+            # Use the size of the image after potential resizing for the primitive output size
+            # This addresses the "Canvas Size Issue" from the documentation
+            output_size = max(img.size) 
+
+            # Determine shape mode
+            shape_mode = 1  # Default to triangle
+            shape_type = "triangle"
+            if shape_types and len(shape_types) > 0:
+                # Use the first shape type specified
+                shape_type = shape_types[0].lower()
+                if shape_type in SHAPE_TYPE_MAPPING:
+                    shape_mode = SHAPE_TYPE_MAPPING[shape_type]
+                else:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Unknown shape type: {shape_type}. Supported types: {list(SHAPE_TYPE_MAPPING.keys())}"
+                    )
+
+            # Admission control: turn the job away now rather than let it queue for too long
+            tiled = tile_size is not None and max(img.size) > tile_size
+            estimate = COST_MODEL.estimate(
+                shape_mode, output_format, img.size[0], img.size[1], shape_count, time_budget_ms,
+                tile_size, tile_overlap, engine, pyramid, importance,
+            )
+            admission = admission_check(priority, estimate["total_seconds"])
+            if not admission["admitted"]:
+                METRICS.inc("geometrize_jobs_rejected_total", **{"class": priority})
+                raise HTTPException(
+                    status_code=429,
+                    detail=(
+                        f"Server busy: estimated queue wait {admission['estimated_queue_wait_seconds']:.0f} s "
+                        f"exceeds {admission['max_queue_wait_seconds']} s for {priority} jobs"
+                    ),
+                    headers={"Retry-After": str(admission["retry_after_seconds"])},
+                )
+
+            # Prepare output paths
+            svg_output_path = os.path.join(tmpdir, "output.svg")
+
+            # Get primitive binary path (the native engine runs without it)
+            try:
+                primitive_bin = get_primitive_binary() if engine == "primitive" else None
+            except RuntimeError as e:
+                raise HTTPException(
+                    status_code=500,
+                    detail=str(e)
+                )
+
+            # Runs that may stop early write intermediate snapshots to fall back on
+            deadline = None
+            stop_check = None
+            if time_budget_ms is not None:
+                deadline = request_started + time_budget_ms / 1000
+            if target_quality is not None:
+                # Stop on primitive's live score once it corresponds to the requested quality
+                target_similarity = primitive_similarity(target_quality)
+            if convergence_threshold is not None or target_similarity is not None:
+                stop_check = convergence_check(convergence_window, convergence_threshold, target_similarity)
+
+            # Execute primitive
+            try:
+                # Wait for a slot of the job's priority class, fairly shared between clients
+                # Requests waiting for the same result keep the job alive when this client leaves
+                watched = flight or request
+                # The native engine is single-threaded and only needs one of the budget's threads
+                async with SCHEDULER.slot(
+                    priority, client_key(request), watched, estimate["total_seconds"],
+                    max_threads=1 if engine == "native" else None,
+                ) as threads:
+                    # The thread count depends on how busy the server is once the job starts
+                    threads = primitive_threads(threads)
+                    if engine == "native":
+                        # In-process engine (single-threaded), optionally searching coarse-to-fine
+                        job = functools.partial(
+                            run_native, img, svg_output_path, shape_count, shape_type, opacity,
+                            background_color, random_shapes, mutations_per_step, pyramid=pyramid,
+                            importance=importance, importance_mask=mask, deadline=deadline, stop_check=stop_check,
+                        )
+                    elif tiled:
+                        # Large image: geometrize overlapping tiles in parallel and merge them
+                        job = functools.partial(
+                            run_tiled, primitive_bin, img, tmpdir, shape_count, shape_mode, opacity,
+                            background_color, tile_size, tile_overlap, deadline=deadline, stop_check=stop_check,
+                            threads=threads,
+                        )
+                    else:
+                        # Build primitive command
+                        cmd = primitive_command(
+                            primitive_bin, input_path, svg_output_path, shape_count, shape_mode, opacity,
+                            output_size, background_color, threads,
+                        )
+                        snapshot_dir = None
+                        if deadline is not None or stop_check is not None:
+                            snapshot_dir = os.path.join(tmpdir, "frames")
+                            cmd.extend(snapshot_args(snapshot_dir, shape_count))
+
+                        # Print debug info
+                        print(f"[DEBUG] Running command: {' '.join(cmd)}")
+                        print(f"[DEBUG] System: {platform.system()}")
+                        print(f"[DEBUG] Input path: {input_path}")
+                        print(f"[DEBUG] Output path: {svg_output_path}")
+
+                        job = functools.partial(
+                            run_primitive, cmd, shape_count, svg_output_path,
+                            snapshot_dir=snapshot_dir, deadline=deadline, stop_check=stop_check,
+                        )
+
+                    METRICS.inc("geometrize_jobs_started_total")
+                    result = await run_until_disconnected(watched, job)
+
+                print(f"[DEBUG] Return code: {result['returncode']}")
+                if result["stdout"]:
+                    print(f"[DEBUG] Stdout: {result['stdout']}")
+                if result["stderr"]:
+                    print(f"[DEBUG] Stderr: {result['stderr']}")
+                if result["stop_reason"] == "cancelled":
+                    METRICS.inc("geometrize_jobs_cancelled_total")
+                    # The CPU time spent until the cancellation is accounted all the same
+                    record_job_usage(request, usage_mode, run_resources(result, bytes_in), bytes_in)
+                    # Nobody is listening any more; 499 is the conventional "client closed request"
+                    raise HTTPException(
+                        status_code=499,
+                        detail="Client disconnected, job cancelled"
+                    )
+
+                print(
+                    f"[DEBUG] Shapes generated: {result['shapes_generated']} "
+                    f"(stop reason: {result['stop_reason']}, {result['elapsed_ms']} ms)"
+                )
+
+                if result["returncode"] != 0:
+                    error_detail = f"Primitive execution failed with code {result['returncode']}. Error: {result['stderr']}"
+                    print(f"[ERROR] {error_detail}")
+                    raise HTTPException(
+                        status_code=500,
+                        detail=error_detail
+                    )
+            except subprocess.TimeoutExpired:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Image processing timed out (>{PRIMITIVE_TIMEOUT_SECONDS} seconds)"
+                )
+            except FileNotFoundError as e:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Primitive binary not found: {str(e)}. Please ensure primitive is installed and in PATH."
+                )
+
+            if not tiled and result["shapes_generated"] > 0:
+                COST_MODEL.record(
+                    COST_MODEL.run_key(shape_mode, engine, pyramid, importance), COST_MODEL.run_units(img.size[0], img.size[1], result["shapes_generated"]),
+                    result["elapsed_ms"] / 1000,
+                )
+
+            finish_started = time.monotonic()
+            svg_output_path = result["svg_path"]
+            culling = None
+            if cull_threshold is not None:
+                # Post-pass: drop shapes that are hidden by later ones or change next to nothing
+                culled_path = os.path.join(tmpdir, "culled.svg")
+                culling = await run_in_threadpool(cull_svg, svg_output_path, img, cull_threshold, culled_path)
+                svg_output_path = culled_path
+                print(
+                    f"[DEBUG] Culled {culling['shapes_removed']} of {culling['shapes_before']} shapes "
+                    f"(score {culling['score_before']} -> {culling['score_after']})"
+                )
+
+            quality = await run_in_threadpool(result_quality, svg_output_path, img, ssim)
+            background = (await run_in_threadpool(svg_header, result["svg_path"]))["background_color"]
+            resources = run_resources(result, bytes_in)
+            stop_reason = result["stop_reason"]
+            if target_quality is not None and stop_reason == "target_similarity":
+                stop_reason = "target_quality"
+
+            checkpoints = None
+            if checkpoint_counts:
+                # The smaller counts are prefixes of this run; each is stored as a result of its own
+                checkpoints = []
+                written = await run_in_threadpool(write_checkpoints, result["svg_path"], checkpoint_counts, tmpdir)
+                for count, checkpoint_path, shapes in written:
+                    checkpoint_culling = None
+                    if cull_threshold is not None:
+                        culled_path = os.path.join(tmpdir, f"checkpoint_{count}_culled.svg")
+                        checkpoint_culling = await run_in_threadpool(
+                            cull_svg, checkpoint_path, img, cull_threshold, culled_path
+                        )
+                        checkpoint_path = culled_path
+                    checkpoint_quality = await run_in_threadpool(result_quality, checkpoint_path, img, ssim)
+                    checkpoint_key = RESULT_CACHE.make_key(image_id, {**params, "shape_count": count})
+                    checkpoint = {
+                        "shape_count": count,
+                        "shapes_generated": shapes,
+                        "stop_reason": "shape_count" if shapes == count else stop_reason,
+                        # On primitive's scale, like the score of a run
+                        "score": round(checkpoint_quality["rmse"] * math.sqrt(3) / 2, 6),
+                        "quality": checkpoint_quality,
+                        "result_id": checkpoint_key if RESULT_CACHE.enabled else None,
+                    }
+                    checkpoints.append(checkpoint)
+                    if RESULT_CACHE.enabled:
+                        await run_in_threadpool(
+                            RESULT_CACHE.store_file, checkpoint_key, "svg", checkpoint_path, {
+                                "canvas_size": list(img.size),
+                                "background_color": background,
+                                "shapes_generated": shapes,
+                                "stop_reason": checkpoint["stop_reason"],
+                                "score": checkpoint["score"],
+                                "tiles": result.get("tiles", 1),
+                                "engine": {
+                                    "name": engine, "pyramid": pyramid, "importance": importance,
+                                    "pixels_evaluated": None,
+                                },
+                                "culling": checkpoint_culling,
+                                "quality": checkpoint_quality,
+                                "result_id": checkpoint_key,
+                                "image_id": image_id if INPUT_CACHE.enabled else None,
+                            }
+                        )
+
+            metadata = {
+                "canvas_size": list(img.size),
+                "background_color": background,
+                "shapes_generated": result["shapes_generated"],
+                "stop_reason": stop_reason,
+                "score": result["score"],
+                "tiles": result.get("tiles", 1),
+                "engine": {
+                    "name": engine, "pyramid": pyramid, "importance": importance,
+                    "pixels_evaluated": result.get("pixels_evaluated"),
+                },
+                "culling": culling,
+                "quality": quality,
+                "checkpoints": checkpoints,
+                "resources": resources,
+                # Results can be re-rendered at other sizes through POST /api/render while cached
+                "result_id": cache_key if RESULT_CACHE.enabled else None,
+                # ... and the input reused with other parameters without uploading it again
+                "image_id": image_id if INPUT_CACHE.enabled else None,
+            }
+            # primitive's SVG is served as the file it wrote; other renderings are built from it
+            output_path = svg_output_path
+            if rendering not in ("svg", "ndjson"):
+                output_path = os.path.join(tmpdir, f"output.{rendering}")
+                with open(output_path, "wb") as f:
+                    await run_in_threadpool(
+                        write_output, f, svg_output_path, output_format, metadata, params, svg_profile, svg_precision
+                    )
+            COST_MODEL.record(
+                f"finish:{output_format}",
+                COST_MODEL.finish_units(output_format, img.size[0], img.size[1], result["shapes_generated"]),
+                time.monotonic() - finish_started,
+            )
+
+            if RESULT_CACHE.enabled:
+                # The SVG is stored alongside every other format so they can be derived later
+                await run_in_threadpool(RESULT_CACHE.store_file, cache_key, "svg", svg_output_path, metadata)
+                if rendering != "svg" and output_format not in RUN_REPORT_FORMATS:
+                    await run_in_threadpool(RESULT_CACHE.store_file, cache_key, rendering, output_path, metadata)
+                # The result is cached: requests waiting for it can be served now
+                if flight is not None:
+                    flight.finish()
+
+            if output_format == "ndjson":
+                # Converted from the SVG while it is sent
+                return temporary_ndjson_response(
+                    request, svg_output_path, metadata, params, "MISS" if RESULT_CACHE.enabled else None,
+                    functools.partial(record_job_usage, request, usage_mode, resources, bytes_in, None),
+                )
+            if not RESULT_CACHE.enabled or output_format in RUN_REPORT_FORMATS:
+                # This body reports the run's cost; the cached one is derived on the first hit
+                response = await temporary_output_response(
+                    request, output_path, output_format, metadata, "MISS" if RESULT_CACHE.enabled else None
+                )
+            else:
+                response = await cached_output_response(request, cache_key, output_format, metadata, "MISS", rendering)
+            record_job_usage(request, usage_mode, resources, bytes_in, response)
+            return response
+
+    except HTTPException as e:
+        if flight is not None:
+            flight.finish(e)
+        raise
+    except Exception as e:
+        print(f"[ERROR] Unexpected error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        error = HTTPException(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
         )
+        if flight is not None:
+            flight.finish(error)
+        raise error
+    finally:
+        # Cancelled or otherwise gone without a result: waiting requests try again themselves
+        if flight is not None:
+            flight.finish()
+
+
+@app.post("/api/generate/sequence")
+async def generate_sequence(
+    request: Request,
+    frames: List[UploadFile] = File(...),
+    output_format: str = Form("json"),
+    shape_types: Optional[List[str]] = Form(None),
+    opacity: int = Form(128),
+    shape_count: int = Form(200),
+    mutations_per_step: int = Form(30),
+    random_shapes: int = Form(50),
+    background_color: Optional[str] = Form(None),
+    resize_width: Optional[int] = Form(None),
+    resize_height: Optional[int] = Form(None),
+    change_threshold: int = Form(SEQUENCE_CHANGE_THRESHOLD),
+    priority: str = Form("interactive"),
+):
+    """
+    Geometrize a sequence of frames, each seeded from the previous frame's shapes.
+
+    Parameters:
+    - frames: The frames in order, as several image files and/or animations (GIF, APNG,
+      animated WebP); all frames are scaled to the size of the first. Each file may be up
+      to GEOMETRIZE_MAX_UPLOAD_BYTES and all of them together up to
+      GEOMETRIZE_MAX_SEQUENCE_UPLOAD_BYTES (256 MiB)
+    - output_format: "json" (shapes per frame) or "svg" (an SVG document per frame)
+    - change_threshold: Luma change (0-255) above which a pixel counts as changed since
+      the previous frame (default: 16)
+    - shape_types, opacity, shape_count, mutations_per_step, random_shapes,
+      background_color, resize_width, resize_height, priority: As for /api/generate
+
+    Frames are geometrized by the native engine. Every frame after the first keeps the
+    shapes of unchanged regions and re-optimizes only where the image changed, which is
+    much cheaper than a run per frame and does not flicker. Returns JSON with a result
+    per frame; sequences are not cached.
+    """
+    if output_format not in ["svg", "json"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid output_format. Must be one of: svg, json. Got: {output_format}"
+        )
+    if not (1 <= opacity <= 255):
+        raise HTTPException(
+            status_code=400,
+            detail=f"opacity must be between 1 and 255. Got: {opacity}"
+        )
+    if shape_count < 1:
+        raise HTTPException(
+            status_code=400,
+            detail=f"shape_count must be at least 1. Got: {shape_count}"
+        )
+    if not (0 <= change_threshold <= 255):
+        raise HTTPException(
+            status_code=400,
+            detail=f"change_threshold must be between 0 and 255. Got: {change_threshold}"
+        )
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid priority. Must be one of: {', '.join(PRIORITY_CLASSES)}. Got: {priority}"
+        )
+    shape_type = (shape_types[0] if shape_types else "triangle").lower()
+    if shape_type not in SHAPE_TYPE_MAPPING:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown shape type: {shape_type}. Supported types: {list(SHAPE_TYPE_MAPPING.keys())}"
+        )
+
+    spools = []
+    try:
+        frame_count = 0
+        size = None
+        for upload in frames:
+            spool, _ = await spool_upload(iter_upload_file(upload))
+            spools.append(spool)
+            probed_size, spool_frames = await run_in_threadpool(probe_frames, spool)
+            size = size or probed_size
+            frame_count += spool_frames
+            if frame_count > MAX_SEQUENCE_FRAMES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Too many frames: at most {MAX_SEQUENCE_FRAMES} per sequence"
+                )
+
+        # Admission control, with later frames estimated at a fraction of a full run
+        width, height = resized_dimensions(*size, resize_width, resize_height) or size
+        estimate = COST_MODEL.estimate(
+            SHAPE_TYPE_MAPPING[shape_type], output_format, width, height, shape_count, engine="native",
+        )
+        cost = estimate["total_seconds"] * (1 + SEQUENCE_FRAME_SHARE * (frame_count - 1))
+        admission = admission_check(priority, cost)
+        if not admission["admitted"]:
+            METRICS.inc("geometrize_jobs_rejected_total", **{"class": priority})
+            raise HTTPException(
+                status_code=429,
+                detail=(
+                    f"Server busy: estimated queue wait {admission['estimated_queue_wait_seconds']:.0f} s "
+                    f"exceeds {admission['max_queue_wait_seconds']} s for {priority} jobs"
+                ),
+                headers={"Retry-After": str(admission["retry_after_seconds"])},
+            )
+
+        async with SCHEDULER.slot(priority, client_key(request), request, cost, max_threads=1):
+            job = functools.partial(
+                run_sequence, iter_frames(spools, resize_width, resize_height), shape_count, shape_type,
+                opacity, background_color, random_shapes, mutations_per_step, change_threshold, output_format,
+            )
+            METRICS.inc("geometrize_jobs_started_total")
+            result = await run_until_disconnected(request, job)
+    finally:
+        for spool in spools:
+            spool.close()
+
+    if result["stop_reason"] == "cancelled":
+        METRICS.inc("geometrize_jobs_cancelled_total")
+        raise HTTPException(
+            status_code=499,
+            detail="Client disconnected, job cancelled"
+        )
+    shapes_added = sum(frame["shapes_added"] for frame in result["frames"])
+    COST_MODEL.record(
+        COST_MODEL.run_key(SHAPE_TYPE_MAPPING[shape_type], "native"),
+        COST_MODEL.run_units(width, height, shapes_added), result["elapsed_ms"] / 1000,
+    )
+    METRICS.inc("geometrize_sequence_frames_total", len(result["frames"]))
+    print(
+        f"[DEBUG] Sequence: {len(result['frames'])} frames, {shapes_added} shapes added "
+        f"({result['elapsed_ms']} ms)"
+    )
+    return JSONResponse({
+        "canvas_size": result["canvas_size"],
+        "background_color": result["background_color"],
+        "shape_types": [shape_type],
+        "shape_count": shape_count,
+        "opacity": opacity,
+        "frame_count": len(result["frames"]),
+        "shapes_added": shapes_added,
+        "elapsed_ms": result["elapsed_ms"],
+        "frames": result["frames"],
+    })
+
+
+@app.post("/api/render")
+async def render_result(request: Request, payload: dict = Body(...)):
+    """
+    Render a geometrized result as a PNG or WebP image at any size.
+
+    The JSON body holds either:
+    - result_id: The id of a cached result (`result_id` in JSON output, `X-Result-Id` header)
+    - result: A JSON result of /api/generate (at least `shapes` and `canvas_size`); it is
+      cached like a generated result, so later renders can pass the returned `X-Result-Id`
+
+    and the target size, all optional:
+    - width / height: Fit the render inside this box, keeping the aspect ratio
+    - scale: Multiply the result's canvas size by this factor (e.g. 2 for retina)
+    - format: "png" (default) or "webp"
+
+    Renders are cached per result and size, so thumbnails and retina variants never
+    start another primitive run.
+    """
+    image_format = payload.get("format", "png")
+    if image_format not in RENDER_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid format. Must be one of: {', '.join(RENDER_FORMATS)}. Got: {image_format}"
+        )
+
+    result_id = payload.get("result_id")
+    result = payload.get("result")
+    if (result_id is None) == (result is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Exactly one of 'result_id' or 'result' must be given"
+        )
+
+    if result_id is not None:
+        metadata = await run_in_threadpool(RESULT_CACHE.lookup, str(result_id))
+        if metadata is None or not RESULT_CACHE.has(str(result_id), "svg"):
+            raise HTTPException(
+                status_code=404,
+                detail=f"Unknown or expired result_id: {result_id}"
+            )
+        key = str(result_id)
+        canvas_width, canvas_height = metadata["canvas_size"]
+    else:
+        from PIL import ImageColor
+
+        try:
+            shapes = result["shapes"]
+            canvas_width, canvas_height = (float(v) for v in result["canvas_size"])
+            background_color = result.get("background_color") or "#ffffff"
+            ImageColor.getrgb(background_color)
+            for shape in shapes:
+                if "points" in shape:
+                    # Stroked paths need a start and an end, filled polygons at least a triangle
+                    points = shape["points"]
+                    minimum = 2 if "stroke_width" in shape else 3
+                    if not isinstance(points, list) or len(points) < minimum:
+                        raise ValueError(f"{shape.get('type', 'shape')} needs at least {minimum} points")
+                    for point in points:
+                        if not (
+                            isinstance(point, list) and len(point) == 2
+                            and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in point)
+                        ):
+                            raise ValueError(f"points must be [x, y] pairs of numbers, got {point!r}")
+                shape_geometry(shape)
+                ImageColor.getrgb(shape["color"])
+                opacity = shape["opacity"]
+                if not isinstance(opacity, int) or isinstance(opacity, bool) or not (0 <= opacity <= 255):
+                    raise ValueError(f"opacity must be an integer between 0 and 255, got {opacity!r}")
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid result: {str(e)}"
+            )
+        if canvas_width <= 0 or canvas_height <= 0:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid result: canvas_size must be positive"
+            )
+        content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+        key = RESULT_CACHE.make_key(content_hash, {"source": "json"})
+        metadata = {"canvas_size": [canvas_width, canvas_height], "background_color": background_color}
+
+    # Target size: fit inside width x height, or scale the canvas, keeping the aspect ratio
+    width, height, scale = payload.get("width"), payload.get("height"), payload.get("scale")
+    try:
+        factor = float(scale) if scale is not None else 1.0
+        if width is not None or height is not None:
+            factor = min(
+                int(width) / canvas_width if width is not None else math.inf,
+                int(height) / canvas_height if height is not None else math.inf,
+            )
+    except (TypeError, ValueError) as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"width, height and scale must be numbers: {str(e)}"
+        )
+    size = (max(1, round(canvas_width * factor)), max(1, round(canvas_height * factor)))
+    if factor <= 0 or max(size) > MAX_IMAGE_DIMENSION or size[0] * size[1] > MAX_IMAGE_PIXELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Render size {size[0]}x{size[1]} is outside the limits "
+                   f"({MAX_IMAGE_DIMENSION} px per side, {MAX_IMAGE_PIXELS} pixels)"
+        )
+
+    rendering = f"render-{size[0]}x{size[1]}.{image_format}"
+    headers = {
+        "Content-Disposition": f"attachment; filename=render.{image_format}",
+        "X-Result-Id": key,
+    }
+    if RESULT_CACHE.enabled and RESULT_CACHE.has(key, rendering):
+        await run_in_threadpool(RESULT_CACHE.lookup, key)
+        headers["X-Cache"] = "HIT"
+        return FileResponse(RESULT_CACHE.path(key, rendering), media_type=OUTPUT_MEDIA_TYPES[image_format], headers=headers)
+
+    if result_id is not None:
+        def load_document() -> dict:
+            with open(RESULT_CACHE.path(key, "svg"), "r") as f:
+                return parse_svg_document(f.read())
+
+        document = await run_in_threadpool(load_document)
+    else:
+        document = {
+            "shapes": shapes,
+            "background_color": background_color,
+            "width": canvas_width,
+            "height": canvas_height,
+            "scale": working_scale(canvas_width, canvas_height),
+        }
+
+    image = await run_in_threadpool(render_document, document, size, RENDER_SUPERSAMPLE)
+    content = await run_in_threadpool(encode_image, image, image_format)
+    print(f"[DEBUG] Rendered {key} at {size[0]}x{size[1]} ({image_format}, {len(content)} bytes)")
+
+    if not RESULT_CACHE.enabled:
+        del headers["X-Result-Id"]
+        return Response(content, media_type=OUTPUT_MEDIA_TYPES[image_format], headers=headers)
+
+    if result_id is None and not RESULT_CACHE.has(key, "svg"):
+        # Keep the shapes as an SVG so later renders can refer to them by id
+        svg = build_svg(
+            round(canvas_width), round(canvas_height), background_color, document["scale"], shapes
+        )
+        await run_in_threadpool(RESULT_CACHE.store, key, "svg", svg.encode(), metadata)
+    await run_in_threadpool(RESULT_CACHE.store, key, rendering, content, metadata)
+    headers["X-Cache"] = "MISS"
+    return Response(content, media_type=OUTPUT_MEDIA_TYPES[image_format], headers=headers)
+
+
+@app.post("/api/estimate")
+async def estimate_job(
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    width: Optional[int] = Form(None),
+    height: Optional[int] = Form(None),
+    output_format: str = Form("json"),
+    shape_types: Optional[List[str]] = Form(None),
+    shape_count: List[str] = Form(["200"]),
+    resize_width: Optional[int] = Form(None),
+    resize_height: Optional[int] = Form(None),
+    time_budget_ms: Optional[int] = Form(None),
+    tile_size: Optional[int] = Form(None),
+    tile_overlap: int = Form(32),
+    priority: str = Form("interactive"),
+    engine: str = Form("primitive"),
+    pyramid: bool = Form(False),
+    importance: str = Form("none"),
+):
+    """
+    Dry run of /api/generate: estimate the job's cost and whether it would be admitted.
+
+    Takes the same parameters as /api/generate, with the image size given by an `image`
+    upload (only its header is read), an `image_id`, or `width` and `height`. Nothing is queued
+    or run; the answer reflects the server's load at the time of the call.
+    """
+    if output_format not in ["svg", "png", "json", "ndjson"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid output_format. Must be one of: svg, png, json, ndjson. Got: {output_format}"
+        )
+    # Checkpoints come out of the run of the largest count at no extra optimization cost
+    shape_count = parse_shape_counts(shape_count)[-1]
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid priority. Must be one of: {', '.join(PRIORITY_CLASSES)}. Got: {priority}"
+        )
+    if engine not in ENGINES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid engine. Must be one of: {', '.join(ENGINES)}. Got: {engine}"
+        )
+    if importance not in IMPORTANCE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid importance. Must be one of: {', '.join(IMPORTANCE_MODES)}. Got: {importance}"
+        )
+    shape_type = (shape_types[0] if shape_types else "triangle").lower()
+    if shape_type not in SHAPE_TYPE_MAPPING:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown shape type: {shape_type}. Supported types: {list(SHAPE_TYPE_MAPPING.keys())}"
+        )
+
+    if image is not None:
+        from PIL import Image
+
+        spool, _ = await spool_upload(iter_upload_file(image))
+        with spool:
+            try:
+                width, height = Image.open(spool).size  # Only parses the header
+            except Exception as e:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid image file: {str(e)}"
+                )
+    elif image_id is not None:
+        input_metadata = await run_in_threadpool(INPUT_CACHE.lookup, image_id)
+        if input_metadata is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Unknown or expired image_id: {image_id}"
+            )
+        # Already resized when it was uploaded
+        (width, height), resize_width, resize_height = input_metadata["size"], None, None
+    elif width is None or height is None or width < 1 or height < 1:
+        raise HTTPException(
+            status_code=400,
+            detail="An image, an image_id or a positive width and height must be given"
+        )
+
+    width, height = resized_dimensions(width, height, resize_width, resize_height) or (width, height)
+    estimate = COST_MODEL.estimate(
+        SHAPE_TYPE_MAPPING[shape_type], output_format, width, height, shape_count, time_budget_ms,
+        tile_size, tile_overlap, engine, pyramid and engine == "native",
+        importance if engine == "native" else "none",
+    )
+    admission = admission_check(priority, estimate["total_seconds"])
+    return {
+        "priority": priority,
+        "canvas_size": [width, height],
+        "estimated_run_seconds": estimate["run_seconds"],
+        "estimated_finish_seconds": estimate["finish_seconds"],
+        "estimated_total_seconds": estimate["total_seconds"],
+        **admission,
+    }
+
+
+def _rounded_shape(shape: dict) -> dict:
+    """A shape as sent to session and sequence clients, with coordinates rounded to two decimals."""
+    rounded = dict(shape)
+    for key, value in shape.items():
+        if key == "points" or key == "center":
+            rounded[key] = [[round(v, 2) for v in p] for p in value] if key == "points" else [round(v, 2) for v in value]
+        elif isinstance(value, float):
+            rounded[key] = round(value, 2)
+    return rounded
+
+
+async def _session_command(websocket: WebSocket, session: dict, message: dict) -> None:
+    """Run one command of an interactive session and send its results."""
+    engine = session["engine"]
+    command = message.get("command")
+
+    def summary(**fields) -> dict:
+        score = engine.score()
+        return {
+            "type": "done", "command": command, **fields, "shapes": len(engine.shapes),
+            "score": round(score, 6), "similarity": round(1 - score, 6),
+        }
+
+    if command == "add":
+        count = int(message.get("count", 50))
+        count = min(count, SESSION_MAX_SHAPES - len(engine.shapes))
+        if count < 1:
+            raise ValueError(f"count must be at least 1 and the session may hold at most {SESSION_MAX_SHAPES} shapes")
+        added, stop_reason = 0, "shape_count"
+        estimate = COST_MODEL.rate(f"run:{SHAPE_TYPE_MAPPING.get(engine.shape_type, 1)}") * count
+        # Session work shares the CPUs with primitive runs like any interactive job
+        async with SCHEDULER.slot("interactive", client_key(websocket), cost=estimate, max_threads=1):
+            for _ in range(count):
+                shape = await run_in_threadpool(engine.step)
+                if shape is None:
+                    stop_reason = "converged"
+                    break
+                added += 1
+                await websocket.send_json({
+                    "type": "shape", "index": len(engine.shapes) - 1, "shape": _rounded_shape(shape),
+                    "score": round(engine.score(), 6),
+                })
+        METRICS.inc("geometrize_session_shapes_total", added)
+        await websocket.send_json(summary(added=added, stop_reason=stop_reason))
+    elif command == "undo":
+        count = int(message.get("count", 1))
+        if count < 1:
+            raise ValueError(f"count must be at least 1. Got: {count}")
+        removed = await run_in_threadpool(engine.undo, count)
+        await websocket.send_json(summary(removed=removed))
+    elif command == "restart":
+        shape_type = message.get("shape_type", engine.shape_type)
+        opacity = int(message.get("opacity", engine.opacity))
+        if shape_type not in ENGINE_SHAPE_TYPES and shape_type not in ENGINE_SHAPE_ALIASES:
+            raise ValueError(f"Unknown shape type: {shape_type}. Supported types: {list(ENGINE_SHAPE_TYPES)}")
+        if not (1 <= opacity <= 255):
+            raise ValueError(f"opacity must be between 1 and 255. Got: {opacity}")
+        await run_in_threadpool(engine.reset, shape_type, opacity)
+        await websocket.send_json(summary(shape_type=shape_type, opacity=opacity))
+    elif command == "svg":
+        width, height = session["canvas_size"]
+        await websocket.send_json({"type": "svg", "svg": engine.to_svg(width, height)})
+    else:
+        raise ValueError(f"Unknown command: {command}. Supported commands: add, undo, restart, svg")
+
+
+@app.websocket("/api/session")
+async def interactive_session(
+    websocket: WebSocket,
+    image_id: Optional[str] = None,
+    shape_type: str = "triangle",
+    opacity: int = 128,
+    background_color: Optional[str] = None,
+    resize_width: Optional[int] = None,
+    resize_height: Optional[int] = None,
+    random_shapes: int = 50,
+    mutations_per_step: int = 30,
+    importance: str = "none",
+):
+    """
+    Interactive session: upload an image once, then add, undo and restart shapes on it.
+
+    The image is either an `image_id` from a previous request or the first (binary)
+    message. The server answers with a "ready" message and then takes JSON commands:
+
+    - {"command": "add", "count": 50}: add shapes, each streamed as a "shape" message
+    - {"command": "undo", "count": 10}: remove the last shapes
+    - {"command": "restart", "shape_type": "rectangle", "opacity": 200}: start over,
+      optionally with another shape type or opacity
+    - {"command": "svg"}: the current result as an SVG document
+
+    Every command ends with a "done" message holding the shape count and score; invalid
+    commands get an "error" message. Shapes are optimized by the in-process
+    `ShapeEngine`, which keeps the target and canvas between commands; `importance`
+    ("edges" or "saliency") weights its error as in /api/generate. Sessions idle for
+    SESSION_IDLE_SECONDS are closed.
+    """
+    await websocket.accept()
+
+    async def fail(detail: str, code: int = 1008) -> None:
+        await websocket.send_json({"type": "error", "detail": detail})
+        await websocket.close(code=code)
+
+    if shape_type not in ENGINE_SHAPE_TYPES and shape_type not in ENGINE_SHAPE_ALIASES:
+        return await fail(f"Unknown shape type: {shape_type}. Supported types: {list(ENGINE_SHAPE_TYPES)}")
+    if not (1 <= opacity <= 255):
+        return await fail(f"opacity must be between 1 and 255. Got: {opacity}")
+    if importance not in IMPORTANCE_MODES or importance == "mask":
+        return await fail(f"Invalid importance. Must be one of: none, edges, saliency. Got: {importance}")
+
+    try:
+        spool = None
+        if image_id is None:
+            # The image comes as the first message
+            data = await asyncio.wait_for(websocket.receive_bytes(), SESSION_IDLE_SECONDS)
+
+            async def chunks():
+                yield data
+
+            spool, content_hash = await spool_upload(chunks())
+            image_id = image_id_for(content_hash, resize_width, resize_height)
+        try:
+            img = await run_in_threadpool(load_input_image, image_id, spool, resize_width, resize_height)
+        finally:
+            if spool is not None:
+                spool.close()
+    except HTTPException as e:
+        return await fail(e.detail)
+    except (asyncio.TimeoutError, KeyError):
+        return await fail("Expected the image as the first (binary) message")
+    except WebSocketDisconnect:
+        return
+
+    width, height = img.size
+    target = await run_in_threadpool(working_image, img)
+    weights = await run_in_threadpool(importance_map, target, importance)
+    engine = await run_in_threadpool(functools.partial(
+        ShapeEngine, target, shape_type, opacity, background_color, random_shapes, mutations_per_step,
+        importance=weights,
+    ))
+    session = {
+        "id": os.urandom(8).hex(), "websocket": websocket, "engine": engine,
+        "canvas_size": [width, height], "busy": False,
+    }
+    if not SESSIONS.open(session):
+        return await fail("Too many active sessions, try again later", code=1013)
+
+    try:
+        await websocket.send_json({
+            "type": "ready", "session_id": session["id"],
+            "image_id": image_id if INPUT_CACHE.enabled else None,
+            "canvas_size": [width, height], "working_size": list(engine.working_size),
+            "background_color": engine.background_color, "shape_type": shape_type, "opacity": opacity,
+            "score": round(engine.score(), 6),
+        })
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive_json(), SESSION_IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                METRICS.inc("geometrize_sessions_evicted_total", reason="idle")
+                await websocket.close(code=1001, reason="Session idle timeout")
+                break
+            except (ValueError, KeyError):
+                await websocket.send_json({"type": "error", "detail": "Commands must be JSON text messages"})
+                continue
+
+            session["busy"] = True
+            SESSIONS.touch(session["id"])
+            try:
+                await _session_command(websocket, session, message if isinstance(message, dict) else {})
+            except (ValueError, TypeError) as e:
+                await websocket.send_json({"type": "error", "detail": str(e)})
+            finally:
+                session["busy"] = False
+    except WebSocketDisconnect:
+        pass
+    except RuntimeError:
+        pass  # The session was evicted and its socket closed by the server
+    finally:
+        SESSIONS.close(session["id"])
 
 
 @app.get("/health")
@@ -636,6 +5357,43 @@ async def health_check():
         }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Metrics endpoint in the Prometheus text format."""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness endpoint.
+
+    Unlike /health (liveness), this only reports ready once the primitive binary has
+    been resolved and the warm-up has finished; until then it answers 503 so the pod
+    receives no traffic. A failed warm-up is retried here at most every
+    READY_RETRY_SECONDS, so installing primitive later makes the pod ready without a restart.
+    """
+    failed_at = READINESS["failed_at"]
+    if (not READINESS["ready"] and failed_at is not None
+            and time.monotonic() - failed_at >= READY_RETRY_SECONDS):
+        print("[INFO] Retrying warm-up")
+        await run_in_threadpool(warm_up)
+    if READINESS["ready"]:
+        return {
+            "status": "ready",
+            "primitive_binary": READINESS["primitive_binary"],
+            "startup_ms": READINESS["startup_ms"],
+            "startup_budget_ms": STARTUP_READY_BUDGET_MS,
+        }
+    return JSONResponse(
+        status_code=503,
+        content={
+            "status": "starting" if READINESS["error"] is None else "not_ready",
+            "error": READINESS["error"],
+        },
+    )
+
+
 @app.get("/")
 async def root():
     """API information endpoint."""
@@ -649,14 +5407,50 @@ async def root():
                 "method": "POST",
                 "description": "Generate a geometrized version of an image"
             },
+            "generate_raw": {
+                "path": "/api/generate/raw",
+                "method": "POST",
+                "description": "Like generate, with the image as the request body and parameters in the query string"
+            },
+            "generate_sequence": {
+                "path": "/api/generate/sequence",
+                "method": "POST",
+                "description": "Geometrize image sequences and animations, seeding each frame from the previous one"
+            },
+            "session": {
+                "path": "/api/session",
+                "method": "WebSocket",
+                "description": "Interactive session: add, undo and restart shapes on one uploaded image"
+            },
+            "render": {
+                "path": "/api/render",
+                "method": "POST",
+                "description": "Render a result as PNG or WebP at any size"
+            },
+            "estimate": {
+                "path": "/api/estimate",
+                "method": "POST",
+                "description": "Estimate a job's run time and queue wait without running it"
+            },
             "health": {
                 "path": "/health",
                 "method": "GET",
                 "description": "Health check endpoint"
+            },
+            "ready": {
+                "path": "/ready",
+                "method": "GET",
+                "description": "Readiness endpoint (binary resolved and warm-up done)"
+            },
+            "metrics": {
+                "path": "/metrics",
+                "method": "GET",
+                "description": "Metrics in the Prometheus text format"
             }
         }
     }
 
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -6,8 +6,6 @@ Usage: python run.py [--host 0.0.0.0] [--port 8000]
 
 import sys
 import argparse
-import uvicorn
-from geometrize_api import app
 
 def main():
     parser = argparse.ArgumentParser(description='Geometrize API Server')
@@ -20,8 +18,11 @@ def main():
     print(f"Starting Geometrize API on {args.host}:{args.port}")
     print(f"API documentation available at http://{args.host}:{args.port}/docs")
     
+    # Imported after argument parsing so `--help` and bad arguments return immediately.
+    # The app is passed as an import string so uvicorn loads it once (and --reload works).
+    import uvicorn
     uvicorn.run(
-        app,
+        "geometrize_api:app",
         host=args.host,
         port=args.port,
         reload=args.reload
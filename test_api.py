@@ -3,9 +3,16 @@
 Comprehensive test suite for the Geometrize API.
 """
 
+import io
 import json
+import os
 import requests
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
+from contextlib import contextmanager
 from pathlib import Path
 from PIL import Image, ImageDraw
 
@@ -30,6 +37,77 @@ def test_health_check():
     assert data["status"] == "healthy", "API should be healthy"
     print("✓ Health check passed")
 
+def test_ready_endpoint():
+    """Test the readiness endpoint."""
+    print("Testing /ready endpoint...")
+    response = requests.get(f"{BASE_URL}/ready")
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    data = response.json()
+    assert data["status"] == "ready", "API should be ready"
+    assert data["primitive_binary"], "Ready response should include the primitive binary"
+    print(f"✓ Readiness check passed (startup: {data['startup_ms']} ms)")
+
+@contextmanager
+def extra_server(port, **env):
+    """Run a second server with extra environment settings on `port` for the block."""
+    server = subprocess.Popen(
+        [sys.executable, "run.py", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=Path(__file__).parent, env=dict(os.environ, **env),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+def wait_for_server(url, timeout=30):
+    """Wait until a server started with `extra_server` answers /ready (with any status)."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return requests.get(f"{url}/ready", timeout=1)
+        except requests.ConnectionError:
+            assert time.time() < deadline, f"Server at {url} did not start"
+            time.sleep(0.1)
+
+def test_ready_recovers():
+    """Test that /ready retries a warm-up that failed because primitive was missing."""
+    print("Testing /ready recovery...")
+    primitive = shutil.which("primitive")
+    # The server also looks in these fixed locations, which an emptied PATH cannot hide
+    fixed = ("/home/ubuntu/go/bin/primitive", "/usr/local/bin/primitive", "/usr/bin/primitive", "/opt/go/bin/primitive")
+    if primitive is None or any(os.path.exists(path) for path in fixed):
+        print("✓ /ready recovery skipped (primitive not in PATH, or installed system-wide)")
+        return
+    bin_dir = tempfile.mkdtemp()
+    try:
+        with extra_server(8017, PATH=bin_dir, HOME=bin_dir, GEOMETRIZE_READY_RETRY_SECONDS="1") as url:
+            deadline = time.time() + 30
+            while (response := wait_for_server(url)).json()["status"] != "not_ready":
+                assert time.time() < deadline, "Server should report not_ready without primitive"
+                time.sleep(0.1)
+            assert response.status_code == 503, f"Expected 503, got {response.status_code}"
+            
+            os.symlink(primitive, os.path.join(bin_dir, "primitive"))
+            time.sleep(1.1)
+            response = requests.get(f"{url}/ready", timeout=10)
+            assert response.status_code == 200, f"Expected 200 after installing primitive, got {response.status_code}"
+            assert response.json()["primitive_binary"].startswith(bin_dir), "Ready response should name the new binary"
+    finally:
+        shutil.rmtree(bin_dir, ignore_errors=True)
+    print("✓ /ready recovery passed")
+
+def test_metrics_endpoint():
+    """Test the metrics endpoint."""
+    print("Testing /metrics endpoint...")
+    response = requests.get(f"{BASE_URL}/metrics")
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert "geometrize_jobs_started_total" in response.text, "Metrics should include started jobs"
+    assert "geometrize_jobs_cancelled_total" in response.text, "Metrics should include cancelled jobs"
+    assert "geometrize_jobs_queued" in response.text, "Metrics should include the scheduler queue"
+    print("✓ Metrics endpoint passed")
+
 def test_root_endpoint():
     """Test the root endpoint."""
     print("Testing / endpoint...")
@@ -120,6 +198,43 @@ def test_svg_output():
     assert b'<svg' in response.content, "Response should contain SVG content"
     print("✓ SVG output passed")
 
+def test_ndjson_output():
+    """Test NDJSON output: a summary line, then one shape per line."""
+    print("Testing NDJSON output...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'ndjson',
+            'shape_types': ['triangle'],
+            'shape_count': 40
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data, headers={'Accept-Encoding': 'gzip'})
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert response.headers['content-type'].startswith('application/x-ndjson'), "Expected NDJSON content type"
+    assert response.headers.get('transfer-encoding') == 'chunked', "NDJSON should be streamed while it is converted"
+    assert response.headers.get('content-encoding') == 'gzip', "NDJSON should be compressed while it is streamed"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    summary, shapes = lines[0], lines[1:]
+    assert "canvas_size" in summary and "shapes" not in summary, "First line should be the result summary"
+    assert len(shapes) == summary["shapes_generated"] == 40, f"Expected 40 shape lines, got {len(shapes)}"
+    assert all(shape["type"] == "triangle" for shape in shapes), "Every further line should be a shape"
+    assert summary["quality"] is not None, "The summary should report the quality"
+    
+    # A cache hit is streamed from the stored SVG with the same shapes
+    with open(image_file, 'rb') as f:
+        response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data=data)
+    assert response.headers.get('x-cache') == 'HIT', "Repeated request should be served from the cache"
+    assert [json.loads(line) for line in response.text.splitlines()][1:] == shapes, "Cached shapes should match"
+    
+    # Culling needs every shape in memory at once, which NDJSON output avoids
+    with open(image_file, 'rb') as f:
+        response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data={**data, 'cull_threshold': 0.001})
+    assert response.status_code == 400, f"Expected 400 for cull_threshold with ndjson, got {response.status_code}"
+    print(f"✓ NDJSON output passed ({len(shapes)} shapes)")
+
 def test_png_output():
     """Test PNG output."""
     print("Testing PNG output...")
@@ -178,6 +293,584 @@ def test_background_color():
     assert result["background_color"] == "#000000", "Background color should be #000000"
     print("✓ Background color parameter passed")
 
+def test_time_budget():
+    """Test that a time-budgeted run returns the shapes generated so far."""
+    print("Testing time_budget_ms parameter...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['triangle'],
+            'shape_count': 5000,
+            'time_budget_ms': 2000
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result["stop_reason"] == "time_budget", "Run should stop on the time budget"
+    assert 0 < result["shapes_generated"] < 5000, f"Unexpected shapes_generated: {result['shapes_generated']}"
+    assert len(result["shapes"]) == result["shapes_generated"], "Shape list should match shapes_generated"
+    print(f"✓ time_budget_ms parameter passed ({result['shapes_generated']} shapes)")
+
+def test_target_similarity():
+    """Test that a run stops once the target similarity is reached."""
+    print("Testing target_similarity parameter...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['rectangle'],
+            'shape_count': 2000,
+            'target_similarity': 0.9
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result["stop_reason"] == "target_similarity", f"Unexpected stop_reason: {result['stop_reason']}"
+    assert result["similarity"] >= 0.9, f"Similarity should reach 0.9, got {result['similarity']}"
+    assert result["shapes_generated"] < 2000, "Run should stop before shape_count"
+    print(f"✓ target_similarity parameter passed ({result['shapes_generated']} shapes)")
+
+def test_quality_report():
+    """Test quality reporting with SSIM and the target_quality parameter."""
+    print("Testing quality report and target_quality...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['triangle'],
+            'shape_count': 2000,
+            'target_quality': 0.5,
+            'ssim': 'true'
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    quality = result["quality"]
+    assert 0 <= quality["rmse"] <= 1, f"rmse out of range: {quality['rmse']}"
+    assert abs(quality["similarity"] - (1 - quality["rmse"])) < 1e-5, "similarity should be 1 - rmse"
+    assert -1 <= quality["ssim"] <= 1, f"ssim out of range: {quality['ssim']}"
+    assert result["stop_reason"] == "target_quality", f"Expected target_quality, got {result['stop_reason']}"
+    print(f"✓ Quality report passed ({result['shapes_generated']} shapes, similarity {quality['similarity']})")
+
+def test_tiled_mode():
+    """Test tiled geometrization of a larger image."""
+    print("Testing tiled mode...")
+    image_file = "test_large_image.png"
+    Image.open(create_test_image()).resize((1024, 768)).save(image_file)
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['triangle'],
+            'shape_count': 40,
+            'tile_size': 512
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result["tiles"] == 4, f"Expected 4 tiles, got {result['tiles']}"
+    assert result["canvas_size"] == [1024, 768], "Canvas should cover the whole image"
+    assert 0 < len(result["shapes"]) <= 40, f"Unexpected shape count: {len(result['shapes'])}"
+    print(f"✓ Tiled mode passed ({len(result['shapes'])} shapes from {result['tiles']} tiles)")
+
+def test_compressed_cached_output():
+    """Test content negotiation and result caching for repeated requests."""
+    print("Testing compressed, cached output...")
+    image_file = create_test_image()
+    data = {
+        'output_format': 'svg',
+        'shape_types': ['triangle'],
+        'shape_count': 7
+    }
+    
+    responses = []
+    for _ in range(2):
+        with open(image_file, 'rb') as f:
+            responses.append(requests.post(
+                f"{BASE_URL}/api/generate", files={'image': f}, data=data,
+                headers={'Accept-Encoding': 'gzip'}
+            ))
+    
+    for response in responses:
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        assert response.headers.get('content-encoding') == 'gzip', "SVG should be served gzip-encoded"
+        assert 'Accept-Encoding' in response.headers.get('vary', ''), "Response should vary on Accept-Encoding"
+    assert responses[1].headers.get('x-cache') == 'HIT', "Repeated request should be served from the cache"
+    assert responses[0].content == responses[1].content, "Cached result should match the original"
+    print("✓ Compressed, cached output passed")
+
+def test_output_served_from_disk():
+    """Test that uncached outputs are streamed from a temporary file that is removed afterwards."""
+    print("Testing output served from disk...")
+    image_file = create_test_image()
+    scratch_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        with extra_server(8018, GEOMETRIZE_CACHE_MAX_BYTES="0", GEOMETRIZE_SCRATCH_DIR=scratch_dir,
+                          GEOMETRIZE_CACHE_DIR=os.path.join(cache_dir, "results")) as url:
+            wait_for_server(url)
+            with open(image_file, 'rb') as f:
+                response = requests.post(
+                    f"{url}/api/generate", files={'image': f},
+                    data={'output_format': 'png', 'shape_types': ['triangle'], 'shape_count': 7},
+                    stream=True
+                )
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+            assert 'content-length' in response.headers, "A file response should declare its length"
+            assert 'chunked' not in response.headers.get('transfer-encoding', ''), "A file response should not be chunked"
+            assert 'x-cache' not in response.headers, "Nothing should be cached with the cache disabled"
+            body = response.raw.read(decode_content=False)
+            assert len(body) == int(response.headers['content-length']), "Body should match Content-Length"
+            assert body.startswith(b'\x89PNG'), "Output should be a PNG"
+            response.close()
+            
+            deadline = time.time() + 5
+            while os.listdir(scratch_dir):
+                assert time.time() < deadline, f"Temporary files should be removed: {os.listdir(scratch_dir)}"
+                time.sleep(0.05)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    print("✓ Output served from disk passed")
+
+def test_compact_svg_output():
+    """Test the compact SVG profile."""
+    print("Testing compact SVG output...")
+    image_file = create_test_image()
+    data = {
+        'output_format': 'svg',
+        'shape_types': ['triangle'],
+        'shape_count': 20
+    }
+    
+    sizes = {}
+    for profile in ['primitive', 'compact']:
+        with open(image_file, 'rb') as f:
+            response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data={**data, 'svg_profile': profile})
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        assert response.headers['content-type'] == 'image/svg+xml', "Content-Type should be 'image/svg+xml'"
+        sizes[profile] = len(response.content)
+    
+    assert b'fill-opacity=' not in response.content.split(b'<path', 1)[1], "Shared opacity should move to the group"
+    assert sizes['compact'] < sizes['primitive'], f"Compact SVG should be smaller: {sizes}"
+    print(f"✓ Compact SVG output passed ({sizes['primitive']} -> {sizes['compact']} bytes)")
+
+def test_cull_threshold():
+    """Test the shape culling post-pass."""
+    print("Testing cull_threshold parameter...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['triangle'],
+            'shape_count': 100,
+            'cull_threshold': 0.0001
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    culling = result["culling"]
+    assert culling is not None, "Response should report the culling pass"
+    assert culling["shapes_before"] == 100, f"Expected 100 shapes before culling, got {culling['shapes_before']}"
+    assert len(result["shapes"]) == 100 - culling["shapes_removed"], "Culled shapes should be removed from the output"
+    print(f"✓ cull_threshold parameter passed ({culling['shapes_removed']} shapes removed)")
+
+def test_shape_count_checkpoints():
+    """Test several shape counts returned from a single run."""
+    print("Testing shape_count checkpoints...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['triangle'],
+            'shape_count': '10,30,20'
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result["shapes_generated"] == 30, "The run should go up to the largest count"
+    checkpoints = result["checkpoints"]
+    assert [c["shape_count"] for c in checkpoints] == [10, 20], f"Unexpected checkpoints: {checkpoints}"
+    assert all(c["shapes_generated"] == c["shape_count"] for c in checkpoints), "Checkpoints should hold their shape count"
+    
+    # Each checkpoint is a result of its own
+    data = {'image_id': result['image_id'], 'output_format': 'json', 'shape_types': ['triangle'], 'shape_count': 10}
+    response = requests.post(f"{BASE_URL}/api/generate", data=data)
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert response.headers.get('X-Cache') == 'HIT', "A checkpoint should be served from the cache"
+    assert len(response.json()["shapes"]) == 10, "Expected the 10-shape checkpoint"
+    assert response.json()["result_id"] == checkpoints[0]["result_id"], "Checkpoint result ids should match"
+    print("✓ shape_count checkpoints passed")
+
+def test_coalesced_requests():
+    """Test identical concurrent requests sharing one job."""
+    print("Testing coalescing of identical requests...")
+    import threading
+    img = Image.new('RGB', (120, 90), color='white')
+    draw = ImageDraw.Draw(img)
+    draw.ellipse([10, 10, 70, 70], fill=(int(time.time() * 1000) % 256, 80, 160))
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    data = {'output_format': 'json', 'shape_types': ['triangle'], 'shape_count': 150}
+    
+    responses = []
+    
+    def client():
+        responses.append(requests.post(f"{BASE_URL}/api/generate", files={'image': ('c.png', buffer.getvalue())}, data=data))
+    
+    threads = [threading.Thread(target=client) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert all(r.status_code == 200 for r in responses), f"Unexpected statuses: {[r.status_code for r in responses]}"
+    statuses = sorted(r.headers.get('X-Cache') for r in responses)
+    assert statuses.count('MISS') == 1, f"Exactly one request should run the job, got {statuses}"
+    assert len({json.dumps(r.json()['shapes']) for r in responses}) == 1, "All requests should get the same result"
+    print(f"✓ Coalescing passed ({', '.join(statuses)})")
+
+def test_resource_accounting():
+    """Test per-job resource usage in the JSON output, headers and metrics."""
+    print("Testing resource accounting...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['ellipse'],
+            'shape_count': 25,
+            'time_budget_ms': 60000
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data, headers={'X-Client-Id': 'accounting-test', 'Accept-Encoding': 'identity'})
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    resources = response.json()["resources"]
+    assert resources["wall_ms"] > 0, "Wall time should be reported"
+    assert resources["cpu_user_ms"] is None or resources["cpu_user_ms"] >= 0, "CPU time should be reported"
+    assert resources["bytes_in"] == Path(image_file).stat().st_size, "Bytes in should be the upload size"
+    assert resources["bytes_out"] == len(response.content), "Bytes out should be the body size"
+    assert not resources["served_from_cache"], "A fresh run should not be marked as cached"
+    assert response.headers.get('X-Job-Wall-Ms') == str(resources["wall_ms"]), "Headers should match the JSON output"
+    assert response.headers.get('X-Job-Bytes-Out') == str(len(response.content)), "Bytes out header should be the body size"
+    
+    # The identical request is a cache hit: it ran nothing, so it must not be charged again
+    with open(image_file, 'rb') as f:
+        response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data=data, headers={'X-Client-Id': 'accounting-test'})
+    assert response.headers.get('X-Cache') == 'HIT', "Repeated request should be a cache hit"
+    cached = response.json()["resources"]
+    assert cached["served_from_cache"] and cached["wall_ms"] == 0 and cached["cpu_user_ms"] == 0, "A cache hit should report no run cost"
+    assert response.headers.get('X-Job-Wall-Ms') == '0' and response.headers.get('X-Job-CPU-User-Ms') == '0', "Cache hit headers should report no run cost"
+    assert response.headers.get('X-Job-Bytes-In') == str(Path(image_file).stat().st_size), "Cache hit headers should report the upload"
+    assert 'X-Job-Bytes-Out' in response.headers, "Cache hit headers should report bytes out"
+    
+    metrics = requests.get(f"{BASE_URL}/metrics").text
+    assert 'geometrize_job_bytes_out_total{client="accounting-test",mode="ellipse"}' in metrics, "Bytes out should be in the metrics"
+    print(f"✓ Resource accounting passed ({resources})")
+
+def test_render_endpoint():
+    """Test rendering a previous result at other sizes."""
+    print("Testing /api/render endpoint...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['triangle'],
+            'shape_count': 20
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    
+    response = requests.post(f"{BASE_URL}/api/render", json={'result_id': result['result_id'], 'width': 64})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert response.headers['content-type'] == 'image/png', "Content-Type should be 'image/png'"
+    assert Image.open(io.BytesIO(response.content)).size == (64, 64), "Render should fit the requested width"
+    
+    response = requests.post(f"{BASE_URL}/api/render", json={'result': result, 'scale': 2, 'format': 'webp'})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert response.headers['content-type'] == 'image/webp', "Content-Type should be 'image/webp'"
+    assert Image.open(io.BytesIO(response.content)).size == (512, 512), "Render should be scaled 2x"
+    
+    # The reported background is the one the run used, so both ways of rendering agree
+    renders = []
+    for source in ({'result_id': result['result_id']}, {'result': result}):
+        response = requests.post(f"{BASE_URL}/api/render", json={**source, 'width': 64})
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        renders.append(Image.open(io.BytesIO(response.content)).convert('RGB'))
+    from PIL import ImageChops, ImageStat
+    difference = ImageStat.Stat(ImageChops.difference(*renders)).mean
+    assert max(difference) < 2, f"Rendering by result and by result_id should match, mean difference {difference}"
+    print("✓ /api/render endpoint passed")
+
+def test_render_invalid_result():
+    """Test that malformed inline results are rejected with 400."""
+    print("Testing /api/render with invalid results...")
+    triangle = {'type': 'triangle', 'color': '#ff0000', 'opacity': 128, 'points': [[0, 0], [10, 0], [0, 10]]}
+    invalid_shapes = [
+        {**triangle, 'points': []},
+        {**triangle, 'points': [[0, 0], [10, 0]]},
+        {**triangle, 'points': [[0, 0], [10], [0, 10]]},
+        {**triangle, 'opacity': 128.5},
+        {**triangle, 'opacity': 300},
+    ]
+    for shape in invalid_shapes:
+        result = {'shapes': [shape], 'canvas_size': [32, 32], 'background_color': '#ffffff'}
+        response = requests.post(f"{BASE_URL}/api/render", json={'result': result})
+        assert response.status_code == 400, f"Expected 400 for {shape}, got {response.status_code}"
+    print("✓ /api/render invalid results passed")
+
+def test_batch_priority():
+    """Test submitting a batch job and rejecting unknown priority classes."""
+    print("Testing priority parameter...")
+    image_file = create_test_image()
+    
+    for priority, expected in [('batch', 200), ('urgent', 400)]:
+        with open(image_file, 'rb') as f:
+            files = {'image': f}
+            data = {
+                'output_format': 'json',
+                'shape_types': ['triangle'],
+                'shape_count': 9,
+                'priority': priority
+            }
+            response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data, headers={'X-Client-Id': 'test-suite'})
+        assert response.status_code == expected, f"Expected {expected} for {priority}, got {response.status_code}"
+    
+    metrics = requests.get(f"{BASE_URL}/metrics").text
+    assert 'geometrize_queue_wait_seconds_count{class="batch"}' in metrics, "Batch queue wait should be recorded"
+    print("✓ priority parameter passed")
+
+def test_cpu_budget_split():
+    """Test that concurrent jobs start at once with worker thread counts (-j) within the CPU budget."""
+    print("Testing CPU budget split...")
+    import asyncio
+    from geometrize_api import JobScheduler
+    budget = 8
+    
+    async def scenario():
+        scheduler = JobScheduler(4, {'interactive': 4, 'batch': 2}, cpu_budget=budget)
+        held, snapshots = {}, []
+        
+        async def job(name, priority, seconds, **kwargs):
+            async with scheduler.slot(priority, name, **kwargs) as threads:
+                held[name] = threads
+                snapshots.append(dict(held))
+                await asyncio.sleep(seconds)
+                del held[name]
+        
+        # A batch job finds an idle server; interactive jobs arriving while it runs must
+        # start right away with threads of their own instead of waiting for it
+        batch = asyncio.create_task(job('batch', 'batch', 0.3))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await asyncio.gather(
+            job('client-a', 'interactive', 0.1), job('client-b', 'interactive', 0.1),
+            job('session', 'interactive', 0.1, max_threads=1),
+        )
+        waited = time.monotonic() - started
+        await batch
+        return snapshots, waited
+    
+    snapshots, waited = asyncio.run(scenario())
+    first = snapshots[0]
+    assert 1 < first['batch'] < budget, f"A job on an idle server should leave a thread for each free slot, got {first}"
+    for snapshot in snapshots:
+        assert all(threads >= 1 for threads in snapshot.values()), "Every job should get at least one thread"
+        assert sum(snapshot.values()) <= budget, f"Concurrent jobs overbook the budget: {snapshot}"
+    busiest = max(snapshots, key=len)
+    assert set(busiest) == {'batch', 'client-a', 'client-b', 'session'}, f"Jobs should run alongside the batch job, got {busiest}"
+    assert busiest['session'] == 1, "A single-threaded job should get one thread"
+    assert waited < 0.2, f"Interactive jobs should not wait for the batch job ({waited * 1000:.0f} ms)"
+    print(f"✓ CPU budget split passed ({busiest})")
+
+def test_image_id_reuse():
+    """Test generating again from a previous upload by its image_id."""
+    print("Testing image_id reuse...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        data = {'output_format': 'json', 'shape_types': ['triangle'], 'shape_count': 7, 'resize_width': 50}
+        response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data=data)
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    first = response.json()
+    image_id = first['image_id']
+    assert image_id and response.headers.get('X-Image-Id') == image_id, "Should return the image_id"
+    
+    data = {'image_id': image_id, 'output_format': 'json', 'shape_types': ['rectangle'], 'shape_count': 8}
+    response = requests.post(f"{BASE_URL}/api/generate", data=data)
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    second = response.json()
+    assert second['canvas_size'] == first['canvas_size'], "Should reuse the resized image"
+    assert second['shapes_generated'] == 8, "Should use the new parameters"
+    
+    response = requests.post(f"{BASE_URL}/api/generate", data={'image_id': 'unknown', 'output_format': 'json'})
+    assert response.status_code == 404, f"Expected 404 for an unknown image_id, got {response.status_code}"
+    print("✓ image_id reuse passed")
+
+def test_raw_body_upload():
+    """Test sending the image as the raw request body."""
+    print("Testing raw body upload...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        image_bytes = f.read()
+    params = {'output_format': 'json', 'shape_types': ['ellipse'], 'shape_count': 6}
+    response = requests.post(f"{BASE_URL}/api/generate/raw", params=params, data=image_bytes, headers={'Content-Type': 'image/png'})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result['shapes_generated'] == 6, "Should use the query parameters"
+    assert result['shape_types'] == ['ellipse'], "Should use the query parameters"
+    
+    response = requests.post(f"{BASE_URL}/api/generate/raw", params=params, data=image_bytes, headers={'Content-Type': 'text/plain'})
+    assert response.status_code == 415, f"Expected 415, got {response.status_code}"
+    print("✓ raw body upload passed")
+
+def test_native_engine_pyramid():
+    """Test the native engine with and without pyramid mode."""
+    print("Testing native engine and pyramid mode...")
+    image_file = create_test_image()
+    
+    for pyramid in (False, True):
+        with open(image_file, 'rb') as f:
+            data = {'output_format': 'json', 'shape_types': ['triangle'], 'shape_count': 10, 'engine': 'native', 'pyramid': pyramid}
+            response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data=data)
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        result = response.json()
+        assert result['shapes_generated'] == 10, "Should generate the requested shapes"
+        assert result['engine']['name'] == 'native' and result['engine']['pyramid'] == pyramid, "Should report the engine"
+        assert result['engine']['pixels_evaluated'] > 0, "Should count the pixels evaluated"
+    
+    with open(image_file, 'rb') as f:
+        response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data={'output_format': 'json', 'pyramid': True})
+    assert response.status_code == 400, f"Expected 400 for pyramid without the native engine, got {response.status_code}"
+    
+    with open(image_file, 'rb') as f:
+        response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data={'output_format': 'json', 'engine': 'native', 'opacity': 0})
+    assert response.status_code == 400, f"Expected 400 for opacity 0 with the native engine, got {response.status_code}"
+    print("✓ native engine and pyramid mode passed")
+
+def test_importance_mask():
+    """Test weighting the native engine by an uploaded importance mask."""
+    print("Testing importance mask...")
+    image_file = create_test_image()
+    mask = Image.new('L', (50, 50), 0)
+    ImageDraw.Draw(mask).rectangle([10, 10, 30, 30], fill=255)
+    buffer = io.BytesIO()
+    mask.save(buffer, 'PNG')
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f, 'importance_mask': ('mask.png', buffer.getvalue())}
+        data = {'output_format': 'json', 'shape_count': 8, 'engine': 'native'}
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result['engine']['importance'] == 'mask', "An uploaded mask should imply importance=mask"
+    assert result['shapes_generated'] == 8, "Should generate the requested shapes"
+    
+    with open(image_file, 'rb') as f:
+        data = {'output_format': 'json', 'shape_count': 8, 'importance': 'edges'}
+        response = requests.post(f"{BASE_URL}/api/generate", files={'image': f}, data=data)
+    assert response.status_code == 400, f"Expected 400 for importance without the native engine, got {response.status_code}"
+    print("✓ importance mask passed")
+
+def test_sequence():
+    """Test geometrizing an image sequence seeded from the previous frame."""
+    print("Testing image sequence...")
+    frames = []
+    for shift in (0, 0, 20):
+        img = Image.new('RGB', (100, 80), color='white')
+        ImageDraw.Draw(img).ellipse([10 + shift, 20, 50 + shift, 60], fill='red')
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG')
+        frames.append(('frames', (f'frame{shift}.png', buffer.getvalue())))
+    
+    response = requests.post(f"{BASE_URL}/api/generate/sequence", files=frames, data={'shape_count': 10})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result['frame_count'] == 3, "Should return every frame"
+    assert result['frames'][0]['shapes_added'] == 10, "The first frame should get a full run"
+    assert result['frames'][1]['shapes_added'] == 0, "An unchanged frame should keep its shapes"
+    assert result['frames'][1]['shapes'] == result['frames'][0]['shapes'], "An unchanged frame should not flicker"
+    changed = result['frames'][2]
+    assert changed['changed_fraction'] > 0 and changed['shapes_added'] > 0, "A changed frame should be re-optimized"
+    assert changed['shapes_kept'] + changed['shapes_added'] == changed['shapes_generated'], "Kept and added shapes should add up"
+    print("✓ image sequence passed")
+
+def test_interactive_session():
+    """Test adding and undoing shapes in a WebSocket session."""
+    print("Testing interactive session...")
+    from websockets.sync.client import connect
+    image_file = create_test_image()
+    
+    with connect(BASE_URL.replace('http', 'ws', 1) + "/api/session?shape_type=rectangle") as ws:
+        with open(image_file, 'rb') as f:
+            ws.send(f.read())
+        ready = json.loads(ws.recv())
+        assert ready['type'] == 'ready', f"Expected ready, got {ready}"
+        
+        ws.send(json.dumps({'command': 'add', 'count': 5}))
+        shapes = []
+        while (message := json.loads(ws.recv()))['type'] == 'shape':
+            shapes.append(message['shape'])
+        assert message['type'] == 'done', f"Expected done, got {message}"
+        assert message['shapes'] == len(shapes) > 0, "Should stream every added shape"
+        assert message['score'] < ready['score'], "Shapes should lower the error"
+        
+        ws.send(json.dumps({'command': 'undo', 'count': 2}))
+        message = json.loads(ws.recv())
+        assert message['shapes'] == len(shapes) - 2, "Undo should remove shapes"
+        
+        ws.send(json.dumps({'command': 'undo', 'count': -1}))
+        assert json.loads(ws.recv())['type'] == 'error', "A negative undo count should be reported"
+        
+        ws.send(json.dumps({'command': 'jump'}))
+        assert json.loads(ws.recv())['type'] == 'error', "Unknown commands should be reported"
+    print("✓ interactive session passed")
+
+def test_estimate_endpoint():
+    """Test the dry-run cost estimate, by image upload and by dimensions."""
+    print("Testing estimate endpoint...")
+    image_file = create_test_image()
+    
+    with open(image_file, 'rb') as f:
+        response = requests.post(f"{BASE_URL}/api/estimate", files={'image': f}, data={'shape_count': 20})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    result = response.json()
+    assert result['estimated_run_seconds'] > 0, "Run time estimate should be positive"
+    assert result['estimated_queue_wait_seconds'] >= 0, "Queue wait estimate should not be negative"
+    assert isinstance(result['admitted'], bool), "Should say whether the job would be admitted"
+    
+    small = requests.post(f"{BASE_URL}/api/estimate", data={'width': 200, 'height': 200, 'shape_count': 100}).json()
+    large = requests.post(f"{BASE_URL}/api/estimate", data={'width': 200, 'height': 200, 'shape_count': 1000}).json()
+    assert large['estimated_run_seconds'] > small['estimated_run_seconds'], "More shapes should take longer"
+    
+    response = requests.post(f"{BASE_URL}/api/estimate", data={'shape_count': 20})
+    assert response.status_code == 400, f"Expected 400 without image or size, got {response.status_code}"
+    print("✓ estimate endpoint passed")
+
 def test_invalid_output_format():
     """Test invalid output format error handling."""
     print("Testing invalid output format error handling...")
@@ -213,6 +906,24 @@ def test_invalid_opacity():
     assert response.status_code == 400, f"Expected 400, got {response.status_code}"
     print("✓ Invalid opacity error handling passed")
 
+def test_oversized_dimensions():
+    """Test that images over the dimension limit are rejected from their header."""
+    print("Testing oversized image dimension handling...")
+    image_file = "test_oversized.png"
+    Image.new('L', (13000, 4), color=255).save(image_file)
+    
+    with open(image_file, 'rb') as f:
+        files = {'image': f}
+        data = {
+            'output_format': 'json',
+            'shape_types': ['triangle'],
+            'shape_count': 5
+        }
+        response = requests.post(f"{BASE_URL}/api/generate", files=files, data=data)
+    
+    assert response.status_code == 413, f"Expected 413, got {response.status_code}"
+    print("✓ Oversized image dimension handling passed")
+
 def run_all_tests():
     """Run all tests."""
     print("=" * 60)
@@ -221,16 +932,43 @@ def run_all_tests():
     
     tests = [
         test_health_check,
+        test_ready_endpoint,
+        test_ready_recovers,
+        test_metrics_endpoint,
         test_root_endpoint,
         test_json_output_triangle,
         test_json_output_rectangle,
         test_json_output_circle,
         test_svg_output,
         test_png_output,
+        test_ndjson_output,
         test_opacity_parameter,
         test_background_color,
+        test_time_budget,
+        test_target_similarity,
+        test_quality_report,
+        test_tiled_mode,
+        test_compressed_cached_output,
+        test_output_served_from_disk,
+        test_compact_svg_output,
+        test_cull_threshold,
+        test_shape_count_checkpoints,
+        test_coalesced_requests,
+        test_resource_accounting,
+        test_render_endpoint,
+        test_render_invalid_result,
+        test_batch_priority,
+        test_cpu_budget_split,
+        test_estimate_endpoint,
+        test_image_id_reuse,
+        test_raw_body_upload,
+        test_native_engine_pyramid,
+        test_importance_mask,
+        test_sequence,
+        test_interactive_session,
         test_invalid_output_format,
         test_invalid_opacity,
+        test_oversized_dimensions,
     ]
     
     passed = 0